@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Reproducible benchmarks of the ingestion pipeline.
+
+Corpora are generated with `LogGenerator` from a fixed seed and a fixed start date,
+so two runs with the same arguments process the exact same lines.
+Results are written as JSON, use `--compare` with a previous result file to see the changes.
+
+    $ python -m benchmarks.benchmark --output before.json
+    $ python -m benchmarks.benchmark --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from datalog_http_monitoring.cli_swag import CliSwag
+from datalog_http_monitoring.generate_logs import LogGenerator
+from datalog_http_monitoring.log_collector import Log, EmptyLog, LogCollector
+from datalog_http_monitoring.http_logs_stats import HTTPLogsStats, HTTPStats, HTTPStatsSections
+
+
+START_DATE = datetime.datetime(2018, 5, 9, 16, 0, 0)
+
+BENCHMARKS = {}
+
+
+def benchmark(unit):
+    """
+    Register a benchmark function, it receives the corpus and returns the number of processed `unit`
+    """
+    def decorator(func):
+        BENCHMARKS[func.__name__.replace("bench_", "")] = (func, unit)
+        return func
+    return decorator
+
+
+def generate_corpus(seed, lines, rate):
+    """
+    Generate `lines` log lines starting at `START_DATE` with `rate` lines per second.
+    """
+    generator = LogGenerator(users=100, files=150, ips=50, threshold_requests=10, threshold_period=120,
+                             threshold_duration_max=300, threshold_trigger_each=600, seed=seed)
+    return [generator.generate_log(START_DATE + datetime.timedelta(seconds=i / rate)) for i in range(lines)]
+
+
+@benchmark("lines")
+def bench_generate_blocks(corpus, _):
+    generator = LogGenerator(users=100, files=150, ips=50, threshold_requests=10, threshold_period=120,
+                             threshold_duration_max=300, threshold_trigger_each=600, seed=0)
+    lines = 0
+    for block in generator.generate_blocks(rate=len(corpus), generation_seconds=10, live=False):
+        lines += block.count("\n")
+    return lines
+
+
+@benchmark("lines")
+def bench_log_from_string(corpus, _):
+    for line in corpus:
+        Log.from_string(line)
+    return len(corpus)
+
+
+@benchmark("lines")
+def bench_common_parser(corpus, _):
+    from datalog_http_monitoring.parsers import get_parser
+    parse = get_parser("common")
+    for line in corpus:
+        parse(line)
+    return len(corpus)
+
+
+@benchmark("logs")
+def bench_http_stats_update(_, logs):
+    stats = HTTPStats()
+    for log in logs:
+        stats.update(log)
+    return len(logs)
+
+
+@benchmark("logs")
+def bench_http_stats_sections_update(_, logs):
+    stats = HTTPStatsSections()
+    for log in logs:
+        stats.update(log)
+    return len(logs)
+
+
+@benchmark("logs")
+def bench_check_alert_sustained(_, logs):
+    # threshold is always exceeded, so the alert stays open during the whole corpus
+    stats = HTTPLogsStats(period=10, alert_period=120, alert_threshold=0)
+    for log in logs:
+        stats._check_alert(log)
+    assert stats.in_alert
+    return len(logs)
+
+
+@benchmark("frames")
+def bench_format_stats(_, logs):
+    stats = HTTPLogsStats(period=10, alert_period=120, alert_threshold=10)
+    for log in logs:
+        stats.update(log)
+    cli = CliSwag(use_curses=False)
+    frames = 200
+    for _ in range(frames):
+        cli.format_stats(stats)
+    return frames
+
+
+@benchmark("lines")
+def bench_end_to_end(corpus, _):
+    return end_to_end(corpus, LogCollector.QUEUE)
+
+
+@benchmark("lines")
+def bench_end_to_end_shm(corpus, _):
+    return end_to_end(corpus, LogCollector.SHARED_MEMORY)
+
+
+def end_to_end(corpus, transport):
+    # collector runs in its own process, so only the main process is traced
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_file = os.path.join(tmp_dir, "access.log")
+        with open(log_file, "w", encoding="utf-8") as fd:
+            fd.write("\n".join(corpus) + "\n")
+
+        collector = LogCollector(log_files={log_file}, transport=transport)
+        stats = HTTPLogsStats(period=10, alert_period=120, alert_threshold=10)
+        stats.sources = collector.sources
+        collector.add_consumer(stats.update)
+        collector.watcher_process.start()
+        try:
+            received = 0
+            for log in collector:
+                collector.feed_consumers(log)
+                if not isinstance(log, EmptyLog):
+                    received += 1
+                    if received == len(corpus):
+                        break
+        finally:
+            collector.watcher_process.terminate()
+            collector.watcher_process.join()
+            collector.close()
+    return received
+
+
+@benchmark("starts")
+def bench_startup(*_):
+    # time to start a process, import the application and parse the command line
+    starts = 10
+    for _ in range(starts):
+        subprocess.check_call([sys.executable, "-m", "datalog_http_monitoring", "--help"], stdout=subprocess.DEVNULL)
+    return starts
+
+
+def run_benchmark(func, corpus, logs, repeat):
+    timings = []
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func(corpus, logs)
+        timings.append(time.perf_counter() - start)
+
+    # peak memory is measured on a separate run to not slow down the timed ones
+    tracemalloc.start()
+    func(corpus, logs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        "count": count,
+        "best_seconds": best,
+        "timings": timings,
+        "per_second": count / best if best else None,
+        "peak_memory": peak,
+    }
+
+
+def compare(results, previous):
+    for name, result in results["benchmarks"].items():
+        old = previous["benchmarks"].get(name)
+        if not old or not old.get("per_second"):
+            print(f"{name:32s} {result['per_second']:>14,.0f} /s  (new)")
+            continue
+        ratio = result["per_second"] / old["per_second"]
+        print(f"{name:32s} {result['per_second']:>14,.0f} /s  {ratio:6.2f}x  "
+              f"peak {result['peak_memory'] / 1024:,.0f}KiB (was {old['peak_memory'] / 1024:,.0f}KiB)")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion pipeline")
+    parser.add_argument("--seed", help="random seed of the corpus (default: %(default)s)", default=42, type=int)
+    parser.add_argument("--lines", help="corpus size (default: %(default)s)", default=50000, type=int)
+    parser.add_argument("--rate", help="corpus lines per second (default: %(default)s)", default=50, type=float)
+    parser.add_argument("--repeat", help="runs per benchmark, best is kept (default: %(default)s)",
+                        default=3, type=int)
+    parser.add_argument("--only", help="run only these benchmarks", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--output", help="write JSON results to this file (default: stdout)",
+                        metavar="FILE", default=None)
+    parser.add_argument("--compare", help="compare results with a previous JSON results file",
+                        metavar="FILE", default=None)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    corpus = generate_corpus(args.seed, args.lines, args.rate)
+    logs = [Log.from_string(line) for line in corpus]
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "lines": args.lines,
+        "rate": args.rate,
+        "benchmarks": {},
+    }
+    for name, (func, unit) in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        result = run_benchmark(func, corpus, logs, args.repeat)
+        result["unit"] = unit
+        results["benchmarks"][name] = result
+        print(f"{name}: {result['per_second']:,.0f} {unit}/s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fd:
+            json.dump(results, fd, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fd:
+            compare(results, json.load(fd))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,14 +8,18 @@ import argparse
 import tempfile
 import multiprocessing
 
-from datalog_http_monitoring.generate_logs import write_logs
+from datalog_http_monitoring import profiling
 
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(
         description="Collect logs and display realtime formatted statistics")
-    parser.add_argument("log_files", help="Files to collect logs from (default: %(default)s)",
+    parser.add_argument("log_files", help="Files to collect logs from, glob patterns and directories (their *.log "
+                                          "files) also collect files created later (default: %(default)s)",
                         metavar="LOGFILE", default=["/tmp/access.log"], nargs="*")
+    parser.add_argument("--log-format", help="format of log files: auto, common, combined, json or a format string "
+                                             "using nginx variables (default: %(default)s)",
+                        metavar="FORMAT", default="auto", type=str)
     parser.add_argument("--period", help="monitoring period to display statistics (default: %(default)s)",
                         default=10, type=int)
     parser.add_argument("--alert", help="minimum number of requests to trigger alert mode (default: %(default)s)",
@@ -24,8 +28,68 @@ def parse_args(args=None):
                         default=120, type=int)
     parser.add_argument("--alert-file", help="where to store alerts details (default: %(default)s)",
                         default=os.path.join(tempfile.gettempdir(), "alerts.log"), type=str)
+    parser.add_argument("--anomaly", help="also alert when a section traffic or the 5XX ratio get far above "
+                                          "their usual values",
+                        default=False, action="store_true")
+    parser.add_argument("--anomaly-interval", help="counting interval of anomaly alerting (default: %(default)s)",
+                        metavar="SECONDS", default=10, type=int)
+    parser.add_argument("--reorder-delay", help="maximum delay of logs held back to process logs of all files "
+                                                "in date order, 0 to disable (default: %(default)s)",
+                        metavar="SECONDS", default=10, type=float)
     parser.add_argument("--refresh", help="statistics display refresh delay (default: %(default)s)",
                         default=.1, type=float)
+    parser.add_argument("--queue-size", help="maximum number of collected logs waiting to be processed, "
+                                             "0 for unbounded (default: %(default)s)",
+                        metavar="SIZE", default=100000, type=int)
+    parser.add_argument("--overload", help="what to do with new logs when the queue is full (default: %(default)s)",
+                        choices=("block", "drop", "sample"), default="block")
+    parser.add_argument("--transport", help="how logs are sent from the watcher process: pickled through a queue or "
+                                            "written in a shared memory ring buffer (default: %(default)s)",
+                        choices=("queue", "shm"), default="queue")
+    parser.add_argument("--sample", help="share of log lines to parse, statistics are scaled back "
+                                         "to estimates (default: %(default)s)",
+                        metavar="RATE", default=1.0, type=float)
+    parser.add_argument("--sample-adaptive", help="lower sampling rate while logs are collected faster "
+                                                  "than they are processed",
+                        default=False, action="store_true")
+    parser.add_argument("--asyncio", help="collect logs in the main process on an asyncio loop instead of a "
+                                          "watcher process, lower overhead for low volumes "
+                                          "(--queue-size, --overload and --sample-adaptive are ignored)",
+                        default=False, action="store_true")
+    parser.add_argument("--agent", help="stream collected logs to an aggregator (see --aggregator) "
+                                        "instead of displaying statistics",
+                        metavar="HOST:PORT", default=None, type=str)
+    parser.add_argument("--agent-name", help="name of this agent, prefixed to its files paths in the aggregator "
+                                             "(default: host name)",
+                        metavar="NAME", default=None, type=str)
+    parser.add_argument("--agent-buffer", help="maximum number of logs kept while the aggregator is unreachable, "
+                                               "oldest are dropped (default: %(default)s)",
+                        metavar="SIZE", default=100000, type=int)
+    parser.add_argument("--aggregator", help="display statistics of logs received from agents on this address "
+                                             "instead of collecting log files (default host: 127.0.0.1, "
+                                             "agents are not authenticated)",
+                        metavar="[HOST:]PORT", default=None, type=str)
+    parser.add_argument("--snapshot", help="periodically save state to this file and restore it at startup",
+                        metavar="FILE", default=None, type=str)
+    parser.add_argument("--snapshot-interval", help="delay between state snapshots (default: %(default)s)",
+                        metavar="SECONDS", default=30, type=float)
+    parser.add_argument("--history", help="with --history-socket, keep logs of the last minutes in memory "
+                                          "for queries (default: %(default)s)",
+                        metavar="MINUTES", default=5, type=float)
+    parser.add_argument("--history-socket", help="answer recent logs queries on this unix socket, "
+                                                 "see `python -m datalog_http_monitoring.history --help`",
+                        metavar="PATH", default=None, type=str)
+    parser.add_argument("--archive", help="also write parsed logs and periodic statistics to this directory, "
+                                          "see `python -m datalog_http_monitoring.archive --help`",
+                        metavar="DIR", default=None, type=str)
+    parser.add_argument("--show-metrics", help="display a debug panel with pipeline health metrics",
+                        default=False, action="store_true")
+    parser.add_argument("--profile", help="profile every process and write stats to this directory",
+                        metavar="DIR", default=None, type=str)
+    parser.add_argument("--profile-memory", help="also trace memory allocations when profiling (slow)",
+                        default=False, action="store_true")
+    parser.add_argument("--profile-interval", help="delay between profiling stats dumps (default: %(default)s)",
+                        metavar="SECONDS", default=60, type=float)
     parser.add_argument("--no-curses", help="fallback to simple print for display",
                         default=False, action="store_true")
     parser.add_argument("--demo", help="auto generate logs for debugging purpose",
@@ -42,7 +106,8 @@ def parse_args(args=None):
 
 
 def launch_log_generator(args):
-    from datalog_http_monitoring.generate_logs import LogGenerator
+    # imported here, faker is slow to import and only needed for demo
+    from datalog_http_monitoring.generate_logs import LogGenerator, write_logs
 
     log_generator = LogGenerator(
         users=max(args.alert // 3, 30),
@@ -69,6 +134,37 @@ def launch_log_generator(args):
         ).start()
 
 
+def create_collector(args, offsets=None, metrics=None):
+    if args.aggregator:
+        from datalog_http_monitoring.agent import LogAggregator, parse_address
+        return LogAggregator(parse_address(args.aggregator), metrics=metrics)
+    if args.asyncio:
+        from datalog_http_monitoring.async_log_collector import AsyncLogCollector
+        return AsyncLogCollector(log_files=args.log_files, offsets=offsets, metrics=metrics,
+                                 sample_rate=args.sample, log_format=args.log_format, tick_interval=args.refresh)
+
+    from datalog_http_monitoring.log_collector import LogCollector
+    return LogCollector(log_files=args.log_files, offsets=offsets, metrics=metrics,
+                        queue_size=args.queue_size, overload=args.overload,
+                        sample_rate=args.sample, sample_adaptive=args.sample_adaptive,
+                        log_format=args.log_format, transport=args.transport)
+
+
+def run_agent(args):
+    from datalog_http_monitoring.agent import LogAgent, parse_address
+
+    collector = create_collector(args)
+    agent = LogAgent(parse_address(args.agent), collector.sources, name=args.agent_name,
+                     max_buffered=args.agent_buffer)
+    collector.add_consumer(agent.update)
+    logging.info(f"Streaming logs of {len(collector.sources)} files to {args.agent}")
+    try:
+        collector.run()
+    finally:
+        agent.close()
+        profiling.stop()
+
+
 def run(args):
     args = parse_args(args)
     if args.debug or args.debug_color:
@@ -78,29 +174,80 @@ def run(args):
         else:
             logging.basicConfig(stream=args.debug_file, level=logging.DEBUG)
 
+    if args.profile:
+        # must be done before starting any process so that they are profiled too
+        profiling.setup(args.profile, trace_memory=args.profile_memory, interval=args.profile_interval)
+
     if args.demo:
         logging.getLogger("faker").setLevel(logging.INFO)
         launch_log_generator(args)
 
+    assert not (args.agent and args.aggregator), "Agent and aggregator modes are exclusive"
+    if args.agent:
+        run_agent(args)
+        return
+
     from datalog_http_monitoring.cli_swag import CliSwag
-    from datalog_http_monitoring.log_collector import LogCollector
+    from datalog_http_monitoring.metrics import PipelineMetrics
     from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
 
     # initialize classes
-    collector = LogCollector(log_files=args.log_files)
+    metrics = PipelineMetrics()
+    anomaly_monitor = None
+    if args.anomaly:
+        from datalog_http_monitoring.anomaly import AnomalyMonitor
+        anomaly_monitor = AnomalyMonitor(interval=args.anomaly_interval)
     stats = HTTPLogsStats(
         period=args.period,
         alert_period=args.alert_period,
         alert_threshold=args.alert,
-        alert_output=args.alert_file)
+        alert_output=args.alert_file,
+        snapshot_file=args.snapshot,
+        snapshot_interval=args.snapshot_interval,
+        metrics=metrics,
+        anomaly_monitor=anomaly_monitor)
+    if args.snapshot:
+        stats.load_snapshot()
+    collector = create_collector(args, stats.offsets, metrics)
+    stats.sources = collector.sources
+    history = None
+    if args.history_socket and args.history:
+        from datalog_http_monitoring.history import RecentHistory
+        history = RecentHistory(retention=args.history * 60, sources=collector.sources)
+        history.serve(args.history_socket)
+    archive = None
+    if args.archive:
+        from datalog_http_monitoring.archive import LogArchive
+        archive = LogArchive(args.archive, sources=collector.sources)
 
-    with CliSwag(refresh_time=args.refresh, use_curses=not args.no_curses) as cli:
-        # connect collected log to stats and stats to cli
-        collector.add_consumer(stats.update)
-        stats.add_consumer(cli.update)
+    # logs of several files are merged in date order before statistics
+    ordered_logs = collector
+    if args.reorder_delay:
+        from datalog_http_monitoring.event_time import EventTimeMerger
+        ordered_logs = EventTimeMerger(max_delay=args.reorder_delay, known_sources=collector.sources,
+                                       metrics=metrics)
+        collector.add_consumer(ordered_logs.update)
 
-        # collect log
-        collector.run()
+    try:
+        with CliSwag(refresh_time=args.refresh, use_curses=not args.no_curses,
+                     show_metrics=args.show_metrics) as cli:
+            # connect collected log to stats and stats to cli
+            ordered_logs.add_consumer(stats.update)
+            if history:
+                ordered_logs.add_consumer(history.add)
+            if archive:
+                ordered_logs.add_consumer(archive.add)
+                stats.add_consumer(archive.add_rollup)
+            stats.add_consumer(cli.update)
+
+            # collect log
+            collector.run()
+    finally:
+        if args.snapshot:
+            stats.save_snapshot()
+        if archive:
+            archive.close()
+        profiling.stop()
 
 
 def main(args=None):
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Multi-host collection: an agent on each host streams its collected logs over TCP to an aggregator,
+which feeds them to a single statistics and display like a local collector.
+
+Logs are sent as batches of the fixed width records of `shared_ring`, compressed with zlib.
+Values which are not numbers (ip, user, method, path, referer, user agent) are replaced by ids,
+each value is sent once per connection in a `VALUE` frame before the first batch using it.
+Ids are reset with a `RESET` frame after `LogAgent.MAX_VALUES` values, so that both ends keep a bounded dictionary.
+The aggregator drops connections which break these bounds (`MAX_BATCH_SIZE`, `MAX_SESSION_VALUES`).
+Files are announced with `SOURCE` frames, the aggregator names them "{agent name}:{path}".
+
+Every frame is a kind byte and a payload length followed by the payload:
+
+  - HELLO: session id, agent name
+  - SOURCE: agent source id, path
+  - VALUE: value id, value type (string or ip), value
+  - BATCH: sequence number, records count, compressed records
+  - ACK: sequence number of the last processed batch, sent back by the aggregator
+  - RESET: forget values ids, next batches only use values sent after it
+
+The agent keeps batches until they are acknowledged and sends them again after a reconnection
+with the same sequence numbers, logs are buffered while the aggregator is unreachable, up to a maximum.
+The aggregator keeps the last sequence number fed of each agent session (an agent process),
+batches which have already been fed are only acknowledged again.
+"""
+
+import os
+import zlib
+import queue
+import select
+import socket
+import struct
+import logging
+import datetime
+import threading
+import socketserver
+
+from collections import deque
+from ipaddress import ip_address, IPv4Address, IPv6Address
+
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
+from datalog_http_monitoring.shared_ring import RECORD, NO_SOURCE, MAX_VALUES, _timezone
+from datalog_http_monitoring.log_collector import Log, EmptyLog, NewSource
+from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
+
+
+logger = logging.getLogger(__name__)
+
+HELLO, SOURCE, VALUE, BATCH, ACK, RESET = range(6)
+# values types
+STRING, IP = range(2)
+
+FRAME = struct.Struct("<BI")  # kind, payload length
+ID = struct.Struct("<I")
+VALUE_HEADER = struct.Struct("<IB")  # value id, value type
+BATCH_HEADER = struct.Struct("<QI")  # sequence number, records count
+SEQUENCE = struct.Struct("<Q")
+SESSION = struct.Struct("<Q")
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+MAX_BATCH_SIZE = 100000
+# values ids of a connection between two resets: the agent resets before a batch once it has `MAX_VALUES` values,
+# and a batch adds at most 6 values per record
+MAX_SESSION_VALUES = MAX_VALUES + 6 * MAX_BATCH_SIZE
+
+
+def frame(kind: int, payload: bytes) -> bytes:
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+def parse_address(address: str, default_host: str = "127.0.0.1") -> tuple:
+    """
+    :param address: "HOST:PORT", or "PORT" to use `default_host`
+    :type address: str
+    :return: (host, port)
+    """
+    host, _, port = address.rpartition(":")
+    assert port.isdigit(), f"Address {address!r} must be HOST:PORT"
+    return host.strip("[]") or default_host, int(port)
+
+
+class LogAgent(object):
+    # delays in seconds between two connection attempts, doubling up to the maximum
+    RECONNECT_MIN = 0.5
+    RECONNECT_MAX = 30
+    # values ids are reset beyond this number of values
+    MAX_VALUES = MAX_VALUES
+
+    def __init__(self, address: tuple, sources: list, name: str = None, batch_size: int = 1000,
+                 flush_interval: float = 0.5, max_buffered: int = 100000, max_in_flight: int = 16,
+                 timeout: float = 10, clock=None):
+        """
+        Send logs to a `LogAggregator`, to be used as a collector consumer.
+
+        `update` only buffers logs, they are sent from a background thread so that a slow or unreachable
+        aggregator never blocks the collection, by batches of `batch_size` or after `flush_interval` seconds.
+        At most `max_in_flight` batches wait for their acknowledgment,
+        beyond that and while the aggregator is unreachable, logs are buffered.
+
+        :param address: aggregator (host, port)
+        :type address: tuple
+        :param sources: log files paths, indexed by logs `source` (eg: the collector `sources`)
+        :type sources: list
+        :param name: agent name, prefixed to its files paths in the aggregator (default to host name)
+        :type name: str
+        :param batch_size: maximum number of logs per batch, up to `MAX_BATCH_SIZE`
+        :type batch_size: int
+        :param flush_interval: maximum delay in seconds before sending collected logs
+        :type flush_interval: float
+        :param max_buffered: maximum number of buffered logs, oldest ones are dropped beyond
+        :type max_buffered: int
+        :param max_in_flight: maximum number of batches waiting for their acknowledgment
+        :type max_in_flight: int
+        :param timeout: delay in seconds before giving up on a connection or an acknowledgment
+        :type timeout: float
+        :param clock: source of time, default to system time
+        :type clock: Clock
+        """
+        assert 0 < batch_size <= MAX_BATCH_SIZE, f"Batch size must be between 1 and {MAX_BATCH_SIZE}"
+        self.address = address
+        self.sources = sources
+        self.name = name or socket.gethostname()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.clock = clock or SYSTEM_CLOCK
+        self.session = SESSION.unpack(os.urandom(SESSION.size))[0]
+
+        self.pending = deque()  # logs to send, shared with the sender thread
+        self.condition = threading.Condition()  # guards `pending` and `closing`, notified when a batch is full
+        self.closing = False
+        self.thread = None
+        self.in_flight = deque()  # (sequence, logs) sent, waiting for their acknowledgment
+        self.sequence = 0
+        self.dropped = 0
+        self.next_connect = 0
+        self.reconnect_delay = self.RECONNECT_MIN
+
+        # connection state
+        self.socket = None
+        self.received = b""
+        self.ids = {}
+        self.sent_sources = 0
+
+    @property
+    def buffered(self) -> int:
+        return len(self.pending) + sum(len(logs) for _, logs in self.in_flight)
+
+    def update(self, log: Log):
+        """
+        Buffer a log for the sender thread, started with the first log
+        :param log: a `Log` instance
+        :type log: Log
+        """
+        if isinstance(log, EmptyLog):
+            return
+        with self.condition:
+            if len(self.pending) >= self.max_buffered:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(log)
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._send, name="LogAgent", daemon=True)
+            self.thread.start()
+
+    def _send(self):
+        profiling.start_thread()
+        try:
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closing or len(self.pending) >= self.batch_size,
+                                            self.flush_interval)
+                    if self.closing:
+                        return
+                if self.pending or self.in_flight:
+                    self.flush()
+                profiling.tick()
+        finally:
+            profiling.stop()
+
+    def flush(self) -> bool:
+        """
+        Send buffered logs, connecting first if needed.
+        Called from the sender thread, or once it is stopped.
+
+        :return: True if logs have been sent, they may not be acknowledged yet
+        """
+        now = self.clock.monotonic()
+        if self.socket is None and (now < self.next_connect or not self._connect(now)):
+            return False
+
+        try:
+            self._receive_acks(0)
+            while self.pending:
+                if len(self.in_flight) >= self.max_in_flight:
+                    self._receive_acks(self.timeout)
+                    if len(self.in_flight) >= self.max_in_flight:
+                        raise TimeoutError("No acknowledgment from the aggregator")
+                with self.condition:
+                    logs = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+                self.sequence += 1
+                self.in_flight.append((self.sequence, logs))
+                self.socket.sendall(self._encode(self.sequence, logs))
+        except OSError as err:
+            logger.warning(f"Connection to aggregator {self.address!r} lost ({err}), "
+                           f"{self.buffered} logs buffered")
+            self._disconnect(now)
+            return False
+        return True
+
+    def close(self):
+        """
+        Stop the sender thread, send buffered logs and wait for their acknowledgment, then disconnect
+        """
+        if self.thread is not None:
+            with self.condition:
+                self.closing = True
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        # last attempt, whatever the reconnection delay
+        self.next_connect = 0
+        if self.flush() and self.in_flight:
+            try:
+                while self.in_flight and self._receive_acks(self.timeout):
+                    pass
+            except OSError:
+                pass
+        if self.in_flight or self.pending:
+            logger.warning(f"{self.buffered} logs not sent to aggregator {self.address!r}")
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def _connect(self, now: float) -> bool:
+        try:
+            self.socket = socket.create_connection(self.address, timeout=self.timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.received = b""
+            self.ids = {}
+            self.sent_sources = 0
+            self.socket.sendall(frame(HELLO, SESSION.pack(self.session) + self.name.encode("utf-8")))
+            # batches which were not acknowledged are sent again with their sequence numbers,
+            # the new connection does not know their values ids
+            for sequence, logs in self.in_flight:
+                self.socket.sendall(self._encode(sequence, logs))
+        except OSError as err:
+            logger.debug(f"Unable to connect to aggregator {self.address!r} ({err})")
+            self._disconnect(now)
+            return False
+
+        logger.info(f"Connected to aggregator {self.address!r}")
+        self.reconnect_delay = self.RECONNECT_MIN
+        return True
+
+    def _disconnect(self, now: float):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        self.next_connect = now + self.reconnect_delay
+        self.reconnect_delay = min(self.reconnect_delay * 2, self.RECONNECT_MAX)
+
+    def _receive_acks(self, timeout: float) -> bool:
+        """
+        Read available acknowledgments, waiting up to `timeout` seconds for the first one.
+
+        :return: True if some data has been received
+        """
+        received = False
+        while select.select([self.socket], [], [], timeout)[0]:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionResetError("Connection closed by the aggregator")
+            received = True
+            timeout = 0
+            self.received += data
+            ack_size = FRAME.size + SEQUENCE.size
+            while len(self.received) >= ack_size:
+                sequence = SEQUENCE.unpack_from(self.received, FRAME.size)[0]
+                self.received = self.received[ack_size:]
+                while self.in_flight and self.in_flight[0][0] <= sequence:
+                    self.in_flight.popleft()
+        return received
+
+    def _encode(self, sequence: int, logs: list) -> bytes:
+        chunks = []
+        sources = self.sources
+        while self.sent_sources < len(sources):
+            chunks.append(frame(SOURCE, ID.pack(self.sent_sources) + sources[self.sent_sources].encode("utf-8")))
+            self.sent_sources += 1
+        # frames are processed in order, previous batches are decoded before the reset
+        if len(self.ids) >= self.MAX_VALUES:
+            chunks.append(frame(RESET, b""))
+            self.ids = {}
+
+        records = bytearray(RECORD.size * len(logs))
+        value_id = self._id
+        for index, log in enumerate(logs):
+            date = log.date
+            RECORD.pack_into(
+                records, index * RECORD.size,
+                date.timestamp(), int(date.utcoffset().total_seconds()) // 60, log.status_code, log.size, log.weight,
+                NO_SOURCE if log.source is None else log.source, log.offset or 0,
+                value_id(log.ip, chunks), value_id(log.user, chunks), value_id(log.method, chunks),
+                value_id(log.path, chunks), value_id(log.referer, chunks), value_id(log.user_agent, chunks))
+        # values definitions come before the batch
+        chunks.append(frame(BATCH, BATCH_HEADER.pack(sequence, len(logs)) + zlib.compress(records, 1)))
+        return b"".join(chunks)
+
+    def _id(self, value, chunks: list) -> int:
+        if value is None:
+            return 0
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.ids) + 1
+            value_type = IP if isinstance(value, (IPv4Address, IPv6Address)) else STRING
+            chunks.append(frame(VALUE, VALUE_HEADER.pack(value_id, value_type) + str(value).encode("utf-8")))
+        return value_id
+
+
+class _AggregatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        profiling.start_thread(f"Agent{self.client_address[1]}")
+        try:
+            self.server.aggregator.handle_agent(self.request, self.client_address)
+        finally:
+            profiling.stop()
+
+
+class LogAggregator(ConsumersFeeder):
+    def __init__(self, address: tuple, metrics=None, queue_size: int = 100, clock=None):
+        """
+        Receive logs from `LogAgent`s and feed them to consumers, it replaces the collector.
+        Agents are served in threads, logs are fed in the thread calling `run`.
+
+        :param address: (host, port) to listen on, port 0 for any free port (see `address` once created)
+        :type address: tuple
+        :param metrics: record pipeline health metrics
+        :type metrics: PipelineMetrics
+        :param queue_size: maximum number of received batches waiting to be consumed
+        :type queue_size: int
+        :param clock: source of time, default to system time
+        :type clock: Clock
+        """
+        super(LogAggregator, self).__init__(metrics)
+        self.clock = clock or SYSTEM_CLOCK
+        # logs `source` is the index of their file in this list, files are named "{agent name}:{path}"
+        self.sources = []
+        self.source_ids = {}
+        self.sessions = {}  # agent session => sequence number of the last fed batch
+        self.logs_queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.connections = set()
+
+        self.server = _AggregatorServer(address, _AgentHandler)
+        self.server.aggregator = self
+        self.address = self.server.server_address
+        self.serving = False
+        if metrics:
+            metrics.queue_size = self.logs_queue.qsize
+            metrics.queue_max_size = queue_size
+
+    def serve(self):
+        """
+        Accept agents connections in a background thread
+        """
+        self.serving = True
+        threading.Thread(target=self.server.serve_forever, name="AggregatorServer", daemon=True).start()
+        logger.info(f"Waiting for agents on {self.address!r}")
+
+    def handle_agent(self, connection: socket.socket, client_address: tuple):
+        with self.lock:
+            self.connections.add(connection)
+        name = client_address[0]
+        session = None
+        sources = {}  # agent source => source
+        values = {0: None}
+        reader = connection.makefile("rb")
+        try:
+            while True:
+                header = reader.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    break
+                kind, length = FRAME.unpack(header)
+                assert length <= MAX_FRAME_SIZE, f"Frame of {length} bytes is too large"
+                payload = reader.read(length)
+                if len(payload) < length:
+                    break
+
+                if kind == BATCH:
+                    sequence, count = BATCH_HEADER.unpack_from(payload)
+                    with self.lock:
+                        fed = self.sessions.get(session, 0)
+                    # a batch sent again after a reconnection may have been fed already
+                    if session is None or sequence > fed:
+                        assert count <= MAX_BATCH_SIZE, f"Batch of {count} records is too large"
+                        # never inflate more than the announced records
+                        size = count * RECORD.size
+                        decompressor = zlib.decompressobj()
+                        records = decompressor.decompress(payload[BATCH_HEADER.size:], size or 1)
+                        assert len(records) == size and decompressor.eof and not decompressor.unused_data, \
+                            f"Batch of {count} records does not match its data"
+                        self.logs_queue.put([self._decode(record, values, sources)
+                                             for record in RECORD.iter_unpack(records)])
+                        if session is not None:
+                            with self.lock:
+                                self.sessions[session] = max(sequence, self.sessions.get(session, 0))
+                    connection.sendall(frame(ACK, SEQUENCE.pack(sequence)))
+                elif kind == VALUE:
+                    value_id, value_type = VALUE_HEADER.unpack_from(payload)
+                    assert len(values) <= MAX_SESSION_VALUES, f"More than {MAX_SESSION_VALUES} values without reset"
+                    value = payload[VALUE_HEADER.size:].decode("utf-8")
+                    values[value_id] = ip_address(value) if value_type == IP else value
+                elif kind == RESET:
+                    values = {0: None}
+                elif kind == SOURCE:
+                    source = ID.unpack_from(payload)[0]
+                    sources[source] = self._source(f"{name}:{payload[ID.size:].decode('utf-8')}")
+                elif kind == HELLO:
+                    session = SESSION.unpack_from(payload)[0]
+                    name = payload[SESSION.size:].decode("utf-8")
+                    logger.info(f"Agent {name!r} connected from {client_address!r}")
+        except (OSError, ValueError, KeyError, AssertionError, struct.error, zlib.error) as err:
+            logger.warning(f"Connection of agent {name!r} failed ({err!r})")
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
+            reader.close()
+        logger.info(f"Agent {name!r} disconnected")
+
+    def _source(self, path: str) -> int:
+        # a reconnected agent gets the same sources ids
+        with self.lock:
+            source = self.source_ids.get(path)
+            if source is None:
+                source = self.source_ids[path] = len(self.source_ids)
+                self.logs_queue.put(NewSource(source, path))
+        return source
+
+    @staticmethod
+    def _decode(record: tuple, values: dict, sources: dict) -> Log:
+        date, utc_offset, status_code, size, weight, source, offset, *ids = record
+        ip, user, method, path, referer, user_agent = (values[value_id] for value_id in ids)
+        log = Log(ip, user, datetime.datetime.fromtimestamp(date, _timezone(utc_offset)), method, path,
+                  status_code, size)
+        if referer is not None:
+            log.referer = referer
+        if user_agent is not None:
+            log.user_agent = user_agent
+        if weight != 1:
+            log.weight = weight
+        log.source = None if source == NO_SOURCE else sources[source]
+        log.offset = offset
+        return log
+
+    def __iter__(self):
+        metrics = self.metrics
+        while True:
+            try:
+                logs = self.logs_queue.get(block=True, timeout=.5)
+            except queue.Empty:
+                yield EmptyLog(self.clock.utcnow())
+                continue
+            if isinstance(logs, NewSource):
+                assert logs.source == len(self.sources), "Sources ids must be sent in order"
+                self.sources.append(logs.path)
+                continue
+            if metrics:
+                metrics.logs += len(logs)
+                metrics.last_event_date = logs[-1].date
+            yield from logs
+
+    def run(self):
+        self.serve()
+        try:
+            for log in self:
+                self.feed_consumers(log)
+                profiling.tick()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.serving:
+            self.server.shutdown()
+            self.serving = False
+        self.server.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Anomaly alerting on what the global requests rate threshold misses: a single section spiking
+or the 5XX ratio jumping.
+
+Logs are counted by `interval`, when an interval ends each value is compared to its baseline,
+an exponentially weighted moving average and variance, then added to it.
+Each log costs a few counter increments, each interval costs one baseline update per tracked section.
+"""
+
+import math
+import logging
+
+from typing import List
+from collections import OrderedDict
+
+from datalog_http_monitoring.log_collector import Log
+from datalog_http_monitoring.http_logs_stats import Alert
+
+
+logger = logging.getLogger(__name__)
+
+
+class EwmaBaseline(object):
+    TRIGGER, RECOVER = 1, -1
+
+    def __init__(self, alpha: float = 0.1, deviations: float = 4, min_value: float = 0, warmup: int = 6):
+        """
+        Exponentially weighted moving average and variance of a series,
+        a value is anomalous above `deviations` standard deviations from the average (and above `min_value`).
+
+        :param alpha: weight of a new value, higher adapts faster
+        :type alpha: float
+        :param deviations: number of standard deviations above average to trigger, half of it to recover
+        :type deviations: float
+        :param min_value: values under this are never anomalous
+        :type min_value: float
+        :param warmup: number of values learned before detecting anomalies
+        :type warmup: int
+        """
+        self.alpha = alpha
+        self.deviations = deviations
+        self.min_value = min_value
+        self.warmup = warmup
+        self.mean = 0.0
+        self.variance = 0.0
+        self.samples = 0
+        self.in_alert = False
+
+    def threshold(self, deviations: float) -> float:
+        return max(self.mean + deviations * math.sqrt(self.variance), self.min_value)
+
+    def update(self, value: float) -> int:
+        """
+        Add a value to the series.
+
+        :param value: new value
+        :type value: float
+        :return: `TRIGGER` when value is anomalous, `RECOVER` when values are back to normal, else 0
+        """
+        change = 0
+        if self.samples >= self.warmup:
+            if not self.in_alert and value > self.threshold(self.deviations):
+                self.in_alert = True
+                change = self.TRIGGER
+            elif self.in_alert and value <= self.threshold(self.deviations / 2):
+                self.in_alert = False
+                change = self.RECOVER
+
+        # anomalous values are not learned, so that the baseline is not raised by the anomaly
+        if not self.in_alert:
+            if not self.samples:
+                self.mean = value
+            diff = value - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+            self.samples += 1
+        return change
+
+
+class _SectionState(object):
+    __slots__ = ("baseline", "hits", "alert")
+
+    def __init__(self, baseline: EwmaBaseline):
+        self.baseline = baseline
+        self.hits = 0
+        self.alert = None
+
+
+class AnomalyMonitor(object):
+    # intervals without any log processed at once at most, older ones are skipped
+    MAX_GAP = 60
+
+    def __init__(self, interval: int = 10, deviations: float = 4, alpha: float = 0.1, min_hits: int = 10,
+                 min_error_ratio: float = 0.05, max_sections: int = 100):
+        """
+        Trigger and recover `Alert`s when a section hits or the 5XX ratio get far above their usual values.
+
+        :param interval: duration in seconds of the counting intervals
+        :type interval: int
+        :param deviations: number of standard deviations above average to trigger (see `EwmaBaseline`)
+        :type deviations: float
+        :param alpha: weight of an interval in baselines (see `EwmaBaseline`)
+        :type alpha: float
+        :param min_hits: hits of an interval under this never trigger, error ratio is not checked with less hits
+        :type min_hits: int
+        :param min_error_ratio: 5XX ratio under this never trigger
+        :type min_error_ratio: float
+        :param max_sections: number of tracked sections, least recently requested ones not in alert are forgotten
+        :type max_sections: int
+        """
+        self.interval = interval
+        self.deviations = deviations
+        self.alpha = alpha
+        self.min_hits = min_hits
+        self.max_sections = max_sections
+
+        self.sections = OrderedDict()  # section => _SectionState, least recently requested first
+        self.errors_baseline = EwmaBaseline(alpha, deviations, min_error_ratio)
+        self.errors_alert = None
+        self.current = None  # current interval index
+        self.intervals = 0  # number of checked intervals
+        self.hits = 0
+        self.errors = 0
+        self.alerts = []
+
+    @property
+    def in_alert(self) -> bool:
+        return self.errors_alert is not None or any(state.alert for state in self.sections.values())
+
+    def check(self, log: Log) -> List[Alert]:
+        """
+        Count a log, and when it starts a new interval check the previous ones.
+
+        :param log: a `Log` instance
+        :type log: Log
+        :return: alerts which have just been triggered or recovered
+        """
+        changed = []
+        current = int(log.date.timestamp()) // self.interval
+        if self.current is None:
+            self.current = current
+        elif current > self.current:
+            # late logs are counted in the current interval
+            for _ in range(min(current - self.current, self.MAX_GAP)):
+                changed.extend(self._check_interval(log))
+            self.current = current
+
+        section = log.path.split('/', 2)[1] if log.path else '/'
+        state = self.sections.get(section)
+        if state is None:
+            # a new section is not tracked while every tracked section is in alert
+            if len(self.sections) < self.max_sections or self._forget_section():
+                # new (or forgotten) sections learn their baseline before alerting, like at startup
+                state = self.sections[section] = _SectionState(
+                    EwmaBaseline(self.alpha, self.deviations, self.min_hits))
+        else:
+            self.sections.move_to_end(section)
+
+        weight = log.weight
+        self.hits += weight
+        if log.status_code >= 500:
+            self.errors += weight
+        if state is not None:
+            state.hits += weight
+            if state.alert:
+                state.alert.update(log)
+        return changed
+
+    def _check_interval(self, log: Log) -> List[Alert]:
+        self.intervals += 1
+        changed = []
+        for section, state in self.sections.items():
+            change = state.baseline.update(state.hits)
+            if change == EwmaBaseline.TRIGGER:
+                state.alert = Alert(log.date, log.date, state.hits, kind=f"Traffic spike on /{section}")
+                self.alerts.append(state.alert)
+                changed.append(state.alert)
+            elif change == EwmaBaseline.RECOVER:
+                state.alert.recover(log)
+                changed.append(state.alert)
+                state.alert = None
+            state.hits = 0
+
+        if self.hits >= self.min_hits:
+            ratio = self.errors / self.hits
+            change = self.errors_baseline.update(ratio)
+            if change == EwmaBaseline.TRIGGER:
+                self.errors_alert = Alert(log.date, log.date, self.errors, kind=f"High 5XX ratio ({ratio:.0%})")
+                self.alerts.append(self.errors_alert)
+                changed.append(self.errors_alert)
+            elif change == EwmaBaseline.RECOVER:
+                self.errors_alert.recover(log)
+                changed.append(self.errors_alert)
+                self.errors_alert = None
+        self.hits = self.errors = 0
+        return changed
+
+    def _forget_section(self) -> bool:
+        """
+        Forget the least recently requested section which is not in alert, its recovery would be lost otherwise.
+
+        :return: False when every tracked section is in alert
+        """
+        for section, state in self.sections.items():
+            if not state.alert:
+                del self.sections[section]
+                return True
+        return False
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Archive of parsed logs, so that later analyses and replays do not parse text logs again.
+
+`LogArchive` is a collector consumer writing logs to segment files in a directory,
+a segment holds at most `segment_size` logs or `segment_seconds` of logs, sorted by date.
+Full segments are sorted and written by a background thread, so that the collection goes on meanwhile.
+Segments are columnar: each field is a fixed width array (see `COLUMNS`),
+strings (ip, user, method, path, referer, user agent) are ids in a dictionary of the segment.
+`index.jsonl` lists written segments with their first and last dates, the time index used to skip segments.
+
+`ArchiveSegment` memory-maps a segment, columns are read in place and dates are searched by bisection.
+Periodic statistics (`HTTPStatsSections`) of each period are also archived, pickled in the ".rollups" file
+of the segment being written when the period ended.
+
+    $ python -m datalog_http_monitoring.archive /var/lib/datalog --start 2018-05-09T16:00:00+00:00 --top path
+"""
+
+import os
+import json
+import mmap
+import queue
+import array
+import bisect
+import struct
+import logging
+import argparse
+import datetime
+import threading
+import functools
+
+from collections import Counter
+from ipaddress import ip_address
+
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.log_collector import Log, EmptyLog
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DLGA"
+VERSION = 1
+PRELUDE = struct.Struct("<4sHI")  # magic, version, header length
+
+# column name, array typecode (all fixed width)
+COLUMNS = (
+    ("date", "d"), ("utc_offset", "h"), ("status_code", "H"), ("size", "Q"), ("weight", "d"), ("source", "I"),
+    ("offset", "Q"), ("ip", "I"), ("user", "I"), ("method", "I"), ("path", "I"), ("referer", "I"),
+    ("user_agent", "I"),
+)
+STRING_COLUMNS = ("ip", "user", "method", "path", "referer", "user_agent")
+NO_SOURCE = 0xFFFFFFFF
+
+INDEX_FILE = "index.jsonl"
+SEGMENT_FILE = "segment-{:06d}.dlg"
+ROLLUPS_FILE = "segment-{:06d}.rollups"
+
+
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+@functools.lru_cache(maxsize=64)
+def _timezone(minutes: int) -> datetime.timezone:
+    return datetime.timezone(datetime.timedelta(minutes=minutes))
+
+
+class LogArchive(object):
+    def __init__(self, directory: str, sources=None, segment_size: int = 1000000, segment_seconds: float = 600):
+        """
+        Write logs and periodic statistics to `directory`, call `close` to write the last segment
+        and wait for the writer thread.
+
+        :param directory: archive directory, created if needed, segments are added to existing ones
+        :type directory: str
+        :param sources: log files paths, indexed by logs `source`
+        :type sources: list
+        :param segment_size: maximum number of logs of a segment
+        :type segment_size: int
+        :param segment_seconds: maximum duration in seconds (of log time) of a segment
+        :type segment_seconds: float
+        """
+        assert segment_size > 0, "Segment size must be positive"
+        os.makedirs(directory, exist_ok=True)
+        assert os.access(directory, os.W_OK), f"Archive directory {directory!r} must be writable"
+        self.directory = directory
+        self.sources = sources if sources is not None else []
+        self.segment_size = segment_size
+        self.segment_seconds = segment_seconds
+
+        self.segment = max((int(name[8:14]) for name in os.listdir(directory)
+                            if name.startswith("segment-") and name[8:14].isdigit()), default=0) + 1
+        self.period_start = None
+        # (segment number, columns, strings, sources) waiting to be written, at most 2 buffered segments
+        self.pending = queue.Queue(maxsize=2)
+        self.writer = None
+        self._new_segment()
+
+    def _new_segment(self):
+        self.columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+        self.strings = {}  # string => id, from 1 (0 is None)
+        self.start = None
+
+    def add(self, log: Log):
+        """
+        Archive a log, to be used as a collector consumer
+        :param log: a `Log` instance
+        :type log: Log
+        """
+        # empty logs dates are wall clock time, segments only span log time
+        if isinstance(log, EmptyLog):
+            return
+        timestamp = log.date.timestamp()
+        count = len(self.columns["date"])
+        if count and (count >= self.segment_size or timestamp - self.start >= self.segment_seconds):
+            self.write_segment()
+
+        if self.start is None:
+            self.start = timestamp
+        columns, string_id = self.columns, self._string_id
+        columns["date"].append(timestamp)
+        columns["utc_offset"].append(int(log.date.utcoffset().total_seconds()) // 60)
+        columns["status_code"].append(log.status_code)
+        columns["size"].append(log.size)
+        columns["weight"].append(log.weight)
+        columns["source"].append(NO_SOURCE if log.source is None else log.source)
+        columns["offset"].append(log.offset or 0)
+        columns["ip"].append(string_id(log.ip))
+        columns["user"].append(string_id(log.user))
+        columns["method"].append(string_id(log.method))
+        columns["path"].append(string_id(log.path))
+        columns["referer"].append(string_id(log.referer))
+        columns["user_agent"].append(string_id(log.user_agent))
+
+    def _string_id(self, value) -> int:
+        if value is None:
+            return 0
+        value = str(value)
+        string_id = self.strings.get(value)
+        if string_id is None:
+            string_id = self.strings[value] = len(self.strings) + 1
+        return string_id
+
+    def add_rollup(self, http_stats):
+        """
+        Archive periodic statistics of each ended period, to be used as a `HTTPLogsStats` consumer
+        :param http_stats: a `HTTPLogsStats` instance
+        :type http_stats: HTTPLogsStats
+        """
+        import pickle
+
+        period_start = http_stats.period_start
+        if period_start == self.period_start:
+            return
+        if self.period_start is not None:
+            # statistics have just been rotated, `period_stats` are the ones of the period which has ended
+            with open(os.path.join(self.directory, ROLLUPS_FILE.format(self.segment)), "ab") as fd:
+                pickle.dump((self.period_start, period_start, http_stats.period_stats), fd,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        self.period_start = period_start
+
+    def write_segment(self):
+        """
+        Hand logs added since the previous segment to the writer thread (started with the first segment),
+        they are written to a new segment file
+        """
+        if not len(self.columns["date"]):
+            return
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write, name="LogArchive", daemon=True)
+            self.writer.start()
+        self.pending.put((self.segment, self.columns, self.strings, list(self.sources)))
+        self.segment += 1
+        self._new_segment()
+
+    def _write(self):
+        profiling.start_thread()
+        try:
+            while True:
+                segment = self.pending.get()
+                if segment is None:
+                    return
+                try:
+                    self._write_segment(*segment)
+                except Exception as err:
+                    logger.error(f"Unable to write archive segment {segment[0]}", exc_info=err)
+                profiling.tick()
+        finally:
+            profiling.stop()
+
+    def _write_segment(self, segment: int, columns: dict, strings: dict, sources: list):
+        dates = columns["date"]
+        count = len(dates)
+
+        # logs are sorted by date so that readers can search dates by bisection
+        order = sorted(range(count), key=dates.__getitem__)
+        if any(index != position for position, index in enumerate(order)):
+            columns = {name: array.array(column.typecode, (column[index] for index in order))
+                       for name, column in columns.items()}
+            dates = columns["date"]
+
+        strings = [value.encode("utf-8") for value in strings]  # in id order
+        string_offsets = array.array("Q", [0])
+        for value in strings:
+            string_offsets.append(string_offsets[-1] + len(value))
+        blobs = [(name, column.tobytes()) for name, column in columns.items()]
+        blobs.append(("strings", string_offsets.tobytes()))
+        blobs.append(("blob", b"".join(strings)))
+
+        position, layout = 0, {}
+        for name, data in blobs:
+            layout[name] = [position, len(data)]
+            position = _align(position + len(data))
+        header = json.dumps({
+            "count": count,
+            "start": dates[0],
+            "end": dates[-1],
+            "sources": sources,
+            "columns": {name: [typecode] + layout[name] for name, typecode in COLUMNS},
+            "strings": layout["strings"],
+            "blob": layout["blob"],
+        }).encode("utf-8")
+
+        path = os.path.join(self.directory, SEGMENT_FILE.format(segment))
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fd:
+            fd.write(PRELUDE.pack(MAGIC, VERSION, len(header)) + header)
+            data_start = _align(fd.tell())
+            for name, data in blobs:
+                fd.seek(data_start + layout[name][0])
+                fd.write(data)
+        os.replace(tmp_path, path)
+        with open(os.path.join(self.directory, INDEX_FILE), "a", encoding="utf-8") as fd:
+            fd.write(json.dumps({"segment": os.path.basename(path), "start": dates[0], "end": dates[-1],
+                                 "count": count}) + "\n")
+        logger.info(f"Archived {count} logs to {path!r}")
+
+    def close(self):
+        self.write_segment()
+        if self.writer is not None:
+            self.pending.put(None)
+            self.writer.join()
+            self.writer = None
+
+    @staticmethod
+    def segments(directory: str, start: float = None, end: float = None) -> list:
+        """
+        Find segments with logs between `start` and `end` in the time index.
+
+        :param directory: archive directory
+        :type directory: str
+        :param start: timestamp of the oldest logs
+        :type start: float
+        :param end: timestamp of the newest logs (excluded)
+        :type end: float
+        :return: list of index entries (dict with segment path, start, end, count)
+        """
+        entries = []
+        try:
+            with open(os.path.join(directory, INDEX_FILE), encoding="utf-8") as fd:
+                for line in fd:
+                    entry = json.loads(line)
+                    if (start is None or entry["end"] >= start) and (end is None or entry["start"] < end):
+                        entry["segment"] = os.path.join(directory, entry["segment"])
+                        entries.append(entry)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @staticmethod
+    def read(directory: str, start: float = None, end: float = None):
+        """
+        Replay archived logs, see `segments` for parameters.
+
+        :return: generator of `Log`, sorted by date within each segment
+        """
+        for entry in LogArchive.segments(directory, start, end):
+            with ArchiveSegment(entry["segment"]) as segment:
+                yield from segment.logs(start, end)
+
+    @staticmethod
+    def rollups(directory: str, start: float = None, end: float = None):
+        """
+        Read archived periodic statistics, see `segments` for parameters.
+
+        :return: generator of (period start, period end, `HTTPStatsSections`)
+        """
+        import glob
+        import pickle
+
+        for path in sorted(glob.glob(os.path.join(glob.escape(directory), ROLLUPS_FILE.replace("{:06d}", "*")))):
+            with open(path, "rb") as fd:
+                while True:
+                    try:
+                        period_start, period_end, period_stats = pickle.load(fd)
+                    except EOFError:
+                        break
+                    if (start is None or period_end.timestamp() > start) \
+                            and (end is None or period_start.timestamp() < end):
+                        yield period_start, period_end, period_stats
+
+
+class ArchiveSegment(object):
+    def __init__(self, path: str):
+        """
+        Memory-mapped segment written by `LogArchive`, columns are read in place.
+
+        :param path: segment file path
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as fd:
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mmap)
+        self.views = []  # views of `buffer`, released on close
+        self._strings = None
+        self._ips = {}
+        try:
+            self._load()
+        except BaseException:
+            self.close()
+            raise
+
+    def _load(self):
+        magic, version, header_length = PRELUDE.unpack_from(self.buffer)
+        assert magic == MAGIC, f"{self.path!r} is not an archive segment"
+        assert version == VERSION, f"{self.path!r} archive version {version} is not supported"
+        header = json.loads(bytes(self.buffer[PRELUDE.size:PRELUDE.size + header_length]))
+        data_start = _align(PRELUDE.size + header_length)
+
+        def view(position: int, length: int, typecode: str = "B") -> memoryview:
+            data = self.buffer[data_start + position:data_start + position + length]
+            self.views.append(data)
+            data = data.cast(typecode)
+            self.views.append(data)
+            return data
+
+        self.count = header["count"]
+        self.start = header["start"]
+        self.end = header["end"]
+        self.sources = header["sources"]
+        self.columns = {name: view(position, length, typecode)
+                        for name, (typecode, position, length) in header["columns"].items()}
+        self.string_offsets = view(*header["strings"], "Q")
+        self.blob = view(*header["blob"])
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        # views must be released before the memory map is closed
+        for view in reversed(self.views):
+            view.release()
+        self.buffer.release()
+        self.mmap.close()
+
+    @property
+    def strings(self) -> list:
+        """
+        Strings of the dictionary, indexed by id, decoded once
+        """
+        if self._strings is None:
+            blob, offsets = bytes(self.blob), self.string_offsets
+            self._strings = [None] + [blob[offsets[index]:offsets[index + 1]].decode("utf-8")
+                                      for index in range(len(offsets) - 1)]
+        return self._strings
+
+    def ip(self, string_id: int):
+        ip = self._ips.get(string_id)
+        if ip is None and string_id:
+            ip = self._ips[string_id] = ip_address(self.strings[string_id])
+        return ip
+
+    def value(self, column: str, string_id: int):
+        """
+        Decoded value of a string column id
+        """
+        return self.ip(string_id) if column == "ip" else self.strings[string_id]
+
+    def bounds(self, start: float = None, end: float = None) -> tuple:
+        """
+        :return: (first index, last index excluded) of logs between `start` and `end` (excluded)
+        """
+        dates = self.columns["date"]
+        return (bisect.bisect_left(dates, start) if start is not None else 0,
+                bisect.bisect_left(dates, end) if end is not None else self.count)
+
+    def logs(self, start: float = None, end: float = None):
+        """
+        :return: generator of `Log` between `start` and `end` (excluded)
+        """
+        dates, utc_offsets, status_codes, sizes, weights, sources, offsets, ips, users, methods, paths, referers, \
+            user_agents = (self.columns[name] for name, _ in COLUMNS)
+        strings, ip = self.strings, self.ip
+        first, last = self.bounds(start, end)
+        for index in range(first, last):
+            log = Log(ip(ips[index]), strings[users[index]],
+                      datetime.datetime.fromtimestamp(dates[index], _timezone(utc_offsets[index])),
+                      strings[methods[index]], strings[paths[index]], status_codes[index], sizes[index])
+            referer, user_agent = referers[index], user_agents[index]
+            if referer:
+                log.referer = strings[referer]
+            if user_agent:
+                log.user_agent = strings[user_agent]
+            if weights[index] != 1:
+                log.weight = weights[index]
+            log.source = None if sources[index] == NO_SOURCE else sources[index]
+            log.offset = offsets[index]
+            yield log
+
+    def top(self, column: str, start: float = None, end: float = None) -> Counter:
+        """
+        Count estimated hits (sampled logs count for their weight) by value of `column`,
+        from the columns without creating logs.
+
+        :return: Counter of values
+        """
+        first, last = self.bounds(start, end)
+        hits = Counter()
+        for key, weight in zip(self.columns[column][first:last], self.columns["weight"][first:last]):
+            hits[key] += weight
+        if column in STRING_COLUMNS:
+            return Counter({self.value(column, key): count for key, count in hits.items()})
+        if column == "source":
+            return Counter({self.sources[key] if key != NO_SOURCE else None: count for key, count in hits.items()})
+        return hits
+
+
+def parse_args(args=None):
+    def parse_date(date_str):
+        return datetime.datetime.fromisoformat(date_str).timestamp()
+
+    parser = argparse.ArgumentParser(description="Query archived logs (see --archive)")
+    parser.add_argument("directory", help="archive directory")
+    parser.add_argument("--start", help="only logs from this ISO date", type=parse_date, default=None)
+    parser.add_argument("--end", help="only logs before this ISO date", type=parse_date, default=None)
+    parser.add_argument("--top", help="count hits by this column instead of listing segments",
+                        choices=[name for name, _ in COLUMNS if name not in ("date", "weight", "offset")],
+                        default=None)
+    parser.add_argument("--limit", help="number of most common values (default: %(default)s)", default=10, type=int)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    entries = LogArchive.segments(args.directory, args.start, args.end)
+    if not args.top:
+        for entry in entries:
+            start, end = (datetime.datetime.fromtimestamp(entry[key], datetime.timezone.utc).isoformat()
+                          for key in ("start", "end"))
+            print(f"{entry['segment']}  {start}  {end}  {entry['count']} logs")
+        return
+
+    hits = Counter()
+    for entry in entries:
+        with ArchiveSegment(entry["segment"]) as segment:
+            hits.update(segment.top(args.top, args.start, args.end))
+    for value, count in hits.most_common(args.limit):
+        print(f"{round(count):>12}  {value}")
+
+
+if __name__ == '__main__':
+    main()
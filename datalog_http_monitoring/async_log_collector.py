@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Single process collector running on an asyncio event loop.
+
+Logs are read and fed to consumers in the main process, so there is no process hop nor pickling per log.
+Regular files are always readable without blocking, so no aiofiles is needed:
+each file is watched by its own task, polled like in the watcher process (see `WatchedFile`),
+and files are checked, detected and read in a single thread to keep the loop (and the display) responsive.
+"""
+
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
+from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
+from datalog_http_monitoring.log_collector import EmptyLog, LineSampler, LogCollector, WatchedFile, \
+    expand_log_files, is_pattern
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLogCollector(ConsumersFeeder):
+    def __init__(self, log_files, offsets=None, metrics=None, sample_rate=1.0, log_format="auto",
+                 tick_interval=0.5, clock=None):
+        """
+        Watch log files on an asyncio event loop and feed parsed `Log` instances to consumers.
+
+        :param log_files: paths of the files to watch, glob patterns or directories (see `expand_log_files`)
+        :type log_files: set
+        :param offsets: position to resume reading from for each file (eg: loaded from a snapshot)
+        :type offsets: dict
+        :param metrics: record pipeline health metrics
+        :type metrics: PipelineMetrics
+        :param sample_rate: share of lines to parse, statistics are scaled back (see `LineSampler`)
+        :type sample_rate: float
+        :param log_format: "auto" to detect each file format, a format name or a format string (see `parsers`)
+        :type log_format: str
+        :param tick_interval: delay in seconds before feeding an `EmptyLog` when no log is collected
+        :type tick_interval: float
+        :param clock: source of time of files checks and `EmptyLog`s, default to system time
+        :type clock: Clock
+        """
+        super(AsyncLogCollector, self).__init__(metrics)
+
+        self.patterns = sorted(log_file for log_file in log_files if is_pattern(log_file))
+        self.sources = sorted(expand_log_files(log_files))
+        self.offsets = dict(offsets or {})
+        LogCollector.check_options(self.sources, self.patterns, sample_rate, log_format)
+
+        self.parser = None
+        if log_format != "auto":
+            from datalog_http_monitoring.parsers import get_parser
+            self.parser = get_parser(log_format)
+        self.counters = metrics.watcher_counters if metrics else None
+        self.sampler = LineSampler(sample_rate, counters=self.counters) if sample_rate < 1 else None
+        self.tick_interval = tick_interval
+        self.clock = clock or SYSTEM_CLOCK
+
+        # every file access runs in this single thread, so that counters and sampler are never used concurrently,
+        # it reads and parses logs, so it is profiled apart from the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LogReader",
+                                           initializer=profiling.start_thread)
+        self.has_fed = False
+
+    def feed_logs(self, logs):
+        metrics = self.metrics
+        for log in logs:
+            if metrics:
+                metrics.logs += 1
+                metrics.last_event_date = log.date
+            self.feed_consumers(log)
+        if logs:
+            self.has_fed = True
+
+    def read_file(self, watched_file: WatchedFile, logs: list) -> int:
+        """
+        Read new logs of a file if it has changed, run in `executor` as stat, format detection and reads may block.
+
+        :param watched_file: the file to read
+        :type watched_file: WatchedFile
+        :param logs: list to append read logs to
+        :type logs: list
+        :return: number of lines read
+        """
+        from datalog_http_monitoring.parsers import detect_file_parser
+
+        profiling.tick()
+        if not watched_file.has_changed():
+            return 0
+        if not watched_file.parser:
+            _, watched_file.parser = detect_file_parser(watched_file.path)
+        # not enough lines to detect format yet otherwise
+        if not watched_file.parser:
+            return 0
+        return watched_file.read(_LogsBuffer(logs), self.counters, self.sampler, LogCollector.READ_BATCH)
+
+    async def watch_file(self, watched_file: WatchedFile):
+        loop = asyncio.get_running_loop()
+        while True:
+            logs = []
+            lines = 0
+            try:
+                lines = await loop.run_in_executor(self.executor, self.read_file, watched_file, logs)
+            except FileNotFoundError:
+                # removed (eg: rotated), it will be read from start if it comes back
+                pass
+            except IOError as err:
+                logger.error(f"Unable to read {watched_file.path!r}", exc_info=err)
+            except Exception as err:
+                logger.error(f"Unable to collect {watched_file.path!r} logs", exc_info=err)
+
+            self.feed_logs(logs)
+            now = self.clock.monotonic()
+            watched_file.schedule(now, lines, LogCollector.READ_BATCH)
+            # when there is a backlog, only let other tasks run before reading again
+            await asyncio.sleep(max(0.0, watched_file.next_check - now))
+
+    async def discover_files(self):
+        loop = asyncio.get_running_loop()
+        known_files = set(self.sources)
+        while True:
+            await asyncio.sleep(LogCollector.DISCOVER_INTERVAL)
+            log_files = await loop.run_in_executor(self.executor, expand_log_files, self.patterns)
+            for log_file in sorted(log_files - known_files):
+                logger.info(f"Discovered log file {log_file!r}")
+                known_files.add(log_file)
+                self.watch(log_file)
+
+    async def tick(self):
+        # keep statistics and display going when no log is collected
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            if not self.has_fed:
+                self.feed_consumers(EmptyLog(self.clock.utcnow()))
+            self.has_fed = False
+            profiling.tick()
+
+    def watch(self, log_file: str):
+        source = self.sources.index(log_file) if log_file in self.sources else len(self.sources)
+        if source == len(self.sources):
+            self.sources.append(log_file)
+        watched_file = WatchedFile(log_file, source, self.offsets.get(log_file, 0), self.parser)
+        return asyncio.ensure_future(self.watch_file(watched_file))
+
+    async def collect(self):
+        logger.info(f"AsyncLogCollector started on {self.sources!r}")
+        tasks = [self.watch(log_file) for log_file in list(self.sources)]
+        tasks.append(asyncio.ensure_future(self.tick()))
+        if self.patterns:
+            tasks.append(asyncio.ensure_future(self.discover_files()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run(self):
+        try:
+            asyncio.run(self.collect())
+        finally:
+            # run after pending reads, in the reader thread
+            self.executor.submit(profiling.stop)
+            self.executor.shutdown(wait=False)
+
+
+class _LogsBuffer(object):
+    # collects logs read by `WatchedFile.read` so that they are fed from the event loop
+    def __init__(self, logs: list):
+        self.put = logs.append
@@ -5,9 +5,8 @@ import os
 import time
 import curses
 
-import humanize
-
 from datalog_http_monitoring import cli_swag_tpl as tpl
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
 from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
 
 
@@ -30,8 +29,56 @@ def n_fmt(n: float, precision: int = 1):
     return f"{n:.{precision}f}T"
 
 
+def size_fmt(n: float):
+    """
+    Format a size in bytes to a short string with decimal units (eg: "3.6 MB").
+
+    :param n: a size in bytes
+    :type n: float
+    :return: formatted size
+    """
+    if abs(n) < 1000:
+        return "1 Byte" if n == 1 else f"{n:.0f} Bytes"
+    for unit in ['kB', 'MB', 'GB', 'TB']:
+        n /= 1000.0
+        if abs(n) < 1000:
+            break
+    return f"{n:.1f} {unit}"
+
+
+def delta_fmt(seconds: float):
+    """
+    Format a duration to a short string, only keeping its biggest unit (eg: "2 minutes").
+
+    :param seconds: a duration in seconds
+    :type seconds: float
+    :return: formatted duration
+    """
+    seconds = int(abs(seconds))
+    for unit, unit_seconds in [("day", 86400), ("hour", 3600), ("minute", 60), ("second", 1)]:
+        count = seconds // unit_seconds
+        if count > 1:
+            return f"{count} {unit}s"
+        if count == 1:
+            return f"an {unit}" if unit == "hour" else f"a {unit}"
+    return "a moment"
+
+
+def path_fmt(path: str, width: int):
+    """
+    Shorten a path to `width` characters by cutting its beginning.
+
+    :param path: a file path
+    :type path: str
+    :param width: maximum length
+    :type width: int
+    :return: shortened path
+    """
+    return path if len(path) <= width else f"…{path[1 - width:]}"
+
+
 class CliSwag(object):
-    def __init__(self, refresh_time: int = 1, use_curses: bool = True):
+    def __init__(self, refresh_time: int = 1, use_curses: bool = True, show_metrics: bool = False, clock=None):
         """
         A CLI with nice color and border and stuff...
 
@@ -46,9 +93,15 @@ class CliSwag(object):
         :type refresh_time: int
         :param use_curses: option to enable/disable curses display
         :type use_curses: bool
+        :param show_metrics: display a debug panel with pipeline health metrics
+        :type show_metrics: bool
+        :param clock: source of time of refreshes, default to system time
+        :type clock: Clock
         """
         self.refresh_time = refresh_time
         self.next_refresh = None
+        self.clock = clock or SYSTEM_CLOCK
+        self.show_metrics = show_metrics
 
         # curse main window
         self.stdscr = None
@@ -113,14 +166,18 @@ class CliSwag(object):
         :type http_stats: HTTPLogsStats
         """
 
-        now = time.time()
+        now = self.clock.time()
         # do not refresh before next_refresh
         if self.next_refresh and self.next_refresh > now:
             return
 
         self.next_refresh = now + self.refresh_time
+        start = time.perf_counter()
         content = self.format_stats(http_stats)
         self._display(content)
+        if http_stats.metrics:
+            http_stats.metrics.frames += 1
+            http_stats.metrics.frame_time = time.perf_counter() - start
 
     def _display(self, content: str):
         if self.stdscr:
@@ -185,12 +242,23 @@ class CliSwag(object):
             if len_details < tpl.TPL_DETAILS_LEN:
                 tpl_part.extend([detail_empty] * (tpl.TPL_DETAILS_LEN - len_details))
             tpl_part.extend(tpl_lines[tpl.TPL_LINE_DETAILS_STATS_START:tpl.TPL_LINE_DETAILS_STATS_END])
+            tpl_part.append(tpl.TOP_PATHS_LINE)
         else:
             tpl_part = [detail_empty, tpl_lines[tpl.TPL_LINE_DETAILS_NONE]] \
-                     + ([detail_empty] * (tpl.TPL_DETAILS_LEN + 2))
+                     + ([detail_empty] * (tpl.TPL_DETAILS_LEN + 3))
 
         tpl_arr.extend(tpl_part)
-        tpl_arr.extend(tpl_lines[tpl.TPL_LINE_DETAILS_STATS_END:tpl.TPL_LINE_DETAILS_END])
+        tpl_arr.extend(tpl_lines[tpl.TPL_LINE_DETAILS_STATS_END:tpl.TPL_LINE_ALERT_HEADER])
+
+        # then the files details, when several files are monitored
+        if data["files"]:
+            tpl_arr.extend(tpl.FILES_TEMPLATE.strip('\n').splitlines())
+            for file_detail in data["files"]:
+                # escape braces as lines are formatted again with the whole template
+                file_fmt = tpl.FILES_LINE.format(**file_detail).replace("{", "{{").replace("}", "}}")
+                tpl_arr.append(file_fmt)
+            tpl_arr.append(detail_empty)
+        tpl_arr.extend(tpl_lines[tpl.TPL_LINE_ALERT_HEADER:tpl.TPL_LINE_DETAILS_END])
 
         # finally the alerting details
         alert_empty = tpl_lines[tpl.TPL_LINE_ALERT_EMPTY]
@@ -212,8 +280,14 @@ class CliSwag(object):
 
         tpl_arr.extend(tpl_part[:1 + tpl.TPL_ALERT_LEN])
 
-        # and the footer
-        tpl_arr.extend(tpl_lines[tpl.TPL_LINE_ALERT_END:])
+        # and the footer, with the optional metrics panel before the last line
+        tpl_arr.extend(tpl_lines[tpl.TPL_LINE_ALERT_END:-1])
+        # always show metrics when logs are lost so that the user knows statistics are incomplete
+        metrics = http_stats.metrics
+        if metrics and (self.show_metrics or metrics.watcher_counters[metrics.LOGS_DROPPED]):
+            tpl_arr.extend(tpl.METRICS_TEMPLATE.strip('\n').splitlines())
+            data.update(self._get_metrics_data(http_stats))
+        tpl_arr.append(tpl_lines[-1])
 
         # join everything in a string to apply formatting and remove spacers
         template = os.linesep.join(p.strip('\n') for p in tpl_arr)
@@ -230,63 +304,86 @@ class CliSwag(object):
         :return: dict
         """
         data = {
-            "config_period": f"{humanize.naturaldelta(http_stats.period)} \1",
+            "config_period": f"{delta_fmt(http_stats.period)} \1",
 
-            "total_requests": n_fmt(http_stats.all_stats.hits, 2),
-            "total_valid": n_fmt(http_stats.all_stats.valid_requests, 2),
-            "total_fail": n_fmt(http_stats.all_stats.hits - http_stats.all_stats.valid_requests, 2),
+            "total_requests": n_fmt(round(http_stats.all_stats.hits), 2),
+            "total_valid": n_fmt(round(http_stats.all_stats.valid_requests), 2),
+            "total_fail": n_fmt(round(http_stats.all_stats.hits - http_stats.all_stats.valid_requests), 2),
             "total_visitors": n_fmt(len(http_stats.all_stats.visitors), 2),
             "total_files": n_fmt(len(http_stats.all_stats.paths), 2),
-            "total_bandwidth": humanize.naturalsize(http_stats.all_stats.bandwidth),
+            "total_bandwidth": size_fmt(http_stats.all_stats.bandwidth),
 
-            "total_200": n_fmt(http_stats.all_stats.status_codes.get("200", 0)),
-            "total_404": n_fmt(http_stats.all_stats.status_codes.get("404", 0)),
-            "total_2XX": n_fmt(http_stats.all_stats.status_codes.get("2XX", 0)),
-            "total_3XX": n_fmt(http_stats.all_stats.status_codes.get("3XX", 0)),
-            "total_4XX": n_fmt(http_stats.all_stats.status_codes.get("4XX", 0)),
-            "total_5XX": n_fmt(http_stats.all_stats.status_codes.get("5XX", 0)),
+            "total_200": n_fmt(round(http_stats.all_stats.status_codes.get("200", 0))),
+            "total_404": n_fmt(round(http_stats.all_stats.status_codes.get("404", 0))),
+            "total_2XX": n_fmt(round(http_stats.all_stats.status_codes.get("2XX", 0))),
+            "total_3XX": n_fmt(round(http_stats.all_stats.status_codes.get("3XX", 0))),
+            "total_4XX": n_fmt(round(http_stats.all_stats.status_codes.get("4XX", 0))),
+            "total_5XX": n_fmt(round(http_stats.all_stats.status_codes.get("5XX", 0))),
 
             "alert_status": "\2OK" if not http_stats.in_alert else "\10KO",
-            "log_file": "/tmp/access.log",  # todo: display real file name ...
+            "log_file": (path_fmt(http_stats.sources[0], 22) if len(http_stats.sources) == 1
+                         else f"{len(http_stats.sources)} files"),
 
             "period_details": CliSwag._get_period_details(http_stats),
+            "files": CliSwag._get_data_files(http_stats),
 
             "period_date": f"{http_stats.period_start:%d/%m/%y}",
             "period_time": f"{http_stats.period_start:%H:%M:%S}",
-            "period_requests": http_stats.period_stats.hits,
+            "period_requests": round(http_stats.period_stats.hits),
             "period_visitors": len(http_stats.period_stats.visitors),
             "period_files": len(http_stats.period_stats.paths),
             "period_reqs_rate": n_fmt(http_stats.period_stats.hits / http_stats.period),
-            "period_bandwidth": humanize.naturalsize(http_stats.period_stats.bandwidth),
-
-            "period_200": http_stats.period_stats.status_codes.get("200", 0),
-            "period_404": http_stats.period_stats.status_codes.get("404", 0),
-            "period_2XX": http_stats.period_stats.status_codes.get("2XX", 0),
-            "period_3XX": http_stats.period_stats.status_codes.get("3XX", 0),
-            "period_4XX": http_stats.period_stats.status_codes.get("4XX", 0),
-            "period_5XX": http_stats.period_stats.status_codes.get("5XX", 0),
+            "period_reqs_error": "±{}".format(n_fmt(round(http_stats.period_stats.hits_error / http_stats.period, 1)))
+                                 if http_stats.period_stats.hits_variance else "",
+            "period_bandwidth": size_fmt(http_stats.period_stats.bandwidth),
+            "period_top_paths": CliSwag._get_top_paths(http_stats),
+
+            "period_200": round(http_stats.period_stats.status_codes.get("200", 0)),
+            "period_404": round(http_stats.period_stats.status_codes.get("404", 0)),
+            "period_2XX": round(http_stats.period_stats.status_codes.get("2XX", 0)),
+            "period_3XX": round(http_stats.period_stats.status_codes.get("3XX", 0)),
+            "period_4XX": round(http_stats.period_stats.status_codes.get("4XX", 0)),
+            "period_5XX": round(http_stats.period_stats.status_codes.get("5XX", 0)),
 
             "alert_log": "/tmp/alerts.log",
             "alert_threshold": "(>{} reqs/s on average over {}) \1".format(
                 http_stats.alert_rate_threshold,
-                humanize.naturaldelta(http_stats.alert_period)
+                delta_fmt(http_stats.alert_period)
             ),
             "alerts": CliSwag._get_data_alerts(http_stats)
         }
 
         return data
 
+    @staticmethod
+    def _get_metrics_data(http_stats: HTTPLogsStats) -> dict:
+        metrics = http_stats.metrics.snapshot()
+        stages = "  ".join(f"{name.split('.')[0]} {load:.1%}" for name, load in metrics["stages_load"].items())
+        return {
+            "metrics_read_rate": n_fmt(round(metrics["lines_read_rate"])),
+            "metrics_parsed_rate": n_fmt(round(metrics["lines_parsed_rate"])),
+            "metrics_failed": n_fmt(metrics["lines_failed"]),
+            "metrics_dropped": n_fmt(metrics["logs_dropped"]),
+            "metrics_queue": "{}/{}".format(
+                n_fmt(metrics["queue_size"]) if metrics["queue_size"] is not None else "n/a",
+                n_fmt(metrics["queue_max_size"]) if metrics["queue_max_size"] else "∞"),
+            "metrics_sampling": f"{metrics['sample_rate']:.1%}",
+            "metrics_lag": f"{metrics['lag']:.1f}s" if metrics["lag"] is not None else "n/a",
+            "metrics_frame": f"{metrics['frame_time'] * 1000:.1f}ms",
+            "metrics_stages": stages[:72],
+        }
+
     @staticmethod
     def _get_period_details(http_stats: HTTPLogsStats):
         period_details = []
+        period_stats = http_stats.period_stats
 
-        top_sections = http_stats.period_stats.sections.most_common()
-        top_5_sections = top_sections[0:5]
-
-        for section_name, _ in top_5_sections:
-            section = http_stats.period_stats.sections_stats[section_name]
+        # top sections and totals are maintained by `HTTPStatsSections`, so a frame does not depend on sections count
+        top_sections = period_stats.top_sections.most_common()
+        for section_name, _ in top_sections:
+            section = period_stats.sections_stats[section_name]
             section_stats = {
-                "detail_hits": section.hits,
+                "detail_hits": round(section.hits),
                 "detail_hits_r": 0,
                 "detail_visitors": len(section.visitors),
                 "detail_visitors_r": 0,
@@ -296,45 +393,100 @@ class CliSwag(object):
             }
             period_details.append(section_stats)
 
-        others_sections = top_sections[5:]
+        others_sections = len(period_stats.sections) - len(top_sections)
         if others_sections:
-            other_sections_cumulated = {
-                "detail_hits": 0,
+            period_details.append({
+                "detail_hits": round(period_stats.hits) - sum(detail["detail_hits"] for detail in period_details),
                 "detail_hits_r": 0,
-                "detail_visitors": 0,
+                "detail_visitors": period_stats.sections_visitors - sum(
+                    detail["detail_visitors"] for detail in period_details),
                 "detail_visitors_r": 0,
-                "detail_bandwidth": 0,
-                "detail_subsections": 0,
-                "detail_path": f"({len(others_sections)} others)"
-            }
-
-            for section_name, _ in others_sections:
-                section = http_stats.period_stats.sections_stats[section_name]
-                other_sections_cumulated["detail_hits"] += section.hits
-                other_sections_cumulated["detail_visitors"] += len(section.visitors)
-                other_sections_cumulated["detail_bandwidth"] += section.bandwidth
-                other_sections_cumulated["detail_subsections"] += len(section.paths)
-
-            period_details.append(other_sections_cumulated)
+                "detail_bandwidth": period_stats.bandwidth - sum(
+                    detail["detail_bandwidth"] for detail in period_details),
+                "detail_subsections": period_stats.sections_paths - sum(
+                    detail["detail_subsections"] for detail in period_details),
+                "detail_path": f"({others_sections} others)"
+            })
 
         for detail in period_details:
             detail["detail_hits_r"] = detail["detail_hits"] / http_stats.period_stats.hits
             detail["detail_visitors_r"] = detail["detail_visitors"] / len(http_stats.period_stats.visitors)
-            detail["detail_bandwidth"] = humanize.naturalsize(detail["detail_bandwidth"])
+            detail["detail_bandwidth"] = size_fmt(detail["detail_bandwidth"])
 
         return period_details
 
+    @staticmethod
+    def _get_top_paths(http_stats: HTTPLogsStats) -> str:
+        # as many top paths as fit on the line, the first one is shortened if needed
+        top_paths = []
+        width = 0
+        for path, hits in http_stats.period_stats.top_paths.most_common():
+            top_path = f"{path} ({n_fmt(round(hits))})"
+            if width + len(top_path) > tpl.TPL_TOP_PATHS_LEN:
+                if not top_paths:
+                    top_paths.append(path_fmt(top_path, tpl.TPL_TOP_PATHS_LEN))
+                break
+            top_paths.append(top_path)
+            width += len(top_path) + 2
+        return "  ".join(top_paths)
+
+    @staticmethod
+    def _get_data_files(http_stats: HTTPLogsStats):
+        if len(http_stats.files) < 2:
+            return []
+
+        top_files = http_stats.files_by_hits[:tpl.TPL_FILES_LEN]
+        files_details = []
+        for file_stats in top_files:
+            files_details.append({
+                "file_hits": n_fmt(round(file_stats.period_stats.hits)),
+                "file_rate": n_fmt(file_stats.period_stats.hits / http_stats.period),
+                "file_bandwidth": size_fmt(file_stats.period_stats.bandwidth),
+                "file_5xx": n_fmt(round(file_stats.period_stats.status_codes.get("5XX", 0))),
+                "file_alert": "\2OK" if not file_stats.alert_monitor.in_alert else "\10KO",
+                "file_name": path_fmt(file_stats.source or "?", 25),
+            })
+
+        others = len(http_stats.files_by_hits) - len(top_files)
+        if others:
+            # period totals of all files minus the shown ones, so that thousands of files cost nothing more
+            period_stats = http_stats.period_stats
+            hits = period_stats.hits
+            bandwidth = period_stats.bandwidth
+            errors = period_stats.status_codes.get("5XX", 0)
+            in_alert = http_stats.files_in_alert
+            for file_stats in top_files:
+                hits -= file_stats.period_stats.hits
+                bandwidth -= file_stats.period_stats.bandwidth
+                errors -= file_stats.period_stats.status_codes.get("5XX", 0)
+                in_alert -= file_stats.alert_monitor.in_alert
+            # float sums may differ from the merged total by a rounding error
+            hits, bandwidth, errors = max(hits, 0), max(bandwidth, 0), max(errors, 0)
+            files_details.append({
+                "file_hits": n_fmt(round(hits)),
+                "file_rate": n_fmt(hits / http_stats.period),
+                "file_bandwidth": size_fmt(bandwidth),
+                "file_5xx": n_fmt(round(errors)),
+                "file_alert": "\2OK" if in_alert <= 0 else "\10KO",
+                "file_name": f"({others} others)",
+            })
+
+        return files_details
+
     @staticmethod
     def _get_data_alerts(http_stats: HTTPLogsStats):
         alerts = []
         for i in range(0, min(4, len(http_stats.alerts))):
             alert = http_stats.alerts[-(i + 1)]
+            kind = alert.kind[:tpl.TPL_ALERT_KIND_LEN]
             alert_detail = {
-                "alert_hits": n_fmt(len(alert.logs)),
-                "alert_start": f"{alert.start:%d/%m/%y, %H:%M:%S}",
+                "alert_kind": kind,
+                "alert_hits": n_fmt(round(alert.hits)),
+                "alert_triggered": f"{alert.triggered:%d/%m/%y, %H:%M:%S}",
                 "alert_end": f"{alert.end:%d/%m/%y, %H:%M:%S}",
                 "alert_finished": alert.finished,
-                "alert_duration": humanize.naturaldelta(alert.duration)
+                "alert_duration": delta_fmt(alert.duration).ljust(34 - len(kind)),
+                "alert_fill": " " * (26 - len(kind)),
             }
 
             alerts.append(alert_detail)
@@ -37,6 +37,7 @@ TPL_LINE_DETAIL = 13
 TPL_LINE_DETAIL_HEADER = 12
 TPL_LINE_DETAILS_STATS_START = 14
 TPL_LINE_DETAILS_STATS_END = 17
+TPL_LINE_ALERT_HEADER = 18
 TPL_LINE_DETAILS_NONE = 11
 TPL_LINE_DETAILS_END = 20
 TPL_DETAILS_LEN = 6
@@ -47,6 +48,8 @@ TPL_LINE_ALERT_KO = 22
 TPL_LINE_ALERT_NONE = 20
 TPL_LINE_ALERT_END = 23
 TPL_ALERT_LEN = 6
+# alert kind is truncated to this length, the end of alert lines is padded according to its length
+TPL_ALERT_KIND_LEN = 24
 
 
 # the template
@@ -65,15 +68,45 @@ TEMPLATE = """\1
   │''       Hits           Visitors      Bandwidth    Files    Section                ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
   │\4  {detail_hits:>5d} ({detail_hits_r:6.1%})\3   {detail_visitors:>5d} ({detail_visitors_r:6.1%})\5 {detail_bandwidth:>11s}\0     {detail_subsections:>4d}\6     {detail_path:<21s} '\1│
   │ - \0Total \1----------------------------------------------------------------------- ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
-  │\4  {period_requests:>5d}\1 Hits\3       {period_visitors:>5d}\1 Visitors\5    {period_bandwidth:>8s}\0    {period_files:>5d}\2  {period_reqs_rate:>5s}\1 Reqs/s             ''''''''''│
+  │\4  {period_requests:>5d}\1 Hits\3       {period_visitors:>5d}\1 Visitors\5    \
+{period_bandwidth:>8s}\0    {period_files:>5d}\2  {period_reqs_rate:>5s}\1 Reqs/s {period_reqs_error:<12s}''''''''''│
   │ Status Codes - 200:\0 {period_200:3d}\1  404:\0 {period_404:3d}\1  5XX:\0 {period_5XX:3d}\1  2XX:\0 {period_2XX:3d}\1  3XX:\0 {period_3XX:3d}\1  4XX:\0 {period_4XX:3d}\1       ''''''│
   │                                                                                 ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
   ├─ \0Alerts History {alert_threshold:─<64s}''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''─┤
   │                                                                                 ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
   │ No alerts history...                                                            ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
-  │ \2High traffic recovered\1 at \7{alert_end}\1 - duration:\7 {alert_duration: <22s} '''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''\1│
-  │ \10High traffic alert\1 - hits =\4 {alert_hits:>5s}\1, triggered at \7{alert_start}              ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''\1│
+  │ \2{alert_kind} recovered\1 at \7{alert_end}\1 - duration:\7 {alert_duration} \1│
+  │ \10{alert_kind} alert\1 - hits =\4 {alert_hits:>5s}\1, triggered at \7{alert_triggered}{alert_fill}\1│
   │ (Complete history at\3 {alert_log}\1)                                           ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
   │                                                                                 ''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''│
   └─────────────────────────────────────────────────────────────────────────────────''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''''┘
 """
+
+
+# most requested paths of the period, inserted after the period statistics
+TPL_TOP_PATHS_LEN = 68
+TOP_PATHS_LINE = "  │ Top paths -\6 {period_top_paths:<68s}\1│"
+
+
+# optional debug panel showing pipeline health, inserted before the last line of `TEMPLATE`
+METRICS_TEMPLATE = """
+  ├─ \0Pipeline Health ───────────────────────────────────────────────────────────────┤
+  │                                                                                 │
+  │ \1Read:\2 {metrics_read_rate:>7s}\1/s  Parsed:\2 {metrics_parsed_rate:>7s}\1/s  \
+Failed:\10 {metrics_failed:>6s}\1  Lost:\10 {metrics_dropped:>6s}\1                │
+  │ \1Queue:\3 {metrics_queue:>13s}\1  Sampling:\3 {metrics_sampling:>6s}\1  \
+Lag:\7 {metrics_lag:>8s}\1  Frame:\7 {metrics_frame:>8s}\1          │
+  │ \1Stages:\6 {metrics_stages:<72s}\1│
+  │                                                                                 │
+"""
+
+
+# files panel, inserted after the period statistics when several files are monitored
+TPL_FILES_LEN = 5
+FILES_TEMPLATE = """
+  ├─ \0Files ─────────────────────────────────────────────────────────────────────────┤
+  │                                                                                 │
+  │\1      Hits      Reqs/s     Bandwidth      5XX   Alert   File                     │
+"""
+FILES_LINE = "  │\4{file_hits:>10s}\2{file_rate:>12s}\5{file_bandwidth:>14s}\10{file_5xx:>9s}   {file_alert}\3      " \
+             "{file_name:<25s}\1│"
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Source of time of the collector, statistics, display and logs generator.
+
+They read time from a `Clock` given at creation (default to `SYSTEM_CLOCK`) instead of the `time` module,
+so that a `SimulatedClock` can replace it: sleeping then only moves the simulated time forward,
+and hours of traffic are replayed in seconds (see `simulation`).
+"""
+
+import time
+import datetime
+
+
+class Clock(object):
+    """
+    System time
+    """
+    def time(self) -> float:
+        """
+        :return: seconds since epoch
+        """
+        return time.time()
+
+    def monotonic(self) -> float:
+        """
+        :return: seconds of a clock which never goes back, to measure delays
+        """
+        return time.monotonic()
+
+    def utcnow(self) -> datetime.datetime:
+        """
+        :return: current date, timezone aware
+        """
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+
+class SimulatedClock(Clock):
+    def __init__(self, start: datetime.datetime = None):
+        """
+        Time which only moves forward when asked to, with `sleep` or `advance`.
+
+        :param start: initial date, naive dates are UTC (default to current date)
+        :type start: datetime.datetime
+        """
+        if start is None:
+            start = datetime.datetime.now(datetime.timezone.utc)
+        elif not start.tzinfo:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        self.now = start.timestamp()
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def utcnow(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.now, datetime.timezone.utc)
+
+    def sleep(self, seconds: float):
+        self.advance(seconds)
+
+    def advance(self, seconds: float):
+        """
+        Move time forward, never backward
+        """
+        if seconds > 0:
+            self.now += seconds
+
+
+SYSTEM_CLOCK = Clock()
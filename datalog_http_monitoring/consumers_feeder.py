@@ -10,17 +10,31 @@ logger = logging.getLogger(__name__)
 class ConsumersFeeder(object):
     """
     Simple class that forward an element to a group of consumers
+
+    When `metrics` (a `PipelineMetrics` instance) is set, time spent in each consumer is recorded
+    with the metrics clock, excluding time spent in consumers of the feeders it calls.
     """
 
-    def __init__(self):
+    def __init__(self, metrics=None):
         self.consumers = []
         self.add_consumer = self.consumers.append
         self.remove_consumer = self.consumers.remove
+        self.metrics = metrics
 
     def feed_consumers(self, *args, **kwargs):
+        metrics = self.metrics
+        clock = metrics and metrics.clock
         for consumer in self.consumers:
             try:
-                consumer(*args, **kwargs)
+                if metrics is None:
+                    consumer(*args, **kwargs)
+                else:
+                    metrics.start_stage()
+                    start = clock.monotonic()
+                    try:
+                        consumer(*args, **kwargs)
+                    finally:
+                        metrics.add_stage_time(consumer, clock.monotonic() - start)
             except Exception as err:
                 logger.error(f"{consumer!r} has failed to consume data", exc_info=err)
                 raise
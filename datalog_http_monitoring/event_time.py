@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Event time ordering of logs collected from several files.
+
+Files are read in turns, so logs of different files arrive interleaved and out of order,
+while alerting windows and period rotations expect increasing dates.
+`EventTimeMerger` buffers logs in a heap and only releases them once every active file has reached their date.
+"""
+
+import heapq
+import logging
+
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
+from datalog_http_monitoring.log_collector import Log, EmptyLog, WatchedFile
+from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventTimeMerger(ConsumersFeeder):
+    # delay in seconds between two computations of the watermark
+    WATERMARK_INTERVAL = 0.1
+    # delay in seconds before ignoring a known source which has never sent a log,
+    # the collector reads every file once at startup, silent files must not hold logs back for long
+    FIRST_LOG_TIMEOUT = 1.0
+
+    def __init__(self, max_delay: float = 10, idle_timeout: float = None, max_buffered: int = 100000,
+                 known_sources: list = None, metrics=None, clock=None):
+        """
+        Merge logs of all sources by date and feed them to consumers.
+
+        The watermark is the oldest of the newest dates of each active source, buffered logs up to it are released.
+        It does not move while a known source has not sent any log yet, for at most `FIRST_LOG_TIMEOUT` seconds.
+        A source without logs for `idle_timeout` seconds does not hold the watermark back,
+        nor do sources more than `max_delay` seconds behind the newest date.
+        Logs older than the watermark (late) are released right away.
+
+        :param max_delay: maximum delay in seconds (of log time) a log is held back
+        :type max_delay: float
+        :param idle_timeout: delay in seconds (of wall time) before ignoring a source without logs, default to
+            twice the slowest polling of unchanged files by the collector, so that a file written now and then
+            does not go idle between two reads
+        :type idle_timeout: float
+        :param max_buffered: oldest logs are released beyond this number of buffered logs
+        :type max_buffered: int
+        :param known_sources: files paths known by the collector, indexed by logs `source` (eg: the collector
+            `sources`, which grows with discovered files), logs are only passed through when there is one
+        :type known_sources: list
+        :param metrics: record pipeline health metrics
+        :type metrics: PipelineMetrics
+        :param clock: source of time of idle sources, default to system time
+        :type clock: Clock
+        """
+        super(EventTimeMerger, self).__init__(metrics)
+        self.max_delay = max_delay
+        self.idle_timeout = 2 * WatchedFile.MAX_INTERVAL if idle_timeout is None else idle_timeout
+        self.max_buffered = max_buffered
+        self.known_sources = known_sources
+        self.clock = clock or SYSTEM_CLOCK
+
+        self.buffer = []  # heap of (date, sequence, log)
+        self.sequence = 0
+        self.sources = {}  # source => [newest date (None until a log is received), last log monotonic time]
+        self.newest = None
+        self.watermark = None
+        self.next_watermark = 0
+        self.late = 0
+
+    def update(self, log: Log):
+        """
+        Buffer a log and release the ones under the watermark, to be used as a collector consumer
+        :param log: a `Log` instance
+        :type log: Log
+        """
+        now = self.clock.monotonic()
+        if isinstance(log, EmptyLog):
+            self._release(now, force_watermark=True)
+            self.feed_consumers(log)
+            return
+
+        date = log.date
+        source = self.sources.get(log.source)
+        if source is None:
+            self.sources[log.source] = [date, now]
+        else:
+            if source[0] is None or date > source[0]:
+                source[0] = date
+            source[1] = now
+        if self.newest is None or date > self.newest:
+            self.newest = date
+
+        if self.known_sources is not None and len(self.known_sources) == 1 and not self.buffer:
+            # a single source is already ordered
+            self.watermark = self.newest
+            self.feed_consumers(log)
+            return
+        if self.watermark is not None and date < self.watermark:
+            self.late += 1
+            self.feed_consumers(log)
+            return
+
+        heapq.heappush(self.buffer, (date, self.sequence, log))
+        self.sequence += 1
+        self._release(now)
+
+    def _release(self, now: float, force_watermark: bool = False):
+        if force_watermark or now >= self.next_watermark:
+            self._update_watermark(now)
+
+        buffer = self.buffer
+        watermark = self.watermark
+        while buffer and (watermark is not None and buffer[0][0] <= watermark or len(buffer) > self.max_buffered):
+            self.feed_consumers(heapq.heappop(buffer)[2])
+
+    def _update_watermark(self, now: float):
+        self.next_watermark = now + self.WATERMARK_INTERVAL
+        if self.known_sources is not None:
+            # known sources which have not sent logs yet, they are idle after `FIRST_LOG_TIMEOUT`
+            for source in range(len(self.known_sources)):
+                self.sources.setdefault(source, [None, now])
+        if self.newest is None:
+            return
+        active = []
+        for date, seen in self.sources.values():
+            if date is None:
+                if now - seen < self.FIRST_LOG_TIMEOUT:
+                    return
+            elif now - seen < self.idle_timeout:
+                active.append(date)
+        lowest = self.newest.timestamp() - self.max_delay
+        watermark = min((date for date in active if date.timestamp() >= lowest), default=self.newest)
+        if self.watermark is None or watermark > self.watermark:
+            self.watermark = watermark
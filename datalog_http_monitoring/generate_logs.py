@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import os
-import time
+import sys
 import random
 import logging
 import argparse
 import datetime
 
 import faker
-import isodate
+
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
 
 
 logger = logging.getLogger(__name__)
@@ -18,10 +20,21 @@ logger = logging.getLogger(__name__)
 class LogGenerator(object):
     """
     This class generate parametrized random log
+
+    Use `seed` to generate the same logs on each run, and a `SimulatedClock` as `clock`
+    to generate live logs without waiting.
+    Spam periods (above `threshold_requests` per second) generated by `generate` are kept in `spam_periods`
+    as [start, end] dates, end is None while in progress.
     """
     def __init__(self, users, files, ips,
-                 threshold_requests, threshold_period, threshold_duration_max, threshold_trigger_each):
+                 threshold_requests, threshold_period, threshold_duration_max, threshold_trigger_each, seed=None,
+                 clock=None):
+        self.clock = clock or SYSTEM_CLOCK
+        self.spam_periods = []
+        self.random = random.Random(seed)
         self.fake = fake = faker.Faker()
+        if seed is not None:
+            fake.seed_instance(seed)
         self.methods = ((70, "GET"), (15, "POST"), (4, "PUT"), (11, "HEAD"))
         self.status_code = ((75, 200), (10, 404), (5, 403), (5, 500))
         self.users = list(fake.first_name() for _ in range(users))
@@ -33,9 +46,9 @@ class LogGenerator(object):
         self.threshold_trigger_each = threshold_trigger_each
 
     @staticmethod
-    def random_bias(items):
+    def random_bias(items, rng=random):
         keys = (i[0] for i in items)
-        number = random.uniform(0, sum(keys))
+        number = rng.uniform(0, sum(keys))
         current = 0
         for bias, item in items:
             current += bias
@@ -49,20 +62,22 @@ class LogGenerator(object):
         127.0.0.1 - frank [09/May/2018:16:00:42 +0000] "POST /api/user HTTP/1.0" 200 34
         127.0.0.1 - mary [09/May/2018:16:00:42 +0000] "POST /api/user HTTP/1.0" 503 12
         """
-        ip = random.choice(self.ips)
-        have_user = bool(random.getrandbits(1))
-        user = random.choice(self.users) if have_user else '-'
-        method = self.random_bias(self.methods)
-        path = random.choice(self.files)
-        status_code = self.random_bias(self.status_code)
-        date = (when or datetime.datetime.utcnow())\
+        rng = self.random
+        ip = rng.choice(self.ips)
+        have_user = bool(rng.getrandbits(1))
+        user = rng.choice(self.users) if have_user else '-'
+        method = self.random_bias(self.methods, rng)
+        path = rng.choice(self.files)
+        status_code = self.random_bias(self.status_code, rng)
+        date = (when or self.clock.utcnow())\
             .replace(tzinfo=datetime.timezone.utc)\
             .strftime("%d/%b/%Y:%H:%M:%S %z")
-        si = random.randint(10, 300)
+        si = rng.randint(10, 300)
         return f'{ip} - {user} [{date}] "{method} /{path} HTTP/1.0" {status_code} {si}'
 
     def generate(self, generation_seconds=0, live=True):
-        past_date = datetime.datetime.utcnow() - datetime.timedelta(seconds=generation_seconds)
+        clock = self.clock
+        past_date = clock.utcnow() - datetime.timedelta(seconds=generation_seconds)
         threshold_start_stop_in = self.threshold_trigger_each
         current_threshold = False
         while True:
@@ -72,15 +87,15 @@ class LogGenerator(object):
 
             if current_threshold:
                 # continue spamming until threshold period ends
-                wait = random.uniform(frequency_min / 5, frequency_min - (frequency_min / 5))
+                wait = self.random.uniform(frequency_min / 5, frequency_min - (frequency_min / 5))
             else:
-                wait = random.uniform(frequency_min + (frequency_min / 3), frequency_min * 3)
+                wait = self.random.uniform(frequency_min + (frequency_min / 3), frequency_min * 3)
 
-            now = datetime.datetime.utcnow()
+            now = clock.utcnow()
             if past_date and now > past_date:
                 past_date += datetime.timedelta(seconds=wait)
             elif live:
-                time.sleep(wait)
+                clock.sleep(wait)
                 past_date = None
             else:
                 break
@@ -89,17 +104,76 @@ class LogGenerator(object):
             if not threshold_start_stop_in > 0:
                 if not current_threshold:
                     current_threshold = True
-                    threshold_start_stop_in = random.uniform(
+                    threshold_start_stop_in = self.random.uniform(
                         self.threshold_period, self.threshold_duration_max + self.threshold_period)
                     logger.info(f"Entering spam mode for {threshold_start_stop_in} seconds")
+                    self.spam_periods.append([past_date or clock.utcnow(), None])
                 else:
                     current_threshold = False
                     threshold_start_stop_in = self.threshold_trigger_each
                     logger.info(f"Exiting spam mode for {threshold_start_stop_in} seconds")
+                    self.spam_periods[-1][1] = past_date or clock.utcnow()
+
+    def _bulk_tables(self, pool_size):
+        """
+        Pre-render pools of line beginnings (ip and user) and line endings (request, status and size)
+        drawn with the same distribution as `generate_log`, a line is then a prefix, a date and a suffix.
+        """
+        rng = self.random
+        prefixes = [f"{rng.choice(self.ips)} - {rng.choice(self.users) if rng.getrandbits(1) else '-'} ["
+                    for _ in range(pool_size)]
+        methods = rng.choices([m for _, m in self.methods], [w for w, _ in self.methods], k=pool_size)
+        status_codes = rng.choices([c for _, c in self.status_code], [w for w, _ in self.status_code], k=pool_size)
+        suffixes = [f'] "{method} /{rng.choice(self.files)} HTTP/1.0" {status_code} {rng.randint(10, 300)}\n'
+                    for method, status_code in zip(methods, status_codes)]
+        return prefixes, suffixes
+
+    def generate_blocks(self, rate, generation_seconds=0, live=True, pool_size=4096):
+        """
+        Bulk generation mode, much faster than `generate`: yield blocks of text of one second of logs each,
+        at a constant `rate` of lines per second.
+
+        Past seconds are generated as fast as possible, then in `live` mode the blocks are paced
+        to hold `rate` until interrupted.
+
+        :param rate: lines per second
+        :type rate: float
+        :param generation_seconds: how many seconds of past logs to generate
+        :type generation_seconds: int
+        :param live: continue generating logs at `rate` once past logs are generated
+        :type live: bool
+        :param pool_size: number of pre-rendered line parts to pick from
+        :type pool_size: int
+        """
+        prefixes, suffixes = self._bulk_tables(pool_size)
+        choices = self.random.choices
+        one_second = datetime.timedelta(seconds=1)
+        clock = self.clock
+        end = clock.utcnow().replace(microsecond=0)
+        when = end - datetime.timedelta(seconds=generation_seconds)
+        carry = 0.0
+        while True:
+            if when >= end:
+                if not live:
+                    break
+                wait = (when - clock.utcnow()).total_seconds()
+                if wait > 0:
+                    clock.sleep(wait)
+
+            # keep fractional rates exact over time
+            carry += rate
+            count = int(carry)
+            carry -= count
+
+            date = when.strftime("%d/%b/%Y:%H:%M:%S +0000")
+            yield "".join([prefix + date + suffix
+                           for prefix, suffix in zip(choices(prefixes, k=count), choices(suffixes, k=count))])
+            when += one_second
 
 
 def get_arg(args=None):
     def parse_iso_duration(duration_str):
+        import isodate
         return isodate.parse_duration(duration_str).total_seconds()
 
     parser = argparse.ArgumentParser()
@@ -113,18 +187,25 @@ def get_arg(args=None):
     parser.add_argument("--threshold-period", type=parse_iso_duration, default="PT2M")
     parser.add_argument("--threshold-duration-max", type=int, default=300)
     parser.add_argument("--threshold-trigger-each", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--rate", type=float, default=None, help="bulk mode: constant lines per second")
+    parser.add_argument("--output", type=str, default=None, help="bulk mode: write logs to this file")
 
     return parser.parse_args(args)
 
 
 def write_logs(log_generator, log_file, period, live):
+    profiling.start()
     try:
         with open(log_file, "w+", encoding="utf-8") as fd:
             for log in log_generator.generate(period, live):
                 fd.write(f"{log}\n")
                 fd.flush()
+                profiling.tick()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        profiling.stop()
 
     try:
         os.remove(log_file)
@@ -132,10 +213,34 @@ def write_logs(log_generator, log_file, period, live):
         pass
 
 
+def write_logs_bulk(log_generator, fd, rate, period, live):
+    profiling.start()
+    try:
+        for block in log_generator.generate_blocks(rate, period, live):
+            fd.write(block)
+            if live:
+                fd.flush()
+            profiling.tick()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        profiling.stop()
+
+
 def main():
     args = get_arg().__dict__
     period, live = args.pop("period"), args.pop("live")
+    rate, output = args.pop("rate"), args.pop("output")
+    args.pop("monitoring_interval")
     generator = LogGenerator(**args)
+    if rate:
+        if output:
+            with open(output, "w", encoding="utf-8", buffering=1 << 20) as fd:
+                write_logs_bulk(generator, fd, rate, period, live)
+        else:
+            write_logs_bulk(generator, sys.stdout, rate, period, live)
+        return
+
     for log in generator.generate(period, live):
         print(log)
 
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Recent logs kept in memory to drill down into the last minutes, eg: paths under /api which returned 5XX.
+
+`RecentHistory` is a collector consumer storing logs as compact records in one second buckets:
+each field is a fixed width array column (see `COLUMNS`), strings and ips are ids in a dictionary of the bucket,
+freed with it. Each bucket indexes its records by section and by status class,
+so filtering on them only reads matching records.
+Queries can be sent to a local unix socket (see `serve`) with this module command line:
+
+    $ python -m datalog_http_monitoring.history /tmp/datalog.sock --section api --status 5XX --group-by path
+"""
+
+import sys
+import json
+import array
+import logging
+import argparse
+import datetime
+import itertools
+import threading
+import functools
+
+from collections import Counter, deque
+
+from datalog_http_monitoring.log_collector import Log, EmptyLog
+
+
+logger = logging.getLogger(__name__)
+
+# record fields, in order
+FIELDS = ("date", "section", "status", "size", "weight", "method", "path", "ip", "user", "source")
+DATE, SECTION, STATUS, SIZE, WEIGHT, METHOD, PATH, IP, USER, SOURCE = range(len(FIELDS))
+
+# column name, array typecode (all fixed width)
+COLUMNS = (
+    ("date", "d"), ("utc_offset", "h"), ("status", "H"), ("size", "Q"), ("weight", "d"), ("source", "I"),
+    ("section", "I"), ("method", "I"), ("path", "I"), ("ip", "I"), ("user", "I"),
+)
+NO_SOURCE = 0xFFFFFFFF
+
+
+@functools.lru_cache(maxsize=64)
+def _timezone(minutes: int) -> datetime.timezone:
+    return datetime.timezone(datetime.timedelta(minutes=minutes))
+
+
+class _Bucket(object):
+    __slots__ = ("second", "columns", "values", "ids", "sections", "statuses")
+
+    def __init__(self, second: int):
+        self.second = second
+        self.columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+        self.values = [None]  # id => string or ip
+        self.ids = {None: 0}
+        self.sections = {}  # section => records indexes
+        self.statuses = {}  # status class (eg: "5XX") => records indexes
+
+    def __len__(self) -> int:
+        return len(self.columns["date"])
+
+    def add(self, log: Log, section: str):
+        index = len(self)
+        columns, value_id = self.columns, self._value_id
+        columns["date"].append(log.date.timestamp())
+        columns["utc_offset"].append(int(log.date.utcoffset().total_seconds()) // 60)
+        columns["status"].append(log.status_code)
+        columns["size"].append(log.size)
+        columns["weight"].append(log.weight)
+        columns["source"].append(NO_SOURCE if log.source is None else log.source)
+        columns["section"].append(value_id(section))
+        columns["method"].append(value_id(log.method))
+        columns["path"].append(value_id(log.path))
+        columns["ip"].append(value_id(log.ip))
+        columns["user"].append(value_id(log.user))
+        self.sections.setdefault(section, array.array("I")).append(index)
+        self.statuses.setdefault(f"{log.status_code // 100}XX", array.array("I")).append(index)
+
+    def _value_id(self, value) -> int:
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def record(self, index: int) -> tuple:
+        """
+        :return: the record tuple at `index`, see `FIELDS`
+        """
+        columns, values = self.columns, self.values
+        source = columns["source"][index]
+        return (datetime.datetime.fromtimestamp(columns["date"][index], _timezone(columns["utc_offset"][index])),
+                values[columns["section"][index]], columns["status"][index], columns["size"][index],
+                columns["weight"][index], values[columns["method"][index]], values[columns["path"][index]],
+                values[columns["ip"][index]], values[columns["user"][index]], None if source == NO_SOURCE else source)
+
+
+class RecentHistory(object):
+    def __init__(self, retention: float = 300, max_records: int = 1000000, sources=None):
+        """
+        Keep logs of the last `retention` seconds (of log time), at most `max_records` logs:
+        oldest seconds are removed beyond, logs are not kept when the newest second alone has `max_records` logs.
+
+        :param retention: duration in seconds of kept history
+        :type retention: float
+        :param max_records: oldest seconds are removed beyond this number of records
+        :type max_records: int
+        :param sources: log files paths, indexed by logs `source`
+        :type sources: list
+        """
+        self.retention = retention
+        self.max_records = max_records
+        self.sources = sources if sources is not None else []
+        self.buckets = deque()
+        self.records = 0
+        # queries are served from another thread
+        self.lock = threading.Lock()
+
+    def add(self, log: Log):
+        """
+        Store a log, to be used as a collector consumer
+        :param log: a `Log` instance
+        :type log: Log
+        """
+        if isinstance(log, EmptyLog):
+            return
+
+        second = int(log.date.timestamp())
+        section = log.path.split('/', 2)[1] if log.path else '/'
+
+        with self.lock:
+            buckets = self.buckets
+            if not buckets or buckets[-1].second < second:
+                buckets.append(_Bucket(second))
+                self._evict(second)
+            if self.records >= self.max_records:
+                self._evict(second)
+                if self.records >= self.max_records:
+                    return
+            bucket = buckets[-1]
+            if bucket.second > second:
+                # late log, find its bucket (there are few of them)
+                bucket = next((bucket for bucket in reversed(buckets) if bucket.second <= second), buckets[0])
+
+            bucket.add(log, section)
+            self.records += 1
+
+    def _evict(self, second: int):
+        buckets = self.buckets
+        # the newest bucket is always kept
+        while len(buckets) > 1 and (buckets[0].second <= second - self.retention or self.records >= self.max_records):
+            self.records -= len(buckets.popleft())
+
+    def _matches(self, last: float = None, section: str = None, status: str = None, path: str = None):
+        """
+        Find records matching all given filters (see `query`) without decoding them.
+        The lock is only held to snapshot the buckets, records added afterward are ignored.
+
+        :return: generator of (bucket, record index), newest first
+        """
+        status_class = f"{status[0]}XX" if status else None
+        status_code = int(status) if status and status.isdigit() else None
+        with self.lock:
+            if not self.buckets:
+                return
+            oldest = self.buckets[-1].second - last if last else None
+            buckets = [(bucket, len(bucket)) for bucket in reversed(self.buckets)
+                       if oldest is None or bucket.second > oldest]
+
+        for bucket, count in buckets:
+            # use the smallest index
+            indexes = None
+            if section is not None:
+                indexes = bucket.sections.get(section, ())
+            if status_class is not None:
+                status_indexes = bucket.statuses.get(status_class, ())
+                if indexes is None or len(status_indexes) < len(indexes):
+                    indexes = status_indexes
+            if indexes is None:
+                indexes = range(count)
+            # filter on columns
+            values, sections, statuses, paths = \
+                bucket.values, bucket.columns["section"], bucket.columns["status"], bucket.columns["path"]
+            for index in reversed(indexes):
+                if index >= count:
+                    continue
+                if section is not None and values[sections[index]] != section:
+                    continue
+                if status_class is not None and (statuses[index] // 100 != int(status[0])
+                                                 or status_code is not None and statuses[index] != status_code):
+                    continue
+                if path is not None and not values[paths[index]].startswith(path):
+                    continue
+                yield bucket, index
+
+    def query(self, last: float = None, section: str = None, status: str = None, path: str = None,
+              limit: int = None):
+        """
+        Find records matching all given filters, newest first.
+
+        :param last: only the last seconds, from the newest log
+        :type last: float
+        :param section: section, eg: "api"
+        :type section: str
+        :param status: status code (eg: "503") or class (eg: "5XX")
+        :type status: str
+        :param path: path prefix
+        :type path: str
+        :param limit: maximum number of records, only these are decoded
+        :type limit: int
+        :return: list of records tuples, see `FIELDS`
+        """
+        return [bucket.record(index)
+                for bucket, index in itertools.islice(self._matches(last, section, status, path), limit)]
+
+    def count(self, **filters) -> int:
+        """
+        :return: number of records matching `filters` (see `query`)
+        """
+        return sum(1 for _ in self._matches(**filters))
+
+    def top(self, group_by: str, limit: int = 10, **filters):
+        """
+        Count estimated hits (sampled logs count for their weight) of records matching `filters`
+        (see `query`) by `group_by` field, read from the columns.
+
+        :param group_by: one of `FIELDS`
+        :type group_by: str
+        :param limit: number of most common values
+        :type limit: int
+        :return: list of (value, hits)
+        """
+        hits = Counter()
+        if group_by == "date":
+            for bucket, index in self._matches(**filters):
+                record = bucket.record(index)
+                hits[record[DATE]] += record[WEIGHT]
+            return hits.most_common(limit)
+
+        # ids of a bucket are counted first, then resolved to values of the bucket
+        ids_column = group_by in ("section", "method", "path", "ip", "user")
+        bucket_hits, current = Counter(), None
+        for bucket, index in self._matches(**filters):
+            if bucket is not current:
+                if bucket_hits:
+                    self._add_hits(hits, bucket_hits, current.values if ids_column else None)
+                    bucket_hits = Counter()
+                current, column, weights = bucket, bucket.columns[group_by], bucket.columns["weight"]
+            bucket_hits[column[index]] += weights[index]
+        if bucket_hits:
+            self._add_hits(hits, bucket_hits, current.values if ids_column else None)
+        if group_by == "source" and NO_SOURCE in hits:
+            hits[None] += hits.pop(NO_SOURCE)
+        return hits.most_common(limit)
+
+    @staticmethod
+    def _add_hits(hits: Counter, bucket_hits: Counter, values: list):
+        if values is None:
+            hits.update(bucket_hits)
+        else:
+            for value_id, value_hits in bucket_hits.items():
+                hits[values[value_id]] += value_hits
+
+    def to_dict(self, record) -> dict:
+        data = dict(zip(FIELDS, record))
+        data["date"] = record[DATE].isoformat()
+        data["ip"] = str(record[IP])
+        if record[SOURCE] is not None and record[SOURCE] < len(self.sources):
+            data["source"] = self.sources[record[SOURCE]]
+        return data
+
+    def answer(self, request: dict) -> dict:
+        """
+        Answer a query request, see `parse_args` for the request keys
+        """
+        filters = {key: request.get(key) for key in ("last", "section", "status", "path")}
+        limit = request.get("limit") or 10
+        if request.get("group_by"):
+            group_by = request["group_by"]
+            assert group_by in FIELDS, f"Group by must be one of {', '.join(FIELDS)}"
+            top = self.top(group_by, limit, **filters)
+            if group_by == "source":
+                top = [(self.sources[value] if value is not None else None, hits) for value, hits in top]
+            return {"top": [[str(value), hits] for value, hits in top]}
+        # every match is counted, only the newest `limit` are decoded
+        count, records = 0, []
+        for bucket, index in self._matches(**filters):
+            if count < limit:
+                records.append(self.to_dict(bucket.record(index)))
+            count += 1
+        return {"count": count, "records": records}
+
+    def serve(self, socket_path: str):
+        """
+        Answer JSON requests, one per line, on a unix socket in a background thread.
+        Only the current user can connect, as answers show requests details (ips, users, paths).
+        A socket left at `socket_path` is replaced, any other file is kept and raises `FileExistsError`.
+
+        :param socket_path: path of the unix socket
+        :type socket_path: str
+        :return: the server, call its `shutdown` method to stop it
+        """
+        import os
+        import stat
+        import socketserver
+
+        history = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = history.answer(json.loads(line))
+                    except (ValueError, TypeError, AssertionError) as err:
+                        response = {"error": str(err)}
+                    self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        try:
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise FileExistsError(f"History socket path {socket_path!r} exists and is not a socket")
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        os.chmod(socket_path, 0o600)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="HistoryServer", daemon=True).start()
+        logger.info(f"History queries served on {socket_path!r}")
+        return server
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Query recent logs of a running datalog (see --history-socket)")
+    parser.add_argument("socket", help="datalog history socket path")
+    parser.add_argument("--last", help="only the last seconds", metavar="SECONDS", default=None, type=float)
+    parser.add_argument("--section", help="only this section, eg: api", default=None)
+    parser.add_argument("--status", help="only this status code or class, eg: 503 or 5XX", default=None)
+    parser.add_argument("--path", help="only paths starting with this prefix", default=None)
+    parser.add_argument("--group-by", help="count hits by this field instead of listing logs",
+                        choices=FIELDS, default=None)
+    parser.add_argument("--limit", help="number of logs or values (default: %(default)s)", default=10, type=int)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    import socket
+
+    args = parse_args(args)
+    request = {key: value for key, value in vars(args).items() if key != "socket"}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(args.socket)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response = json.loads(client.makefile("rb").readline())
+    json.dump(response, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
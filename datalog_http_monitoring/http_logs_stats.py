@@ -1,28 +1,44 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import math
+import logging
 import datetime
+import threading
 
 from typing import List
-from collections import Counter
+from collections import Counter, deque
 
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
 from datalog_http_monitoring.log_collector import Log, EmptyLog
 from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
 
 
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 3
+
+
 class Alert(object):
     """
-    An alert with corresponding logs.
+    An alert summary, logs are not kept: `source` is the log file for a single file alert
+    and `kind` describes what is anomalous.
+    `start` is the date of the first log, `triggered` the date of the log which triggered it.
     """
-    def __init__(self, logs: List[Log]):
-        self.logs = logs
-        self.start = logs[0].date
-        self.end = logs[-1].date
+    def __init__(self, start: datetime.datetime, triggered: datetime.datetime, hits: float = 0,
+                 source: str = None, kind: str = "High traffic"):
+        self.source = source
+        self.kind = kind
+        self.hits = hits
+        self.start = start
+        self.end = triggered
+        self.triggered = triggered
         self.finished = False
 
     def update(self, log: Log):
         assert not self.finished, "Alert has ended, create another alert"
-        self.logs.append(log)
+        self.hits += log.weight
         self.end = log.date
 
     def recover(self, log: Log):
@@ -34,11 +50,112 @@ class Alert(object):
         return (self.end - self.start).total_seconds()
 
 
+class AlertMonitor(object):
+    def __init__(self, alert_period: int = 120, alert_threshold: int = 5, source: str = None):
+        """
+        Trigger and recover `Alert`s from the requests rate over `alert_period`.
+
+        :param alert_period: duration in seconds of alert monitoring
+        :type alert_period: int
+        :param alert_threshold: requests per seconds limit before triggering an alert
+        :type alert_threshold: int
+        :param source: log file monitored, None for all files
+        :type source: str
+        """
+        self.source = source
+        self.alerts = []
+        self.in_alert = False
+        self.alert_period = alert_period
+        self.set_threshold(alert_threshold)
+        self.alert_period_logs = deque()  # (date, weight) of logs during the last `alert_period`
+        self.alert_period_hits = 0  # estimated requests in `alert_period_logs` (sampled logs weight more)
+
+    def set_threshold(self, alert_threshold: int):
+        """
+        :param alert_threshold: requests per seconds limit before triggering an alert
+        :type alert_threshold: int
+        """
+        self.alert_rate_threshold = alert_threshold
+        self.alert_rate_threshold_margin = alert_threshold / 10
+
+    def check(self, log: Log) -> Alert:
+        """
+        Collect all logs during last `alert_period` seconds
+        and create an alert when the requests rate get greater than `alert_rate_threshold`.
+
+        Alert is recovered when requests rate goes under (`alert_rate_threshold` - `alert_rate_threshold_margin`)
+        to avoid triggering many alerts when requests rate is just around the `alert_rate_threshold`.
+        :param log: a `Log` instance
+        :type log: Log
+        :return: the alert if it has just been triggered or recovered
+        """
+
+        self.alert_period_logs.append((log.date, log.weight))
+        self.alert_period_hits += log.weight
+        # while first and last log time diff is more than alert period
+        while (log.date - self.alert_period_logs[0][0]).total_seconds() >= self.alert_period:
+            # remove oldest log
+            self.alert_period_hits -= self.alert_period_logs.popleft()[1]
+
+        # compute current requests rate, estimated from weights when logs are sampled
+        alert_requests_rate = self.alert_period_hits / self.alert_period
+
+        # trigger or recover alerts
+        if self.in_alert:
+            alert = self.alerts[-1]  # current alert
+            if alert_requests_rate <= (self.alert_rate_threshold - self.alert_rate_threshold_margin):
+                alert.recover(log)
+                self.in_alert = False
+                return alert
+            alert.update(log)
+        elif alert_requests_rate > self.alert_rate_threshold:
+            alert = Alert(self.alert_period_logs[0][0], log.date, self.alert_period_hits, self.source)
+            self.alerts.append(alert)
+            self.in_alert = True
+            return alert
+
+
+class FileStats(object):
+    def __init__(self, source: str = None, alert_period: int = 120, alert_threshold: int = 5):
+        """
+        Period statistics partition and alerting of a single log file,
+        `HTTPLogsStats` merges their periods into global period statistics.
+
+        :param source: log file path
+        :type source: str
+        :param alert_period: duration in seconds of alert monitoring
+        :type alert_period: int
+        :param alert_threshold: requests per seconds limit before triggering an alert
+        :type alert_threshold: int
+        """
+        self.source = source
+        self.period_stats = HTTPStatsSections()
+        self._period_stats = HTTPStatsSections()  # used for period stats rotations
+        self.alert_monitor = AlertMonitor(alert_period, alert_threshold, source)
+
+    def update(self, log: Log):
+        self._period_stats.update(log)
+        return self.alert_monitor.check(log)
+
+    def rotate_period_stats(self):
+        self.period_stats = self._period_stats
+        self._period_stats = HTTPStatsSections()
+
+
 class HTTPLogsStats(ConsumersFeeder):
-    def __init__(self, period: int = 10, alert_period: int = 120, alert_threshold: int = 5, alert_output: str = None):
+    def __init__(self, period: int = 10, alert_period: int = 120, alert_threshold: int = 5, alert_output: str = None,
+                 snapshot_file: str = None, snapshot_interval: float = 30, metrics=None, anomaly_monitor=None,
+                 clock=None):
         """
         Collect total and periodic statistics from Log instances and manage alerting.
 
+        Total statistics are kept globally, period statistics and alerts are kept per log file (see `FileStats`)
+        and files period statistics are merged at each period rotation.
+        Logs `source` is an index in `sources`, the list of collected files paths.
+
+        State can be saved periodically to `snapshot_file` and loaded back with `load_snapshot`
+        so that a restarted instance continues where the previous one stopped.
+
         :param period: duration in seconds of periodic statistics
         :type period: int
         :param alert_period: duration in seconds of alert monitoring
@@ -47,21 +164,34 @@ class HTTPLogsStats(ConsumersFeeder):
         :type alert_threshold: int
         :param alert_output: write alerts to this path
         :type alert_output: str
+        :param snapshot_file: periodically save state to this path
+        :type snapshot_file: str
+        :param snapshot_interval: delay in seconds between two snapshots
+        :type snapshot_interval: float
+        :param metrics: record pipeline health metrics, also available to consumers
+        :type metrics: PipelineMetrics
+        :param anomaly_monitor: also alert on sections spikes and 5XX ratio
+        :type anomaly_monitor: AnomalyMonitor
+        :param clock: source of time of snapshots, default to system time
+        :type clock: Clock
         """
-        super(HTTPLogsStats, self).__init__()
+        super(HTTPLogsStats, self).__init__(metrics)
+        self.sources = []
+        self.files = {}  # log file path => FileStats
+        # files by hits of the last period (most first) and number of files in alert,
+        # maintained so that displays never go through every file
+        self.files_by_hits = []
+        self.files_in_alert = 0
         self.all_stats = HTTPStats()
 
         self.period = period
         self.period_start = None
         self.period_stats = HTTPStatsSections()
-        self._period_stats = HTTPStatsSections()  # used for period stats rotations
 
-        self.alerts = []
-        self.in_alert = False
         self.alert_period = alert_period
         self.alert_rate_threshold = alert_threshold
-        self.alert_rate_threshold_margin = alert_threshold / 10
-        self.alert_period_logs = []
+        self.alert_monitor = AlertMonitor(alert_period, alert_threshold)
+        self.anomaly_monitor = anomaly_monitor
 
         self.alert_output = alert_output
         if alert_output:
@@ -69,6 +199,17 @@ class HTTPLogsStats(ConsumersFeeder):
             with open(alert_output, "a+", encoding="utf-8"):
                 pass
 
+        # collector position of the last consumed log of each file, saved along the state
+        self.offsets = {}
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock or SYSTEM_CLOCK
+        self.next_snapshot = self.clock.time() + snapshot_interval
+        self._snapshot_thread = None  # thread writing a background snapshot
+        self._snapshot_sequence = 0  # sequence number of the last taken snapshot
+        self._snapshot_written = 0  # sequence number of the snapshot in the snapshot file, guarded by the lock
+        self._snapshot_lock = threading.Lock()
+
     def update(self, log: Log):
         """
         Collect `Log` metrics and add it to existing statistics
@@ -76,13 +217,153 @@ class HTTPLogsStats(ConsumersFeeder):
         :type log: Log
         """
         if not isinstance(log, EmptyLog):
+            source = self.sources[log.source] if log.source is not None else None
+            file_stats = self.files.get(source)
+            if not file_stats:
+                file_stats = self.files[source] = FileStats(source, self.alert_period, self.alert_rate_threshold)
+                # no hits in the last period
+                self.files_by_hits.append(file_stats)
+            file_alert = file_stats.update(log)
+            if file_alert:
+                self.files_in_alert += -1 if file_alert.finished else 1
             self.all_stats.update(log)
-            self._period_stats.update(log)
             self._check_alert(log)
+            # single file alerts would duplicate global alerts when there is only one file,
+            # its window is still kept so that it alerts right away once other files are discovered
+            if file_alert and len(self.sources) > 1:
+                self.write_alert(file_alert)
+            if source:
+                self.offsets[source] = log.offset
 
         self._rotate_period_stats(log.date)
         self.feed_consumers(self)
 
+        if self.snapshot_file and self.clock.time() >= self.next_snapshot:
+            self.save_snapshot(background=True)
+
+    @property
+    def alerts(self) -> List[Alert]:
+        if not self.anomaly_monitor:
+            return self.alert_monitor.alerts
+        return sorted(self.alert_monitor.alerts + self.anomaly_monitor.alerts, key=lambda alert: alert.start)
+
+    @property
+    def in_alert(self) -> bool:
+        return self.alert_monitor.in_alert or bool(self.anomaly_monitor and self.anomaly_monitor.in_alert)
+
+    @property
+    def alert_period_logs(self) -> deque:
+        return self.alert_monitor.alert_period_logs
+
+    def save_snapshot(self, path: str = None, background: bool = False):
+        """
+        Atomically write current state and collector offsets to a compressed snapshot file.
+        The snapshot is written and synced to a temporary file then renamed, a crash never leaves a partial snapshot.
+
+        State is serialized right away, in `background` it is compressed and written by a thread
+        while statistics keep being updated, periodic snapshots are skipped until it has finished.
+        A snapshot never replaces a newer one written meanwhile (eg: on exit).
+
+        :param path: snapshot path (default to `snapshot_file`)
+        :type path: str
+        :param background: write the snapshot from a background thread
+        :type background: bool
+        """
+        import pickle
+
+        path = path or self.snapshot_file
+        self.next_snapshot = self.clock.time() + self.snapshot_interval
+        if background and self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+
+        self._snapshot_sequence += 1
+        state = pickle.dumps({
+            "version": SNAPSHOT_VERSION,
+            "period": self.period,
+            "alert_period": self.alert_period,
+            "files": self.files,
+            "all_stats": self.all_stats,
+            "period_start": self.period_start,
+            "period_stats": self.period_stats,
+            "alert_monitor": self.alert_monitor,
+            "anomaly_monitor": self.anomaly_monitor,
+            "offsets": self.offsets,
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+        if background:
+            self._snapshot_thread = threading.Thread(target=self._write_snapshot, name="Snapshot",
+                                                     args=(path, state, self._snapshot_sequence))
+            self._snapshot_thread.start()
+        else:
+            self._write_snapshot(path, state, self._snapshot_sequence)
+
+    def _write_snapshot(self, path: str, state: bytes, sequence: int):
+        import gzip
+        import tempfile
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as raw_fd:
+                with gzip.GzipFile(fileobj=raw_fd, mode="wb", compresslevel=1) as gz_fd:
+                    gz_fd.write(state)
+                raw_fd.flush()
+                os.fsync(raw_fd.fileno())
+            with self._snapshot_lock:
+                if sequence > self._snapshot_written:
+                    os.replace(tmp_path, path)
+                    self._snapshot_written = sequence
+        except Exception as err:
+            logger.error(f"Unable to write snapshot {path!r}", exc_info=err)
+        finally:
+            # left when interrupted, failed, or outdated
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def load_snapshot(self, path: str = None) -> bool:
+        """
+        Restore state and collector offsets from a snapshot file written by `save_snapshot`.
+
+        :param path: snapshot path (default to `snapshot_file`)
+        :type path: str
+        :return: True if state has been restored
+        """
+        import gzip
+        import pickle
+
+        path = path or self.snapshot_file
+        try:
+            with gzip.open(path, "rb") as fd:
+                state = pickle.load(fd)
+        except FileNotFoundError:
+            return False
+        except Exception as err:
+            logger.error(f"Unable to read snapshot {path!r}, starting from scratch", exc_info=err)
+            return False
+
+        if state.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Snapshot {path!r} has an unsupported version, starting from scratch")
+            return False
+        if (state["period"], state["alert_period"]) != (self.period, self.alert_period):
+            logger.warning(f"Snapshot {path!r} was made with other periods, starting from scratch")
+            return False
+
+        self.files = state["files"]
+        self.all_stats = state["all_stats"]
+        self.period_start = state["period_start"]
+        self.period_stats = state["period_stats"]
+        self.alert_monitor = state["alert_monitor"]
+        # the alert threshold may have changed since the snapshot
+        for alert_monitor in [self.alert_monitor] + [file_stats.alert_monitor for file_stats in self.files.values()]:
+            alert_monitor.set_threshold(self.alert_rate_threshold)
+        if self.anomaly_monitor and state.get("anomaly_monitor"):
+            self.anomaly_monitor = state["anomaly_monitor"]
+        self.offsets = state["offsets"]
+        self._rank_files()
+        self.files_in_alert = sum(file_stats.alert_monitor.in_alert for file_stats in self.files.values())
+        logger.info(f"Restored state from snapshot {path!r}")
+        return True
+
     def _rotate_period_stats(self, date: datetime.datetime):
         """
         Rotate period statistics when period has ended
@@ -92,56 +373,40 @@ class HTTPLogsStats(ConsumersFeeder):
         if not self.period_start:
             self.period_start = date
         elif (date - self.period_start).total_seconds() >= self.period:
-            self.period_stats = self._period_stats
-            self._period_stats = HTTPStatsSections()
+            for file_stats in self.files.values():
+                file_stats.rotate_period_stats()
+            self.period_stats = HTTPStatsSections.merge_all(
+                file_stats.period_stats for file_stats in self.files.values())
+            self._rank_files()
             self.period_start = date
 
+    def _rank_files(self):
+        self.files_by_hits = sorted(self.files.values(), key=lambda file_stats: file_stats.period_stats.hits,
+                                    reverse=True)
+
     def _check_alert(self, log: Log):
         """
-        Collect all logs during last `alert_period` seconds
-        and create an alert when the requests rate get greater than `alert_rate_threshold`.
-
-        Alert is recovered when requests rate goes under (`alert_rate_threshold` - `alert_rate_threshold_margin`)
-        to avoid triggering many alerts when requests rate is just around the `alert_rate_threshold`.
+        Check global requests rate, see `AlertMonitor.check`, and anomalies, see `AnomalyMonitor.check`
         :param log: a `Log` instance
         :type log: Log
         """
-
-        self.alert_period_logs.append(log)
-        # while first and last log time diff is more than alert period
-        while (self.alert_period_logs[-1].date - self.alert_period_logs[0].date).total_seconds() >= self.alert_period:
-            # remove oldest log
-            self.alert_period_logs.pop(0)
-
-        # compute current requests rate
-        alert_period_requests = len(self.alert_period_logs)
-        alert_requests_rate = alert_period_requests / self.alert_period
-
-        # trigger or recover alerts
-        if self.in_alert:
-            alert = self.alerts[-1]  # current alert
-            if alert_requests_rate <= (self.alert_rate_threshold - self.alert_rate_threshold_margin):
-                alert.recover(log)
-                self.in_alert = False
-                self.write_alert(alert)
-            else:
-                alert.update(log)
-        else:
-            if alert_requests_rate > self.alert_rate_threshold:
-                alert = Alert(list(self.alert_period_logs))
-                self.alerts.append(alert)
-                self.in_alert = True
+        alert = self.alert_monitor.check(log)
+        if alert:
+            self.write_alert(alert)
+        if self.anomaly_monitor:
+            for alert in self.anomaly_monitor.check(log):
                 self.write_alert(alert)
 
     def write_alert(self, alert: Alert):
         if not self.alert_output:  # pragma: no cover
             return
 
+        source = f" on {alert.source}" if alert.source else ""
         if alert.finished:
-            text = f"High traffic recovered at {alert.end:%d/%m/%y, %H:%M:%S} - duration:\7 {alert.duration}\n"
+            text = f"{alert.kind}{source} recovered at {alert.end:%d/%m/%y, %H:%M:%S} - duration:\7 {alert.duration}\n"
         else:
-            text = f"High traffic generated an alert - " \
-                   f"hits = {len(alert.logs)}, triggered at {alert.start:%d/%m/%y, %H:%M:%S}\n"
+            text = f"{alert.kind}{source} generated an alert - " \
+                   f"hits = {round(alert.hits)}, triggered at {alert.triggered:%d/%m/%y, %H:%M:%S}\n"
 
         with open(self.alert_output, "a", encoding="utf-8") as fd:
             fd.write(text)
@@ -150,10 +415,14 @@ class HTTPLogsStats(ConsumersFeeder):
 class HTTPStats(object):
     """
     Collect statistics from Log instances.
+
+    Sampled logs count for their `weight`, so counters are estimates of all logs
+    (except unique visitors and paths which are only counted on sampled logs).
     """
 
     def __init__(self):
         self.hits = 0
+        self.hits_variance = 0  # variance of the `hits` estimate, 0 when nothing is sampled
         self.visitors = Counter()
         self.valid_requests = 0
         self.status_codes = Counter()
@@ -172,29 +441,131 @@ class HTTPStats(object):
         :type log: Log
         """
 
-        self.hits += 1
-        self.visitors[(log.ip, log.user)] += 1
-        self.paths[log.path] += 1
-        self.bandwidth += log.size
-        self.methods[log.method] += 1
+        weight = log.weight
+        self.hits += weight
+        self.visitors[(log.ip, log.user)] += weight
+        self.paths[log.path] += weight
+        self.bandwidth += log.size * weight
+        self.methods[log.method] += weight
 
         section = log.path.split('/', 2)[1] if log.path else '/'
-        self.sections[section] += 1
+        self.sections[section] += weight
 
         status = str(log.status_code)
         status_kind = f"{status[0]}XX"
-        self.status_codes.update([status, status_kind])
+        self.status_codes[status] += weight
+        self.status_codes[status_kind] += weight
         if status_kind != "5XX":
-            self.valid_requests += 1
+            self.valid_requests += weight
+
+        if weight != 1:
+            # Horvitz-Thompson variance estimate of a log kept with probability 1 / weight
+            self.hits_variance += weight * weight - weight
+
+    def merge(self, other: "HTTPStats"):
+        """
+        Add statistics of `other` to this instance
+        :param other: a `HTTPStats` instance
+        :type other: HTTPStats
+        """
+        self.hits += other.hits
+        self.hits_variance += other.hits_variance
+        self.visitors.update(other.visitors)
+        self.valid_requests += other.valid_requests
+        self.status_codes.update(other.status_codes)
+        self.paths.update(other.paths)
+        self.sections.update(other.sections)
+        self.methods.update(other.methods)
+        self.bandwidth += other.bandwidth
+
+    @classmethod
+    def merge_all(cls, stats_list):
+        """
+        Merge statistics, a single statistics is returned as is
+        :param stats_list: iterable of statistics of this class
+        :return: merged statistics
+        """
+        stats_list = list(stats_list)
+        if len(stats_list) == 1:
+            return stats_list[0]
+        merged = cls()
+        for stats in stats_list:
+            merged.merge(stats)
+        return merged
+
+    @property
+    def hits_error(self) -> float:
+        """
+        Half width of the 95% confidence interval of `hits` (0 when nothing is sampled)
+        """
+        return 1.96 * math.sqrt(self.hits_variance)
+
+
+class TopK(object):
+    def __init__(self, counter: Counter, k: int = 5):
+        """
+        Keys with the `k` highest counts of `counter`, kept up to date with `update` after each increment
+        so that reading them does not sort the whole counter.
+
+        Counts must only increase: a key outside the top then never has a higher count than the lowest top key,
+        and only replaces it when it does. `lowest` is only refreshed then, it is a lower bound in between.
+
+        :param counter: counter of keys
+        :type counter: Counter
+        :param k: number of top keys
+        :type k: int
+        """
+        self.counter = counter
+        self.k = k
+        self.keys = []
+        self.lowest = 0  # lowest count of top keys (or less), 0 while there are less than `k` keys
+
+    def update(self, key):
+        """
+        Update top keys after `key` count has increased
+        """
+        keys = self.keys
+        if key in keys:
+            return
+        if len(keys) < self.k:
+            keys.append(key)
+            return
+        count = self.counter[key]
+        if count > self.lowest:
+            counter = self.counter
+            lowest_index = min(range(self.k), key=lambda index: counter[keys[index]])
+            if count > counter[keys[lowest_index]]:
+                keys[lowest_index] = key
+            self.lowest = min(counter[top_key] for top_key in keys)
+
+    def rebuild(self):
+        self.keys = [key for key, _ in self.counter.most_common(self.k)]
+        self.lowest = self.counter[self.keys[-1]] if len(self.keys) == self.k else 0
+
+    def most_common(self):
+        """
+        :return: list of (key, count) of top keys, highest first
+        """
+        return sorted(((key, self.counter[key]) for key in self.keys), key=lambda item: item[1], reverse=True)
 
 
 class HTTPStatsSections(HTTPStats):
     """
     Collect statistics from Log instances with also sections statistics.
+
+    Top sections and paths are maintained as logs are collected, along with totals of sections unique visitors
+    and paths, so that top sections and the remaining ones can be displayed without going through all sections.
     """
+
+    TOP_K = 5
+
     def __init__(self):
         super(HTTPStatsSections, self).__init__()
         self.sections_stats = {}
+        self.top_sections = TopK(self.sections, self.TOP_K)
+        self.top_paths = TopK(self.paths, self.TOP_K)
+        self.sections_visitors = 0  # sum of sections unique visitors
+        self.sections_paths = 0  # sum of sections unique paths
 
     def update(self, log: Log):
         """
@@ -205,5 +576,22 @@ class HTTPStatsSections(HTTPStats):
         super(HTTPStatsSections, self).update(log)
         # also collect sections statistics
         section = log.path.split('/', 2)[1] if log.path else '/'
-        section_stats = self.sections_stats.setdefault(section, HTTPStats())
+        section_stats = self.sections_stats.get(section)
+        if section_stats is None:
+            section_stats = self.sections_stats[section] = HTTPStats()
+        if (log.ip, log.user) not in section_stats.visitors:
+            self.sections_visitors += 1
+        if log.path not in section_stats.paths:
+            self.sections_paths += 1
         section_stats.update(log)
+        self.top_sections.update(section)
+        self.top_paths.update(log.path)
+
+    def merge(self, other: "HTTPStatsSections"):
+        super(HTTPStatsSections, self).merge(other)
+        for section, other_section_stats in other.sections_stats.items():
+            self.sections_stats.setdefault(section, HTTPStats()).merge(other_section_stats)
+        self.sections_visitors = sum(len(section_stats.visitors) for section_stats in self.sections_stats.values())
+        self.sections_paths = sum(len(section_stats.paths) for section_stats in self.sections_stats.values())
+        self.top_sections.rebuild()
+        self.top_paths.rebuild()
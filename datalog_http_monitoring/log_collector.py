@@ -2,109 +2,510 @@
 # -*- coding: utf-8 -*-
 
 import os
-import time
+import zlib
 import logging
 import datetime
 import multiprocessing
 
-from queue import Empty
+from queue import Empty, Full
 from ipaddress import ip_address
 
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
+from datalog_http_monitoring.metrics import PipelineMetrics
 from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
 
 
 logger = logging.getLogger(__name__)
 
 
+class LineSampler(object):
+    """
+    Deterministic hash based sampling of log lines, done before parsing to save its cost.
+    A line is kept when its hash is under `rate`, so the same lines are always kept.
+
+    Kept logs have a `weight` of 1 / `rate` so that statistics scale back to estimates of all lines.
+    When `adaptive`, rate halves each time the collector queue is full,
+    and doubles back up to `max_rate` after `RECOVER_AFTER` logs were queued without waiting.
+    """
+    RECOVER_AFTER = 1000
+    MIN_RATE = 1 / 1024
+
+    def __init__(self, rate: float = 1.0, adaptive: bool = False, counters=None):
+        """
+        :param rate: share of lines to keep, between 0 (excluded) and 1
+        :type rate: float
+        :param adaptive: adapt rate to the collector queue load
+        :type adaptive: bool
+        :param counters: `PipelineMetrics.watcher_counters` to report sampling rate
+        :type counters: multiprocessing.RawArray
+        """
+        assert 0 < rate <= 1, "Sampling rate must be between 0 (excluded) and 1"
+        self.max_rate = rate
+        self.adaptive = adaptive
+        self.counters = counters
+        self.queued_count = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float):
+        self.rate = rate
+        self.weight = 1 / rate
+        self.threshold = int(rate * 0xFFFFFFFF)
+        self.queued_count = 0
+        if self.counters is not None:
+            self.counters[PipelineMetrics.SAMPLE_RATE] = int(rate * PipelineMetrics.SAMPLE_RATE_SCALE)
+
+    def keep(self, line: str) -> bool:
+        return self.rate >= 1 or zlib.crc32(line.encode("utf-8")) <= self.threshold
+
+    def overloaded(self):
+        if self.adaptive and self.rate > self.MIN_RATE:
+            logger.info(f"Collector queue is overloaded, sampling {self.rate / 2:.2%} of lines")
+            self.set_rate(max(self.rate / 2, self.MIN_RATE))
+
+    def queued(self):
+        if self.adaptive and self.rate < self.max_rate:
+            self.queued_count += 1
+            if self.queued_count >= self.RECOVER_AFTER:
+                self.set_rate(min(self.rate * 2, self.max_rate))
+
+
+class OverloadPolicy(object):
+    """
+    Wrap the collector queue to decide what to do with new logs when it is full:
+      - block: wait for the consumer, the watcher stop reading files (no loss)
+      - drop: discard new logs until there is room again, loss is counted
+      - sample: keep only one log out of `sample_every`, which double each time the queue is full
+        and halves after `RECOVER_AFTER` logs were queued without waiting, discarded logs are counted
+        and kept logs weight is multiplied by `sample_every`
+
+    An adaptive `LineSampler` is notified of the queue load too.
+    """
+    BLOCK, DROP, SAMPLE = "block", "drop", "sample"
+    POLICIES = (BLOCK, DROP, SAMPLE)
+
+    SAMPLE_MAX = 1024
+    RECOVER_AFTER = 1000
+
+    def __init__(self, logs_queue, policy: str = BLOCK, counters=None, sampler: LineSampler = None):
+        """
+        :param logs_queue: the collector queue
+        :type logs_queue: multiprocessing.Queue
+        :param policy: one of `POLICIES`
+        :type policy: str
+        :param counters: `PipelineMetrics.watcher_counters` to report loss and sampling
+        :type counters: multiprocessing.RawArray
+        :param sampler: line sampler to notify of the queue load
+        :type sampler: LineSampler
+        """
+        self.logs_queue = logs_queue
+        self.policy = policy
+        self.counters = counters
+        self.sampler = sampler
+        self.sample_every = 1
+        self.sample_index = 0
+        self.queued = 0
+
+    def put(self, log):
+        if self.sample_every > 1:
+            self.sample_index += 1
+            if self.sample_index % self.sample_every:
+                self._drop()
+                return
+            log.weight *= self.sample_every
+
+        try:
+            self.logs_queue.put_nowait(log)
+        except Full:
+            if self.sampler:
+                self.sampler.overloaded()
+            if self.policy == self.BLOCK:
+                self.logs_queue.put(log)
+                return
+            self._drop()
+            if self.policy == self.SAMPLE and self.sample_every < self.SAMPLE_MAX:
+                self._set_sample_every(self.sample_every * 2)
+            return
+
+        if self.sampler:
+            self.sampler.queued()
+        if self.sample_every > 1:
+            self.queued += 1
+            if self.queued >= self.RECOVER_AFTER:
+                self._set_sample_every(self.sample_every // 2)
+
+    def _drop(self):
+        if self.counters is not None:
+            self.counters[PipelineMetrics.LOGS_DROPPED] += 1
+
+    def _set_sample_every(self, sample_every: int):
+        logger.info(f"Collector queue is overloaded, keeping 1 log out of {sample_every}")
+        self.sample_every = sample_every
+        self.sample_index = 0
+        self.queued = 0
+        if self.counters is not None:
+            self.counters[PipelineMetrics.SAMPLE_EVERY] = sample_every
+
+
+def is_pattern(log_file: str) -> bool:
+    """
+    Tell if a log file argument is a glob pattern or a directory, which can match files created later.
+    """
+    return any(char in log_file for char in "*?[") or os.path.isdir(log_file)
+
+
+def expand_log_files(log_files) -> set:
+    """
+    Find files matching log files arguments: plain paths are kept as is,
+    glob patterns are expanded (`**` is recursive) and directories match their `*.log` files
+    (rotated and compressed files are left apart).
+
+    :param log_files: files paths, glob patterns or directories
+    :type log_files: set
+    :return: set of files paths
+    """
+    import glob
+
+    paths = set()
+    for log_file in log_files:
+        if not is_pattern(log_file):
+            paths.add(log_file)
+            continue
+        if os.path.isdir(log_file):
+            log_file = os.path.join(log_file, "*.log")
+        paths.update(path for path in glob.iglob(log_file, recursive=True) if os.path.isfile(path))
+    return paths
+
+
+class NewSource(object):
+    """
+    Sent by the watcher to the main process before the first log of a file discovered from a pattern,
+    so that both processes give it the same `source` id.
+    """
+    def __init__(self, source: int, path: str):
+        self.source = source
+        self.path = path
+
+
+class WatchedFile(object):
+    """
+    A log file and its reading state in the watcher process.
+
+    Files are polled with `os.stat`, an unchanged file is checked less and less often
+    (from `MIN_INTERVAL` up to `MAX_INTERVAL` seconds) so that thousands of idle files cost nearly nothing,
+    and is checked again at `MIN_INTERVAL` as soon as it changes.
+    """
+
+    MIN_INTERVAL = 0.1
+    MAX_INTERVAL = 5.0
+
+    def __init__(self, path: str, source: int = None, position: int = 0, parser=None):
+        self.path = path
+        self.source = source
+        self.position = position
+        self.parser = parser
+        self.last_read = 0
+        self.modified = 0
+        self.interval = self.MIN_INTERVAL
+        self.next_check = 0
+
+    def __lt__(self, other):
+        # files are kept in a heap ordered by `next_check`
+        return (self.next_check, self.source) < (other.next_check, other.source)
+
+    def has_changed(self) -> bool:
+        stats = os.stat(self.path)
+        if stats.st_size < self.position:
+            # file has been truncated (or replaced), start over
+            logger.info(f"Log file {self.path!r} is smaller than last position, reading from start")
+            self.position = 0
+        self.modified = stats.st_mtime
+        return stats.st_mtime > self.last_read or stats.st_size > self.position
+
+    def read(self, logs_queue, counters=None, sampler=None, max_lines: int = None) -> int:
+        """
+        Parse new lines and put logs in `logs_queue`, the file must have changed (see `has_changed`).
+
+        :param logs_queue: queue receiving parsed logs
+        :param counters: watcher counters (see `PipelineMetrics`)
+        :param sampler: skip lines not kept by this sampler
+        :type sampler: LineSampler
+        :param max_lines: stop after this number of lines so that other files are read too
+        :type max_lines: int
+        :return: number of lines read
+        """
+        # note: modification time is taken before reading, so that lines written meanwhile are read next time
+        self.last_read = self.modified
+
+        # read new log lines
+        # logger.debug(f"Detected new content in {self.path}")
+        parse = self.parser or Log.from_string
+        position = self.position
+        lines_parsed = lines_failed = lines_skipped = 0
+        with open(self.path, "r", encoding="utf-8") as fd:
+            fd.seek(position)
+            while not max_lines or lines_parsed + lines_failed + lines_skipped < max_lines:
+                line = fd.readline()
+                if not line:
+                    # logger.debug(f"Finish reading logs in {self.path}")
+                    break
+                if sampler and line[-1] == "\n" and not sampler.keep(line):
+                    lines_skipped += 1
+                    position = fd.tell()
+                    continue
+                log = parse(line)
+                if log:
+                    lines_parsed += 1
+                    # note: we only move position past complete lines, an incomplete
+                    # line will be read again once it has been fully written
+                    position = fd.tell()
+                    log.source, log.offset = self.source, position
+                    if sampler and sampler.rate < 1:
+                        log.weight = sampler.weight
+                    logs_queue.put(log)
+                elif line[-1] == "\n":
+                    # complete garbage lines are skipped, incomplete lines will be read again
+                    lines_failed += 1
+                    position = fd.tell()
+        self.position = position
+
+        if counters is not None:
+            counters[PipelineMetrics.LINES_READ] += lines_parsed + lines_failed + lines_skipped
+            counters[PipelineMetrics.LINES_SKIPPED] += lines_skipped
+            counters[PipelineMetrics.LINES_PARSED] += lines_parsed
+            counters[PipelineMetrics.LINES_FAILED] += lines_failed
+
+        return lines_parsed + lines_failed + lines_skipped
+
+    def schedule(self, now: float, lines: int, max_lines: int = None):
+        """
+        Set when to check the file again after reading `lines` lines
+        """
+        if max_lines and lines >= max_lines:
+            # more lines are waiting, read them after the other files
+            self.interval = self.MIN_INTERVAL
+            self.next_check = now
+            return
+        self.interval = self.MIN_INTERVAL if lines else min(self.interval * 2, self.MAX_INTERVAL)
+        self.next_check = now + self.interval
+
+
 class LogCollector(ConsumersFeeder):
-    def __init__(self, log_files):
-        super(LogCollector, self).__init__()
 
-        self.log_files = log_files
+    # lines read from a file before moving to the next one
+    READ_BATCH = 1000
+    # delay in seconds between two searches of new files matching patterns
+    DISCOVER_INTERVAL = 2.0
 
-        # check that file can be read early
-        for log_file in log_files:
-            assert os.path.exists(log_file), f"Log file {log_file!r} must exists"
-            assert os.path.isfile(log_file), f"Log file {log_file!r} must be a file"
-            assert os.access(log_file, os.R_OK), f"Log file {log_file!r} must be a readable"
+    # how logs are sent from the watcher process
+    QUEUE, SHARED_MEMORY = "queue", "shm"
+    TRANSPORTS = (QUEUE, SHARED_MEMORY)
 
-        self.logs_queue = multiprocessing.Queue()
+    def __init__(self, log_files, offsets=None, metrics=None, queue_size=0, overload=OverloadPolicy.BLOCK,
+                 sample_rate=1.0, sample_adaptive=False, log_format="auto", transport=QUEUE, clock=None):
+        """
+        Watch log files in a separate process and feed parsed `Log` instances to consumers.
+
+        :param log_files: paths of the files to watch, glob patterns or directories (see `expand_log_files`),
+                          files matching patterns are discovered while running
+        :type log_files: set
+        :param offsets: position to resume reading from for each file (eg: loaded from a snapshot)
+        :type offsets: dict
+        :param metrics: record pipeline health metrics
+        :type metrics: PipelineMetrics
+        :param queue_size: maximum number of logs waiting to be consumed, 0 for unbounded
+        :type queue_size: int
+        :param overload: what to do when queue is full, one of `OverloadPolicy.POLICIES`
+        :type overload: str
+        :param sample_rate: share of lines to parse, statistics are scaled back (see `LineSampler`)
+        :type sample_rate: float
+        :param sample_adaptive: lower sampling rate when the collector queue is full
+        :type sample_adaptive: bool
+        :param log_format: "auto" to detect each file format, a format name or a format string (see `parsers`)
+        :type log_format: str
+        :param transport: "queue" to pickle logs through a `multiprocessing.Queue`,
+                          "shm" to write them in a shared memory ring buffer (see `shared_ring`)
+        :type transport: str
+        :param clock: source of time, default to system time
+        :type clock: Clock
+        """
+        super(LogCollector, self).__init__(metrics)
+
+        self.log_files = log_files
+        self.patterns = sorted(log_file for log_file in log_files if is_pattern(log_file))
+        # logs `source` is the index of their file in this list, cheaper to send than the path
+        self.sources = sorted(expand_log_files(log_files))
+        self.offsets = dict(offsets or {})
+        self.clock = clock or SYSTEM_CLOCK
+
+        self.check_options(self.sources, self.patterns, sample_rate, log_format)
+        assert overload in OverloadPolicy.POLICIES, f"Overload policy must be one of {OverloadPolicy.POLICIES}"
+        assert transport in self.TRANSPORTS, f"Transport must be one of {self.TRANSPORTS}"
+        self.transport = transport
+        if transport == self.SHARED_MEMORY:
+            from datalog_http_monitoring.shared_ring import SharedRingQueue
+            self.logs_queue = SharedRingQueue(capacity=queue_size, sources=len(self.sources))
+            queue_size = self.logs_queue.capacity
+        else:
+            self.logs_queue = multiprocessing.Queue(maxsize=queue_size)
+        if metrics:
+            metrics.queue_size = self.logs_queue.qsize
+            metrics.queue_max_size = queue_size
         self.watcher_process = multiprocessing.Process(
             name="LogWatcherProcess",
             target=self.watcher,
-            args=(self.log_files, self.logs_queue),
+            args=(self.sources, self.logs_queue, self.offsets, metrics.watcher_counters if metrics else None,
+                  overload, sample_rate, sample_adaptive, log_format, self.patterns, self.clock),
             daemon=True
         )
 
     @staticmethod
-    def watcher(log_files, logs_queue):
+    def check_options(sources, patterns, sample_rate, log_format):
+        # check that file can be read early
+        for log_file in sources:
+            assert os.path.exists(log_file), f"Log file {log_file!r} must exists"
+            assert os.path.isfile(log_file), f"Log file {log_file!r} must be a file"
+            assert os.access(log_file, os.R_OK), f"Log file {log_file!r} must be a readable"
+        for pattern in patterns:
+            if not expand_log_files([pattern]):
+                logger.warning(f"No log file matches {pattern!r} yet")
+
+        assert 0 < sample_rate <= 1, "Sampling rate must be between 0 (excluded) and 1"
+        if log_format != "auto":
+            # check format early
+            from datalog_http_monitoring.parsers import get_parser
+            get_parser(log_format)
+
+    @staticmethod
+    def watcher(log_files, logs_queue, offsets=None, counters=None, overload="block",
+                sample_rate=1.0, sample_adaptive=False, log_format="auto", patterns=None, clock=None):
+        import heapq
+        from datalog_http_monitoring.parsers import get_parser, detect_file_parser
+
+        profiling.start()
         try:
             logger.info(f"LogConsumerWatcher thread started on {log_files!r}")
-            last_reads = {log_file: 0 for log_file in log_files}
-            positions = {log_file: 0 for log_file in log_files}
+            parser = get_parser(log_format) if log_format != "auto" else None
+            sampler = None
+            if sample_rate < 1 or sample_adaptive:
+                sampler = LineSampler(sample_rate, sample_adaptive, counters)
+            sources_queue = logs_queue
+            logs_queue = OverloadPolicy(logs_queue, overload, counters, sampler)
+            offsets = offsets or {}
+            clock = clock or SYSTEM_CLOCK
+
+            # files to check, ordered by next check time
+            watched_files = [WatchedFile(log_file, source, offsets.get(log_file, 0), parser)
+                             for source, log_file in enumerate(log_files)]
+            heapq.heapify(watched_files)
+            known_files = set(log_files)
+            next_discover = clock.monotonic() + LogCollector.DISCOVER_INTERVAL if patterns else None
+
             while True:
-                # avoid using `stat` too frequently
-                time.sleep(0.1)
+                now = clock.monotonic()
+                profiling.tick()
 
-                for log_file in log_files:
+                if next_discover and now >= next_discover:
+                    next_discover = now + LogCollector.DISCOVER_INTERVAL
+                    for log_file in sorted(expand_log_files(patterns) - known_files):
+                        logger.info(f"Discovered log file {log_file!r}")
+                        watched_file = WatchedFile(log_file, len(known_files), offsets.get(log_file, 0), parser)
+                        known_files.add(log_file)
+                        # never dropped, or the main process would not know the file of next logs
+                        sources_queue.put(NewSource(watched_file.source, log_file))
+                        heapq.heappush(watched_files, watched_file)
+
+                # read due files once each, a file with more lines than `READ_BATCH` waits for the others
+                due_files = []
+                while watched_files and watched_files[0].next_check <= now:
+                    due_files.append(heapq.heappop(watched_files))
+                for watched_file in due_files:
+                    lines = 0
                     try:
-                        last_reads[log_file], positions[log_file] = LogCollector.read_logs(
-                            log_file, logs_queue, last_reads[log_file], positions[log_file])
-                    except AssertionError:
-                        # file has not changed since last read
+                        if watched_file.has_changed():
+                            if not watched_file.parser:
+                                _, watched_file.parser = detect_file_parser(watched_file.path)
+                            # not enough lines to detect format yet otherwise
+                            if watched_file.parser:
+                                lines = watched_file.read(logs_queue, counters, sampler, LogCollector.READ_BATCH)
+                    except FileNotFoundError:
+                        # removed (eg: rotated), it will be read from start if it comes back
                         pass
                     except IOError as err:
-                        logger.error(f"Unable to read {log_file!r}", exc_info=err)
+                        logger.error(f"Unable to read {watched_file.path!r}", exc_info=err)
                     except Exception as err:
-                        logger.error(f"Unable to collect {log_file!r} logs", exc_info=err)
+                        logger.error(f"Unable to collect {watched_file.path!r} logs", exc_info=err)
+                    watched_file.schedule(now, lines, LogCollector.READ_BATCH)
+                    heapq.heappush(watched_files, watched_file)
+
+                # sleep until next file check
+                next_check = watched_files[0].next_check if watched_files else now + WatchedFile.MAX_INTERVAL
+                if next_discover:
+                    next_check = min(next_check, next_discover)
+                delay = next_check - clock.monotonic()
+                if delay > 0:
+                    clock.sleep(delay)
 
         except (KeyboardInterrupt, SystemExit):
             pass
+        finally:
+            profiling.stop()
 
     @staticmethod
-    def read_logs(log_file, logs_queue, last_read, position):
-        # see if log file has changed
-        stats = os.stat(log_file)
-        has_changed = stats.st_mtime > last_read or stats.st_size > position
-        assert has_changed, "No changes"
-        last_read = stats.st_mtime
+    def read_logs(log_file, logs_queue, last_read, position, counters=None, sampler=None, parser=None, source=None):
+        """
+        Read new lines of `log_file` since `position`, see `WatchedFile.read`.
+        Raise an `AssertionError` when the file has not changed since `last_read`.
 
-        # read new log lines
-        # logger.debug(f"Detected new content in {log_file}")
-        with open(log_file, "r", encoding="utf-8") as fd:
-            fd.seek(position)
-            while True:
-                line = fd.readline()
-                if not line:
-                    # logger.debug(f"Finish reading logs in {log_file}")
-                    break
-                log = Log.from_string(line)
-                if log:
-                    logs_queue.put(log)
-                    # note: we only move position once we successfully read
-                    # a log line, that means that if we have garbage or incomplete
-                    # line, we will retry reading until we got a log
-                    position = fd.tell()
-
-        return last_read, position
+        :return: (last_read, position) for the next call
+        """
+        watched_file = WatchedFile(log_file, source, position, parser)
+        watched_file.last_read = last_read
+        assert watched_file.has_changed(), "No changes"
+        watched_file.read(logs_queue, counters, sampler)
+        return watched_file.last_read, watched_file.position
 
     def __iter__(self):
+        metrics = self.metrics
         while True:
             try:
-                yield self.logs_queue.get(block=True, timeout=.5)
+                log = self.logs_queue.get(block=True, timeout=.5)
+                if isinstance(log, NewSource):
+                    assert log.source == len(self.sources), "Sources ids must be sent in order"
+                    self.sources.append(log.path)
+                    continue
+                if metrics:
+                    metrics.logs += 1
+                    metrics.last_event_date = log.date
+                yield log
             except ValueError:
                 # ignore semaphore release bug from Queue when debugging
                 pass
             except Empty:
-                yield EmptyLog()
+                yield EmptyLog(self.clock.utcnow())
 
     def run(self):
         self.watcher_process.start()
-        for log in self:
-            self.feed_consumers(log)
+        try:
+            for log in self:
+                self.feed_consumers(log)
+                profiling.tick()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.transport == self.SHARED_MEMORY:
+            # shared memory outlives processes, unless it is removed
+            self.logs_queue.close()
 
 
 class Log(object):
+    # number of lines this log stands for when lines are sampled
+    weight = 1
+    # only available with some log formats
+    referer = None
+    user_agent = None
+
     def __init__(self, ip, user, date, method, path, status_code, size):
         self.ip = ip
         self.user = user
@@ -113,6 +514,9 @@ class Log(object):
         self.path = path
         self.status_code = status_code
         self.size = size
+        # file and position right after this log, set by the collector
+        self.source = None
+        self.offset = None
 
     @staticmethod
     def from_string(line):
@@ -135,6 +539,6 @@ class Log(object):
 class EmptyLog(Log):
     def __init__(self, date=None):
         if not date:
-            date = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+            date = SYSTEM_CLOCK.utcnow()
         super(EmptyLog, self).__init__(
             ip=None, user=None, method=None, path=None, status_code=None, size=None, date=date,)
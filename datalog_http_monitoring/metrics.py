@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+
+from datalog_http_monitoring.clock import SYSTEM_CLOCK
+
+
+class PipelineMetrics(object):
+    """
+    Cheap counters about datalog itself, to tell if the pipeline is lagging.
+
+    Each component only increments counters or stores a value,
+    rates and derived values are computed in `snapshot` when they are displayed.
+    """
+
+    # indexes of the counters shared with the watcher process
+    LINES_READ, LINES_PARSED, LINES_FAILED, LINES_SKIPPED, LOGS_DROPPED, SAMPLE_EVERY, SAMPLE_RATE = range(7)
+
+    # sampling rate is shared as an integer in parts per million
+    SAMPLE_RATE_SCALE = 1000000
+
+    def __init__(self, clock=None):
+        """
+        :param clock: source of time of rates and lag, default to system time
+        :type clock: Clock
+        """
+        self.clock = clock or SYSTEM_CLOCK
+        # written by the watcher process, read by the main process
+        self.watcher_counters = multiprocessing.RawArray('Q', 7)
+        self.watcher_counters[self.SAMPLE_EVERY] = 1
+        self.watcher_counters[self.SAMPLE_RATE] = self.SAMPLE_RATE_SCALE
+
+        self.logs = 0
+        self.last_event_date = None
+        self.queue_size = None  # callable returning the collector queue size
+        self.queue_max_size = 0
+        self.stages = {}  # consumer => cumulated seconds, excluding the stages it fed
+        self._nested = []  # seconds spent in stages fed by each running stage
+        self.frames = 0
+        self.frame_time = 0.0
+
+        self._last_snapshot = None
+
+    def start_stage(self):
+        self._nested.append(0.0)
+
+    def add_stage_time(self, consumer, elapsed: float):
+        """
+        Record `elapsed` seconds spent in `consumer` since `start_stage`,
+        time of the stages it fed is subtracted so that loads of all stages add up to the pipeline load.
+        """
+        self.stages[consumer] = self.stages.get(consumer, 0.0) + elapsed - self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+
+    def snapshot(self) -> dict:
+        """
+        Compute current metrics, rates are per second since the previous call.
+
+        :return: dict
+        """
+        now = self.clock.monotonic()
+        counters = {
+            "lines_read": self.watcher_counters[self.LINES_READ],
+            "lines_parsed": self.watcher_counters[self.LINES_PARSED],
+            "lines_failed": self.watcher_counters[self.LINES_FAILED],
+            "lines_skipped": self.watcher_counters[self.LINES_SKIPPED],
+            "logs_dropped": self.watcher_counters[self.LOGS_DROPPED],
+            "logs": self.logs,
+        }
+        stages = {getattr(consumer, "__qualname__", repr(consumer)): elapsed
+                  for consumer, elapsed in self.stages.items()}
+
+        previous_time, previous_counters, previous_stages = self._last_snapshot or (now, counters, stages)
+        self._last_snapshot = now, counters, stages
+        elapsed = now - previous_time
+
+        data = dict(counters)
+        for name in ("lines_read", "lines_parsed", "logs"):
+            data[f"{name}_rate"] = (counters[name] - previous_counters[name]) / elapsed if elapsed else 0.0
+        # share of wall time spent in each consumer
+        data["stages_load"] = {
+            name: (stage_time - previous_stages.get(name, 0.0)) / elapsed if elapsed else 0.0
+            for name, stage_time in stages.items()
+        }
+        data["stages_time"] = stages
+
+        try:
+            data["queue_size"] = self.queue_size() if self.queue_size else None
+        except NotImplementedError:  # pragma: no cover
+            # qsize is not available on macOS
+            data["queue_size"] = None
+        data["queue_max_size"] = self.queue_max_size
+        data["sample_every"] = self.watcher_counters[self.SAMPLE_EVERY]
+        # share of read lines that reach the statistics, from line sampling and overload sampling
+        data["sample_rate"] = self.watcher_counters[self.SAMPLE_RATE] / self.SAMPLE_RATE_SCALE / data["sample_every"]
+
+        data["lag"] = None
+        if self.last_event_date:
+            data["lag"] = (self.clock.utcnow() - self.last_event_date).total_seconds()
+
+        data["frames"] = self.frames
+        data["frame_time"] = self.frame_time
+        return data
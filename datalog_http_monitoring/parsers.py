@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Log line parsers for the common, combined and JSON access log formats,
+or for a user declared format string.
+
+Each format is compiled once into a parse function taking a line and returning a `Log` (or None),
+the collector detects the format of each file from its first lines with `detect_parser`.
+
+A format string uses nginx `log_format` variables, eg: the combined format is
+
+    $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+"""
+
+import re
+import json
+import logging
+import datetime
+import functools
+
+from ipaddress import ip_address
+
+from datalog_http_monitoring.log_collector import Log
+
+
+logger = logging.getLogger(__name__)
+
+# lines used to detect the format of a file
+DETECT_LINES = 20
+
+MONTHS = {month: index for index, month in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+
+# name => parse function, detection tries them in this order (most specific first)
+PARSERS = {}
+
+
+def register_parser(name: str, parser):
+    """
+    Register a parse function, it will be available with `get_parser` and tried by `detect_parser`.
+
+    :param name: format name
+    :type name: str
+    :param parser: function taking a line and returning a `Log` or None when it can't be parsed
+    :type parser: callable
+    """
+    PARSERS[name] = parser
+
+
+# logs of a same second and from a same client share these values, parsing them only once is much faster
+@functools.lru_cache(maxsize=4096)
+def parse_clf_date(date_str: str) -> datetime.datetime:
+    """
+    Parse a common log format date (eg: "09/May/2018:16:00:39 +0000"), much faster than `strptime`
+    """
+    day, month, rest = date_str.split("/", 2)
+    year, hour, minute, second_tz = rest.split(":", 3)
+    second, tz = second_tz.split(" ", 1)
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+    return datetime.datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second),
+                             tzinfo=_timezone(-offset if tz[0] == "-" else offset))
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_iso_date(date_str: str) -> datetime.datetime:
+    date = datetime.datetime.fromisoformat(date_str.replace("Z", "+00:00"))
+    return date if date.tzinfo else date.replace(tzinfo=datetime.timezone.utc)
+
+
+@functools.lru_cache(maxsize=64)
+def _timezone(offset: datetime.timedelta) -> datetime.timezone:
+    return datetime.timezone(offset)
+
+
+parse_ip = functools.lru_cache(maxsize=65536)(ip_address)
+
+
+def _make_log(ip, user, date, method, path, status, size, referer=None, user_agent=None) -> Log:
+    log = Log(
+        ip=parse_ip(ip),
+        user=user if user and user != "-" else None,
+        date=date,
+        method=method,
+        path=path,
+        status_code=int(status),
+        size=int(size) if size and size != "-" else 0,
+    )
+    if referer and referer != "-":
+        log.referer = referer
+    if user_agent and user_agent != "-":
+        log.user_agent = user_agent
+    return log
+
+
+# nginx variables => (regex group name, pattern)
+FORMAT_VARIABLES = {
+    "remote_addr": ("ip", r"\S+"),
+    "remote_user": ("user", r"\S+"),
+    "time_local": ("date", r"[^\]]+"),
+    "time_iso8601": ("date_iso", r"\S+"),
+    "request": ("request", r"[^\"]*"),
+    "request_method": ("method", r"[A-Z]+"),
+    "request_uri": ("path", r"\S+"),
+    "uri": ("path", r"\S+"),
+    "status": ("status", r"\d{3}"),
+    "body_bytes_sent": ("size", r"\d+|-"),
+    "bytes_sent": ("size", r"\d+|-"),
+    "http_referer": ("referer", r"[^\"]*"),
+    "http_user_agent": ("user_agent", r"[^\"]*"),
+}
+
+
+def compile_format(log_format: str):
+    """
+    Compile a format string using nginx variables (see `FORMAT_VARIABLES`) into a parse function.
+    Unknown variables are matched but ignored.
+
+    :param log_format: a format string, eg: '$remote_addr - $remote_user [$time_local] "$request" $status'
+    :type log_format: str
+    :return: parse function
+    """
+    pattern = []
+    groups = set()
+    position = 0
+    for variable in re.finditer(r"\$(\w+)", log_format):
+        pattern.append(re.escape(log_format[position:variable.start()]))
+        position = variable.end()
+        group, group_pattern = FORMAT_VARIABLES.get(variable.group(1), (None, r".*?"))
+        if group and group not in groups:
+            groups.add(group)
+            pattern.append(f"(?P<{group}>{group_pattern})")
+        else:
+            pattern.append(f"(?:{group_pattern})")
+    pattern.append(re.escape(log_format[position:]))
+
+    assert "ip" in groups, "Log format must contain $remote_addr"
+    assert "status" in groups, "Log format must contain $status"
+    assert {"date", "date_iso"} & groups, "Log format must contain $time_local or $time_iso8601"
+    assert "request" in groups or {"method", "path"} <= groups, \
+        "Log format must contain $request or $request_method and $request_uri"
+
+    match = re.compile("".join(pattern)).match
+    parse_date = parse_clf_date if "date" in groups else parse_iso_date
+    date_group = "date" if "date" in groups else "date_iso"
+
+    def parse(line: str):
+        matched = match(line)
+        if not matched:
+            return None
+        values = matched.groupdict()
+        try:
+            if "request" in values:
+                method, path, *_ = values["request"].split(" ")
+            else:
+                method, path = values["method"], values["path"]
+            return _make_log(values["ip"], values.get("user"), parse_date(values[date_group]), method, path,
+                             values["status"], values.get("size"), values.get("referer"), values.get("user_agent"))
+        except (ValueError, KeyError):
+            return None
+
+    return parse
+
+
+# 127.0.0.1 - james [09/May/2018:16:00:39 +0000] "GET /report HTTP/1.0" 200 123
+COMMON_REGEX = r'(\S+) \S+ (\S+) \[([^\]]+)\] "(\S+) (\S+)[^"]*" (\d{3}) (\d+|-)'
+
+
+def _compile_common(combined: bool):
+    # hand written specializations of `compile_format` for the most used formats
+    if combined:
+        match = re.compile(COMMON_REGEX + r' "([^"]*)" "([^"]*)"').match
+    else:
+        # extra trailing fields (eg: a response time) are ignored, combined is detected before common
+        match = re.compile(COMMON_REGEX + r"(?:\s.*)?$").match
+
+    def parse(line: str):
+        matched = match(line)
+        if not matched:
+            return None
+        try:
+            if combined:
+                ip, user, date, method, path, status, size, referer, user_agent = matched.groups()
+                return _make_log(ip, user, parse_clf_date(date), method, path, status, size, referer, user_agent)
+            ip, user, date, method, path, status, size = matched.groups()
+            return _make_log(ip, user, parse_clf_date(date), method, path, status, size)
+        except (ValueError, KeyError):
+            return None
+
+    return parse
+
+
+# JSON keys of each field, in order of preference
+JSON_KEYS = {
+    "ip": ("remote_addr", "ip", "client_ip", "clientip"),
+    "user": ("remote_user", "user"),
+    "time_local": ("time_local",),
+    "time_iso": ("time_iso8601", "time", "timestamp", "@timestamp"),
+    "request": ("request",),
+    "method": ("request_method", "method"),
+    "path": ("request_uri", "uri", "path"),
+    "status": ("status", "status_code"),
+    "size": ("body_bytes_sent", "bytes_sent", "size", "bytes"),
+    "referer": ("http_referer", "referer"),
+    "user_agent": ("http_user_agent", "user_agent"),
+}
+
+
+def _json_get(values: dict, field: str):
+    for key in JSON_KEYS[field]:
+        value = values.get(key)
+        if value is not None:
+            return str(value)
+    return None
+
+
+def parse_json(line: str):
+    """
+    Parse a JSON access log line, as produced by nginx `log_format escape=json`
+    """
+    if not line.startswith("{"):
+        return None
+    try:
+        values = json.loads(line)
+        if "request" in values:
+            method, path, *_ = values["request"].split(" ")
+        else:
+            method, path = _json_get(values, "method"), _json_get(values, "path")
+        time_local = _json_get(values, "time_local")
+        date = parse_clf_date(time_local) if time_local else parse_iso_date(_json_get(values, "time_iso"))
+        return _make_log(_json_get(values, "ip"), _json_get(values, "user"), date, method, path,
+                         _json_get(values, "status"), _json_get(values, "size"),
+                         _json_get(values, "referer"), _json_get(values, "user_agent"))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+register_parser("json", parse_json)
+register_parser("combined", _compile_common(combined=True))
+register_parser("common", _compile_common(combined=False))
+
+
+def get_parser(log_format: str):
+    """
+    Get the parse function of a registered format, or compile a format string.
+
+    :param log_format: a registered format name or a format string
+    :type log_format: str
+    :return: parse function
+    """
+    if log_format in PARSERS:
+        return PARSERS[log_format]
+    assert "$" in log_format, f"Log format must be one of {', '.join(PARSERS)} or a format string"
+    return compile_format(log_format)
+
+
+def detect_parser(lines):
+    """
+    Find which registered format parses the most lines.
+
+    :param lines: some log lines
+    :type lines: list
+    :return: (format name, parse function) or (None, None) when no format parses any line
+    """
+    best_name, best_parser, best_parsed = None, None, 0
+    for name, parser in PARSERS.items():
+        parsed = sum(1 for line in lines if parser(line))
+        if parsed > best_parsed:
+            best_name, best_parser, best_parsed = name, parser, parsed
+    return best_name, best_parser
+
+
+def detect_file_parser(log_file: str):
+    """
+    Detect a file format from its first complete lines.
+
+    :param log_file: path of a log file
+    :type log_file: str
+    :return: (format name, parse function) or (None, None) when the file has no complete line yet,
+             lines of an unknown format are parsed with `Log.from_string`
+    """
+    with open(log_file, "r", encoding="utf-8") as fd:
+        lines = []
+        for line in fd:
+            if not line.endswith("\n") or len(lines) >= DETECT_LINES:
+                break
+            lines.append(line)
+    name, parser = detect_parser(lines)
+    if name:
+        logger.info(f"Detected {name} log format for {log_file!r}")
+    elif lines:
+        logger.warning(f"Unknown log format for {log_file!r}, lines are parsed as space separated fields")
+        return None, Log.from_string
+    return name, parser
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Built-in profiling of every datalog process.
+
+Configuration is stored in environment variables by `setup` so that every process
+started afterward (log watcher, log generators) inherits it and profiles itself with `start`.
+cProfile only profiles the thread which enables it, so worker threads doing the actual work (asyncio collector
+reader, agent sender, aggregator connections, archive writer) profile themselves with `start_thread`.
+Each process and profiled thread periodically writes (and on exit) in the profiling directory:
+  - `<process>.<pid>.prof`: cProfile stats, readable with `pstats` or snakeviz
+  - `<process>.<pid>.txt`: a summary of the top hot spots and allocation sites
+Threads files are named `<process>-<thread>.<pid>.*`.
+"""
+
+import io
+import os
+import re
+import time
+import signal
+import logging
+import threading
+import tracemalloc
+import multiprocessing
+
+
+logger = logging.getLogger(__name__)
+
+ENV_DIR = "DATALOG_PROFILE"
+ENV_MEMORY = "DATALOG_PROFILE_MEMORY"
+ENV_INTERVAL = "DATALOG_PROFILE_INTERVAL"
+
+SUMMARY_LINES = 20
+
+# profiler of the current process
+_profiler = None
+# profilers of other threads of the current process
+_thread = threading.local()
+
+
+class Profiler(object):
+    def __init__(self, output_dir: str, name: str, trace_memory: bool = False, interval: float = 60):
+        """
+        Profile current thread and write stats to `output_dir`, must be created, ticked and stopped from this thread.
+
+        :param output_dir: directory where stats are written
+        :type output_dir: str
+        :param name: process name used in files names
+        :type name: str
+        :param trace_memory: also trace memory allocations (slow)
+        :type trace_memory: bool
+        :param interval: delay in seconds between two dumps
+        :type interval: float
+        """
+        self.pid = os.getpid()
+        self.thread = threading.get_ident()
+        self.trace_memory = trace_memory
+        self.interval = interval
+        self.next_dump = time.monotonic() + interval
+        name = re.sub(r"[^\w.-]+", "_", name)
+        self.path = os.path.join(output_dir, f"{name}.{self.pid}")
+
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.dump()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def tick(self):
+        if time.monotonic() >= self.next_dump:
+            self.profile.disable()
+            try:
+                self.dump()
+            finally:
+                self.profile.enable()
+
+    def dump(self):
+        self.next_dump = time.monotonic() + self.interval
+        try:
+            self.profile.dump_stats(f"{self.path}.prof")
+            with open(f"{self.path}.txt", "w", encoding="utf-8") as fd:
+                fd.write(self.summary())
+        except Exception as err:
+            logger.error(f"Unable to write profiling stats to {self.path!r}", exc_info=err)
+
+    def summary(self) -> str:
+        import pstats
+
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output)
+        for sort_key, label in ((pstats.SortKey.CUMULATIVE, "cumulative time"), (pstats.SortKey.TIME, "own time")):
+            output.write(f"=== Top {SUMMARY_LINES} functions by {label} ===\n")
+            stats.sort_stats(sort_key).print_stats(SUMMARY_LINES)
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            output.write(f"=== Top {SUMMARY_LINES} allocation sites "
+                         f"(current: {current / 1024:,.0f}KiB, peak: {peak / 1024:,.0f}KiB) ===\n")
+            for statistic in tracemalloc.take_snapshot().statistics("lineno")[:SUMMARY_LINES]:
+                output.write(f"{statistic}\n")
+        return output.getvalue()
+
+
+def setup(output_dir: str, trace_memory: bool = False, interval: float = 60):
+    """
+    Enable profiling of current process and of every process started afterward.
+
+    :param output_dir: directory where stats are written
+    :type output_dir: str
+    :param trace_memory: also trace memory allocations (slow)
+    :type trace_memory: bool
+    :param interval: delay in seconds between two dumps
+    :type interval: float
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    os.environ[ENV_DIR] = os.path.abspath(output_dir)
+    os.environ[ENV_MEMORY] = "1" if trace_memory else ""
+    os.environ[ENV_INTERVAL] = str(interval)
+    start()
+
+
+def _exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def start(name: str = None):
+    """
+    Start profiling current process if profiling has been set up (see `setup`).
+    Daemon processes are terminated with SIGTERM, it raises `SystemExit` so that they `stop` profiling on exit.
+
+    :param name: process name, default to `multiprocessing` process name
+    :type name: str
+    """
+    global _profiler
+    output_dir = os.environ.get(ENV_DIR)
+    if not output_dir:
+        return
+
+    if _profiler:
+        # profiler inherited from parent process through fork
+        _profiler.profile.disable()
+
+    name = name or multiprocessing.current_process().name
+    _profiler = Profiler(output_dir, name, bool(os.environ.get(ENV_MEMORY)), float(os.environ.get(ENV_INTERVAL, 60)))
+    _profiler.start()
+    if threading.current_thread() is threading.main_thread() \
+            and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _exit)
+    logger.info(f"Profiling {name} to {_profiler.path!r}")
+
+
+def start_thread(name: str = None):
+    """
+    Start profiling current thread if profiling has been set up (see `setup`), stop it with `stop` from this thread.
+    Memory tracing is process wide, it is left to the process profiler.
+
+    :param name: thread name, default to `threading` thread name
+    :type name: str
+    """
+    output_dir = os.environ.get(ENV_DIR)
+    if not output_dir or getattr(_thread, "profiler", None) is not None:
+        return
+
+    name = f"{multiprocessing.current_process().name}-{name or threading.current_thread().name}"
+    profiler = Profiler(output_dir, name, interval=float(os.environ.get(ENV_INTERVAL, 60)))
+    try:
+        profiler.start()
+    except ValueError:
+        # python >= 3.12 allows a single active profiler, the process one which also sees this thread
+        logger.debug(f"Thread {name} profiled by its process profiler")
+        return
+    _thread.profiler = profiler
+    logger.info(f"Profiling {name} to {profiler.path!r}")
+
+
+def _current():
+    profiler = getattr(_thread, "profiler", None) or _profiler
+    if profiler is not None and profiler.pid == os.getpid() and profiler.thread == threading.get_ident():
+        return profiler
+    return None
+
+
+def tick():
+    """
+    Periodically dump stats, must be called regularly from the process (or profiled thread) main loop.
+    Costs nothing when profiling is disabled.
+    """
+    profiler = _current()
+    if profiler is not None:
+        profiler.tick()
+
+
+def stop():
+    """
+    Stop profiling current thread (see `start_thread`), or current process, and write final stats.
+    """
+    global _profiler
+    profiler = getattr(_thread, "profiler", None)
+    if profiler is not None:
+        _thread.profiler = None
+        if profiler.pid == os.getpid():
+            profiler.stop()
+        return
+    if _profiler is not None and _profiler.pid == os.getpid():
+        _profiler.stop()
+    _profiler = None
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Shared memory transport of logs between the watcher process and the main process.
+
+`SharedRingQueue` is a single producer / single consumer ring buffer of fixed width records
+in `multiprocessing.shared_memory`, it has the `Queue` methods used by the collector so it can replace it.
+Logs are written in place with `struct`, without pickling nor copy through a pipe.
+
+Record fields that are not numbers (ip, user, method, path, referer, user agent) are replaced by ids:
+new values of a record are sent once in a single message through a side `multiprocessing.Queue`
+along with `NewSource` messages, the consumer waits for the definition of an id it does not know yet.
+
+Values get an id per epoch of at most `MAX_VALUES` values, so that both dictionaries stay bounded
+with unbounded values (paths with ids, user agents): ids keep increasing across epochs
+and the consumer forgets the values of an epoch two epochs later.
+An epoch starts once all records of the epoch before the previous one have been read.
+
+Waiting sides block on semaphores counting the records and the free slots of the ring.
+The segment is named after its owner process, which removes it on exit and, on startup,
+removes the segments of owners that died without doing so (shared memory outlives processes).
+"""
+
+import os
+import atexit
+import struct
+import datetime
+import functools
+import multiprocessing
+
+from queue import Empty, Full
+from collections import deque
+
+from datalog_http_monitoring.log_collector import Log, NewSource
+
+
+# date timestamp, utc offset in minutes, status code, size, weight, source, offset,
+# ids of ip, user, method, path, referer and user agent (0 for None)
+RECORD = struct.Struct("<dhHQdIQ6I")
+INDEX = struct.Struct("<Q")
+
+# write and read indexes are counters of records, kept on distinct cache lines
+WRITE_INDEX_OFFSET = 0
+READ_INDEX_OFFSET = 64
+RECORDS_OFFSET = 128
+
+NO_SOURCE = 0xFFFFFFFF
+
+# number of distinct values of an epoch, ids wrap around after `MAX_ID`
+MAX_VALUES = 1 << 20
+MAX_ID = 0xFFFFFFFF
+
+# segments are named "{SEGMENT_PREFIX}{owner pid}_{random}" in `SHM_DIR`
+SEGMENT_PREFIX = "datalog_ring_"
+SHM_DIR = "/dev/shm"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def unlink_stale_segments():
+    """
+    Remove the segments of rings whose owner process is dead, eg: killed before closing its ring.
+    Does nothing where shared memory segments are not listed in `SHM_DIR`.
+    """
+    try:
+        names = os.listdir(SHM_DIR)
+    except OSError:
+        return
+    for name in names:
+        pid = name[len(SEGMENT_PREFIX):].partition("_")[0]
+        if name.startswith(SEGMENT_PREFIX) and pid.isdigit() and not _pid_alive(int(pid)):
+            try:
+                os.unlink(os.path.join(SHM_DIR, name))
+            except OSError:
+                pass
+
+
+@functools.lru_cache(maxsize=64)
+def _timezone(minutes: int) -> datetime.timezone:
+    return datetime.timezone(datetime.timedelta(minutes=minutes))
+
+
+class SharedRingQueue(object):
+    DEFAULT_CAPACITY = 65536
+
+    def __init__(self, capacity: int = 0, sources: int = 0):
+        """
+        Create the shared memory, must be done before starting the watcher process.
+        It is removed by `close`, or when the owner process exits.
+
+        :param capacity: maximum number of records waiting to be read, 0 for `DEFAULT_CAPACITY`
+        :type capacity: int
+        :param sources: number of sources known by both processes, later ones are announced with `NewSource`
+        :type sources: int
+        """
+        from multiprocessing import shared_memory
+
+        unlink_stale_segments()
+        self.capacity = capacity or self.DEFAULT_CAPACITY
+        self.memory = shared_memory.SharedMemory(name=f"{SEGMENT_PREFIX}{os.getpid()}_{os.urandom(4).hex()}",
+                                                 create=True, size=RECORDS_OFFSET + self.capacity * RECORD.size)
+        self.buffer = self.memory.buf
+        self.closed = False
+        atexit.register(self.close)
+        INDEX.pack_into(self.buffer, WRITE_INDEX_OFFSET, 0)
+        INDEX.pack_into(self.buffer, READ_INDEX_OFFSET, 0)
+        self.definitions = multiprocessing.Queue()
+        # released for each record written, and each record read
+        self.records = multiprocessing.Semaphore(0)
+        self.free_slots = multiprocessing.Semaphore(self.capacity)
+
+        # producer side
+        self.ids = {}
+        self.next_id = 1
+        self.epoch = 0
+        self.epoch_start = 0  # write index of the first record of the current epoch
+        self.new_values = []
+        self.write_index = 0
+        # consumer side
+        self.values = {0: None}
+        self.values_epoch = 0
+        self.epochs_ids = deque([[]])  # ids of the previous and current epochs
+        self.sources = sources
+        self.read_index = 0
+        self.pending = deque()
+
+    def qsize(self) -> int:
+        return INDEX.unpack_from(self.buffer, WRITE_INDEX_OFFSET)[0] \
+               - INDEX.unpack_from(self.buffer, READ_INDEX_OFFSET)[0] + len(self.pending)
+
+    def put_nowait(self, log):
+        self.put(log, block=False)
+
+    def put(self, log, block: bool = True, timeout: float = None):
+        """
+        Write a `Log` (or a `NewSource`) in the ring, raise `Full` when not `block`ing and there is no room.
+        """
+        if isinstance(log, NewSource):
+            self.definitions.put(log)
+            return
+
+        if not self.free_slots.acquire(block, timeout):
+            raise Full
+
+        if len(self.ids) >= MAX_VALUES \
+                and INDEX.unpack_from(self.buffer, READ_INDEX_OFFSET)[0] >= self.epoch_start:
+            self.epoch += 1
+            self.epoch_start = self.write_index
+            self.ids = {}
+
+        date = log.date
+        ids = (self._id(log.ip), self._id(log.user), self._id(log.method), self._id(log.path),
+               self._id(log.referer), self._id(log.user_agent))
+        if self.new_values:
+            self.definitions.put((self.epoch, self.new_values))
+            self.new_values = []
+        RECORD.pack_into(
+            self.buffer, RECORDS_OFFSET + (self.write_index % self.capacity) * RECORD.size,
+            date.timestamp(), int(date.utcoffset().total_seconds()) // 60, log.status_code, log.size, log.weight,
+            NO_SOURCE if log.source is None else log.source, log.offset or 0, *ids)
+        # publish the record once written
+        self.write_index += 1
+        INDEX.pack_into(self.buffer, WRITE_INDEX_OFFSET, self.write_index)
+        self.records.release()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Read the next `Log` (or `NewSource`) from the ring, raise `Empty` when not `block`ing and there is none.
+        """
+        if self.pending:
+            return self.pending.popleft()
+
+        if not self.records.acquire(block, timeout):
+            raise Empty
+
+        date, utc_offset, status_code, size, weight, source, offset, *ids = RECORD.unpack_from(
+            self.buffer, RECORDS_OFFSET + (self.read_index % self.capacity) * RECORD.size)
+        self.read_index += 1
+        INDEX.pack_into(self.buffer, READ_INDEX_OFFSET, self.read_index)
+        self.free_slots.release()
+
+        # definitions are sent before the first record using them
+        values = self.values
+        while any(value_id not in values for value_id in ids) \
+                or (source != NO_SOURCE and source >= self.sources):
+            self._receive_definition()
+        ip, user, method, path, referer, user_agent = (values[value_id] for value_id in ids)
+
+        log = Log(ip, user, datetime.datetime.fromtimestamp(date, _timezone(utc_offset)), method, path,
+                  status_code, size)
+        if referer is not None:
+            log.referer = referer
+        if user_agent is not None:
+            log.user_agent = user_agent
+        if weight != 1:
+            log.weight = weight
+        log.source = None if source == NO_SOURCE else source
+        log.offset = offset
+        self.pending.append(log)
+        return self.pending.popleft()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.memory.close()
+        self.memory.unlink()
+
+    def _id(self, value) -> int:
+        if value is None:
+            return 0
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = self.next_id
+            self.next_id = self.next_id % MAX_ID + 1
+            self.new_values.append((value_id, value))
+        return value_id
+
+    def _receive_definition(self):
+        definition = self.definitions.get()
+        if isinstance(definition, NewSource):
+            self.sources = max(self.sources, definition.source + 1)
+            self.pending.append(definition)
+        else:
+            epoch, new_values = definition
+            if epoch != self.values_epoch:
+                # records of the epoch before the previous one have all been read, forget its values
+                self.values_epoch = epoch
+                self.epochs_ids.append([])
+                if len(self.epochs_ids) > 2:
+                    for value_id in self.epochs_ids.popleft():
+                        del self.values[value_id]
+            self.values.update(new_values)
+            self.epochs_ids[-1].extend(value_id for value_id, _ in new_values)
+
+    def __getstate__(self):
+        # the ring is sent to the watcher process, which attaches to the same shared memory
+        state = dict(self.__dict__)
+        state["memory"] = self.memory.name
+        del state["buffer"]
+        return state
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=state["memory"])
+        self.buffer = self.memory.buf
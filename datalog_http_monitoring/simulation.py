@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic simulation of the traffic alerting over hours or days of generated logs.
+
+`LogGenerator` runs in live mode on a `SimulatedClock`: waiting between two logs only moves the simulated time,
+so a day of traffic is replayed in seconds. Logs and the empty logs the collector sends while files are idle
+are fed to `HTTPLogsStats`, then alerts are checked against the specification:
+
+  - an alert is triggered by the first log for which the average requests rate of the last `alert_period` seconds
+    is above the threshold, and recovered by the first log for which it is back under the threshold
+    (minus its 10% margin)
+  - each spam period of the generator, at least `alert_period` long, triggers an alert within `alert_period`,
+    which recovers within `alert_period` after the spam period ends
+
+    $ python -m datalog_http_monitoring.simulation --hours 48 --seed 1
+"""
+
+import sys
+import time
+import logging
+import argparse
+import datetime
+
+from collections import deque
+
+from datalog_http_monitoring.clock import SimulatedClock
+from datalog_http_monitoring.generate_logs import LogGenerator
+from datalog_http_monitoring.log_collector import EmptyLog
+from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
+
+
+logger = logging.getLogger(__name__)
+
+START_DATE = datetime.datetime(2018, 5, 9, 16, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+class Simulation(object):
+    # delay in seconds without logs before the collector sends an empty log
+    TICK_INTERVAL = 0.5
+
+    def __init__(self, hours: float = 24, alert_threshold: int = 2, alert_period: int = 120, period: int = 10,
+                 spam_each: int = 600, spam_duration_max: int = 300, seed: int = 0, start: datetime.datetime = None):
+        """
+        Generate `hours` of traffic, normal traffic is about half of `alert_threshold` and spam periods twice it.
+
+        :param hours: duration of simulated traffic
+        :type hours: float
+        :param alert_threshold: requests per seconds limit before triggering an alert
+        :type alert_threshold: int
+        :param alert_period: duration in seconds of alert monitoring, also minimum duration of spam periods
+        :type alert_period: int
+        :param period: duration in seconds of periodic statistics
+        :type period: int
+        :param spam_each: duration in seconds of normal traffic between spam periods
+        :type spam_each: int
+        :param spam_duration_max: maximum duration in seconds of spam periods beyond `alert_period`
+        :type spam_duration_max: int
+        :param seed: random seed of the generated traffic
+        :type seed: int
+        :param start: date of the first log (default to `START_DATE`)
+        :type start: datetime.datetime
+        """
+        assert hours > 0, "Simulated duration must be positive"
+        self.hours = hours
+        self.alert_threshold = alert_threshold
+        self.alert_period = alert_period
+        self.clock = SimulatedClock(start or START_DATE)
+        self.generator = LogGenerator(users=20, files=30, ips=20, threshold_requests=alert_threshold,
+                                      threshold_period=alert_period, threshold_duration_max=spam_duration_max,
+                                      threshold_trigger_each=spam_each, seed=seed, clock=self.clock)
+        self.stats = HTTPLogsStats(period=period, alert_period=alert_period, alert_threshold=alert_threshold,
+                                   clock=self.clock)
+        self.dates = []  # timestamps of all logs
+        self.end = None
+
+    def run(self) -> int:
+        """
+        Feed generated logs to statistics until the simulated duration is over.
+
+        :return: number of logs
+        """
+        from datalog_http_monitoring.parsers import get_parser
+
+        clock, stats = self.clock, self.stats
+        parse = get_parser("common")
+        self.end = clock.time() + self.hours * 3600
+        next_tick = clock.time() + self.TICK_INTERVAL
+        for line in self.generator.generate(live=True):
+            log = parse(line)
+            timestamp = log.date.timestamp()
+            while next_tick < timestamp:
+                stats.update(EmptyLog(datetime.datetime.fromtimestamp(next_tick, datetime.timezone.utc)))
+                next_tick += self.TICK_INTERVAL
+            if timestamp >= self.end:
+                break
+            stats.update(log)
+            self.dates.append(timestamp)
+            next_tick = timestamp + self.TICK_INTERVAL
+        return len(self.dates)
+
+    def expected_alerts(self):
+        """
+        Alerts the specification expects from simulated logs.
+
+        :return: list of [trigger timestamp, recover timestamp or None]
+        """
+        threshold = self.alert_threshold
+        recover_threshold = threshold - threshold / 10
+        window = deque()
+        alerts = []
+        for timestamp in self.dates:
+            window.append(timestamp)
+            while window[0] <= timestamp - self.alert_period:
+                window.popleft()
+            rate = len(window) / self.alert_period
+            if alerts and alerts[-1][1] is None:
+                if rate <= recover_threshold:
+                    alerts[-1][1] = timestamp
+            elif rate > threshold:
+                alerts.append([timestamp, None])
+        return alerts
+
+    def check(self):
+        """
+        Compare alerts with the specification, see module documentation.
+
+        :return: list of differences, empty when alerting is right
+        """
+        errors = []
+        alerts = [[alert.triggered.timestamp(), alert.end.timestamp() if alert.finished else None]
+                  for alert in self.stats.alerts]
+        expected = self.expected_alerts()
+        if len(alerts) != len(expected):
+            errors.append(f"{len(alerts)} alerts instead of {len(expected)}")
+        for (triggered, recovered), (expected_triggered, expected_recovered) in zip(alerts, expected):
+            if triggered != expected_triggered:
+                errors.append(f"Alert triggered at {self._fmt(triggered)} instead of {self._fmt(expected_triggered)}")
+            if recovered != expected_recovered:
+                errors.append(f"Alert triggered at {self._fmt(triggered)} recovered at {self._fmt(recovered)} "
+                              f"instead of {self._fmt(expected_recovered)}")
+
+        for start, end in self.generator.spam_periods:
+            start = start.timestamp()
+            end = end.timestamp() if end else None
+            if start + self.alert_period >= self.end or (end and end + self.alert_period >= self.end):
+                # cut by the end of the simulation
+                continue
+            alert = next((alert for alert in alerts if start <= alert[0] <= start + self.alert_period), None)
+            if not alert:
+                errors.append(f"No alert within {self.alert_period}s of spam period started at {self._fmt(start)}")
+            elif end and (alert[1] is None or alert[1] > end + self.alert_period):
+                errors.append(f"Alert of spam period ended at {self._fmt(end)} not recovered within "
+                              f"{self.alert_period}s")
+        return errors
+
+    @staticmethod
+    def _fmt(timestamp: float) -> str:
+        if timestamp is None:
+            return "never"
+        return f"{datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc):%d/%m/%y %H:%M:%S}"
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Check alerting over hours of simulated traffic")
+    parser.add_argument("--hours", help="simulated duration (default: %(default)s)", default=24, type=float)
+    parser.add_argument("--alert", help="alert threshold in requests per second (default: %(default)s)",
+                        metavar="THRESHOLD", default=2, type=int)
+    parser.add_argument("--alert-period", help="alert period in seconds (default: %(default)s)",
+                        default=120, type=int)
+    parser.add_argument("--seed", help="random seed of the traffic (default: %(default)s)", default=0, type=int)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    try:
+        simulation = Simulation(hours=args.hours, alert_threshold=args.alert, alert_period=args.alert_period,
+                                seed=args.seed)
+    except AssertionError as err:
+        print(f"Error: {err}")
+        sys.exit(2)
+
+    start = time.perf_counter()
+    logs = simulation.run()
+    errors = simulation.check()
+    print(f"{args.hours:g} hours simulated in {time.perf_counter() - start:.1f}s: {logs} logs, "
+          f"{len(simulation.stats.alerts)} alerts, {len(simulation.generator.spam_periods)} spam periods")
+    for error in errors:
+        print(f"Error: {error}")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from ipaddress import ip_address
+
+from datalog_http_monitoring.log_collector import Log
+
+
+START = datetime.datetime(2018, 5, 9, 16, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def make_log(second: float, source: int = 0, path: str = None, status_code: int = 200, weight: float = 1) -> Log:
+    """
+    A log `second` seconds after `START`, its ip, user, path, size and offset vary with `second`.
+    """
+    index = int(second)
+    log = Log(ip_address(f"10.0.0.{index % 4}"), "james" if index % 2 else None,
+              START + datetime.timedelta(seconds=second), "GET", path or f"/api/user/{index % 3}", status_code,
+              100 + index)
+    log.source, log.offset = source, index
+    if weight != 1:
+        log.weight = weight
+    return log
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import tempfile
+import threading
+
+from unittest import TestCase, mock
+
+from datalog_http_monitoring.log_collector import EmptyLog, WatchedFile
+from datalog_http_monitoring.async_log_collector import AsyncLogCollector
+
+
+LINE = '127.0.0.1 - james [09/May/2018:16:00:39 +0000] "GET /report HTTP/1.0" 200 123\n'
+
+
+class TestAsyncLogCollector(TestCase):
+    def test_collect(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "access.log"), "w", encoding="utf-8") as fd:
+                fd.write(LINE * 2500)  # more than a read batch
+
+            collector = AsyncLogCollector(log_files={tmp_dir}, tick_interval=0.1)
+            logs = []
+            collector.add_consumer(logs.append)
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(collector.collect(), 1))
+
+        assert len([log for log in logs if not isinstance(log, EmptyLog)]) == 2500
+        assert isinstance(logs[-1], EmptyLog), "Consumers should be fed even without new logs"
+
+    def test_checks_off_loop(self):
+        threads = set()
+        has_changed = WatchedFile.has_changed
+
+        def check(watched_file):
+            threads.add(threading.current_thread().name)
+            return has_changed(watched_file)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "access.log"), "w", encoding="utf-8") as fd:
+                fd.write(LINE)
+
+            collector = AsyncLogCollector(log_files={tmp_dir}, tick_interval=0.1)
+            with mock.patch.object(WatchedFile, "has_changed", check), self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(collector.collect(), 0.5))
+
+        assert threads and all(name.startswith("LogReader") for name in threads), \
+            "Files should only be checked in the reader thread"
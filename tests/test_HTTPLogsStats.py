@@ -2,13 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import gzip
 import tempfile
 
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from datalog_http_monitoring.generate_logs import LogGenerator
-from datalog_http_monitoring.log_collector import Log
-from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
+from datalog_http_monitoring.log_collector import Log, LineSampler
+from datalog_http_monitoring.cli_swag import CliSwag, n_fmt, size_fmt
+from datalog_http_monitoring.http_logs_stats import HTTPLogsStats, HTTPStats, HTTPStatsSections
+
+from tests import make_log
 
 
 class TestHTTPLogsStats(TestCase):
@@ -38,3 +42,133 @@ class TestHTTPLogsStats(TestCase):
 
         assert self.http_log_stats.alerts, "An alert should have been triggered"
         assert os.path.getsize(self.tmp_file), "Alert should have been written to file"
+        with open(self.tmp_file, encoding="utf-8") as fd:
+            assert f"triggered at {self.http_log_stats.alerts[0].triggered:%d/%m/%y, %H:%M:%S}" in fd.readline()
+
+    def test_snapshot_restore(self):
+        snapshot_file = tempfile.mkstemp()[1]
+        self.http_log_stats.sources = ["access.log"]
+        for log in self.log_generator.generate(generation_seconds=60, live=False):
+            log = Log.from_string(log)
+            log.source, log.offset = 0, 42
+            self.http_log_stats.update(log)
+        assert self.http_log_stats.files["access.log"].alert_monitor.alert_period_logs, \
+            "A single file window should be kept for when other files are discovered"
+        with open(self.tmp_file, encoding="utf-8") as fd:
+            assert " on access.log " not in fd.read(), "A single file alert duplicates global alerts"
+        self.http_log_stats.save_snapshot(snapshot_file)
+
+        restored = HTTPLogsStats(period=10, alert_period=10, alert_threshold=10)
+        assert restored.load_snapshot(snapshot_file), "Snapshot should have been loaded"
+        assert restored.all_stats.hits == self.http_log_stats.all_stats.hits
+        assert len(restored.alerts) == len(self.http_log_stats.alerts)
+        assert len(restored.alert_period_logs) == len(self.http_log_stats.alert_period_logs)
+        assert restored.in_alert == self.http_log_stats.in_alert
+        assert restored.files_in_alert == self.http_log_stats.files_in_alert
+        assert restored.offsets == {"access.log": 42}
+
+        other_threshold = HTTPLogsStats(period=10, alert_period=10, alert_threshold=20)
+        assert other_threshold.load_snapshot(snapshot_file)
+        assert other_threshold.alert_monitor.alert_rate_threshold == 20
+        assert other_threshold.alert_monitor.alert_rate_threshold_margin == 2
+        assert all(file.alert_monitor.alert_rate_threshold == 20 for file in other_threshold.files.values())
+
+        other_periods = HTTPLogsStats(period=5, alert_period=10, alert_threshold=10)
+        assert not other_periods.load_snapshot(snapshot_file), "Snapshot with other periods should be ignored"
+        os.remove(snapshot_file)
+
+    def test_background_snapshot(self):
+        snapshot_file = tempfile.mkstemp()[1]
+        for log in self.log_generator.generate(generation_seconds=10, live=False):
+            self.http_log_stats.update(Log.from_string(log))
+        self.http_log_stats.save_snapshot(snapshot_file, background=True)
+        hits = self.http_log_stats.all_stats.hits
+        self.http_log_stats.update(Log.from_string(self.log_generator.generate_log()))
+
+        # the thread writes the state as it was when the snapshot was taken
+        self.http_log_stats._snapshot_thread.join()
+        restored = HTTPLogsStats(period=10, alert_period=10, alert_threshold=10)
+        assert restored.load_snapshot(snapshot_file), "Background snapshot should have been written"
+        assert restored.all_stats.hits == hits
+        os.remove(snapshot_file)
+
+    def test_interrupted_snapshot(self):
+        directory = tempfile.mkdtemp()
+        snapshot_file = os.path.join(directory, "snapshot")
+        with mock.patch("os.fsync", side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.http_log_stats.save_snapshot, snapshot_file)
+        assert os.listdir(directory) == [], "Temporary snapshot file should be removed"
+
+        # an older background snapshot finishing later does not replace a newer one
+        self.http_log_stats._write_snapshot(snapshot_file, b"newer", 2)
+        self.http_log_stats._write_snapshot(snapshot_file, b"older", 1)
+        assert os.listdir(directory) == ["snapshot"]
+        with gzip.open(snapshot_file) as fd:
+            assert fd.read() == b"newer"
+        os.remove(snapshot_file)
+        os.rmdir(directory)
+
+    def test_files_partitions(self):
+        self.http_log_stats.sources = ["a.log", "b.log"]
+        for i, log in enumerate(self.log_generator.generate(generation_seconds=60, live=False)):
+            log = Log.from_string(log)
+            log.source, log.offset = i % 2, i
+            self.http_log_stats.update(log)
+
+        files = self.http_log_stats.files
+        assert set(files) == {"a.log", "b.log"}
+        assert self.http_log_stats.period_stats.hits == sum(file.period_stats.hits for file in files.values())
+        assert set(self.http_log_stats.offsets) == {"a.log", "b.log"}
+        assert all(file.alert_monitor.alert_period_logs for file in files.values())
+
+    def test_files_panel(self):
+        self.http_log_stats.sources = [f"{index}.log" for index in range(8)]
+        for source in range(8):
+            for second in range(source + 1):
+                self.http_log_stats.update(make_log(second, source, status_code=500 if source < 2 else 200))
+        # the panel shows the last complete period
+        self.http_log_stats.update(make_log(10, 7))
+
+        files = CliSwag._get_data_files(self.http_log_stats)
+        assert [file["file_name"] for file in files] == ["7.log", "6.log", "5.log", "4.log", "3.log", "(3 others)"]
+        others = HTTPStats.merge_all(self.http_log_stats.files[f"{index}.log"].period_stats for index in range(3))
+        assert files[-1]["file_hits"] == n_fmt(round(others.hits)) == "6"
+        assert files[-1]["file_bandwidth"] == size_fmt(others.bandwidth)
+        assert files[-1]["file_5xx"] == n_fmt(round(others.status_codes["5XX"])) == "3"
+        assert files[-1]["file_alert"] == "\2OK"
+
+        # an alert on a file out of the top files shows on the others line until it recovers
+        self.http_log_stats.update(make_log(11, 0, weight=200))
+        assert self.http_log_stats.files_in_alert == 1
+        assert CliSwag._get_data_files(self.http_log_stats)[-1]["file_alert"] == "\10KO"
+        self.http_log_stats.update(make_log(40, 0))
+        assert self.http_log_stats.files_in_alert == 0
+        assert CliSwag._get_data_files(self.http_log_stats)[-1]["file_alert"] == "\2OK"
+
+    def test_sampled_estimates(self):
+        sampler = LineSampler(rate=0.1)
+        all_stats, sampled_stats = HTTPStats(), HTTPStats()
+        for line in self.log_generator.generate(generation_seconds=3600, live=False):
+            log = Log.from_string(line)
+            all_stats.update(log)
+            if sampler.keep(line):
+                log.weight = sampler.weight
+                sampled_stats.update(log)
+
+        assert sampled_stats.hits_error > 0
+        assert abs(sampled_stats.hits - all_stats.hits) <= 2 * sampled_stats.hits_error
+
+    def test_top_sections(self):
+        stats, merged = HTTPStatsSections(), HTTPStatsSections()
+        for line in self.log_generator.generate(generation_seconds=600, live=False):
+            stats.update(Log.from_string(line))
+        merged.merge(stats)
+
+        for top_stats in (stats, merged):
+            top_hits = [hits for _, hits in top_stats.top_sections.most_common()]
+            assert top_hits == [hits for _, hits in top_stats.sections.most_common(HTTPStatsSections.TOP_K)]
+            top_hits = [hits for _, hits in top_stats.top_paths.most_common()]
+            assert top_hits == [hits for _, hits in top_stats.paths.most_common(HTTPStatsSections.TOP_K)]
+            assert top_stats.sections_visitors == sum(len(section.visitors)
+                                                      for section in top_stats.sections_stats.values())
+            assert top_stats.sections_paths == sum(len(section.paths) for section in top_stats.sections_stats.values())
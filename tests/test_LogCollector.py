@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import queue
+import tempfile
+import threading
+import subprocess
+
+from unittest import TestCase, mock, skipUnless
+
+from datalog_http_monitoring import shared_ring
+from datalog_http_monitoring.clock import SimulatedClock
+from datalog_http_monitoring.metrics import PipelineMetrics
+from datalog_http_monitoring.consumers_feeder import ConsumersFeeder
+from datalog_http_monitoring.log_collector import Log, EmptyLog, LogCollector, OverloadPolicy, LineSampler, \
+    WatchedFile
+
+
+LINES = [
+    '127.0.0.1 - james [09/May/2018:16:00:39 +0000] "GET /report HTTP/1.0" 200 123\n',
+    'garbage\n',
+    '127.0.0.1 - jill [09/May/2018:16:00:41 +0000] "GET /api/user HTTP/1.0" 200 234\n',
+    '127.0.0.1 - frank [09/May/2018:16:00:42 +0000] "POST /api/',  # incomplete line
+]
+
+
+class TestLogCollector(TestCase):
+    def setUp(self):
+        fd, self.tmp_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w", encoding="utf-8") as fd:
+            fd.writelines(LINES)
+
+    def tearDown(self):
+        os.remove(self.tmp_file)
+
+    def test_read_logs(self):
+        logs_queue = queue.Queue()
+        metrics = PipelineMetrics()
+        _, position = LogCollector.read_logs(self.tmp_file, logs_queue, 0, 0, metrics.watcher_counters)
+
+        assert logs_queue.qsize() == 2
+        assert position == len("".join(LINES[:3]))
+        assert logs_queue.get().offset == len(LINES[0])
+
+        data = metrics.snapshot()
+        assert (data["lines_read"], data["lines_parsed"], data["lines_failed"]) == (3, 2, 1)
+
+    def test_overload_policies(self):
+        for policy in (OverloadPolicy.DROP, OverloadPolicy.SAMPLE):
+            metrics = PipelineMetrics()
+            logs_queue = OverloadPolicy(queue.Queue(maxsize=10), policy, metrics.watcher_counters)
+            for _ in range(100):
+                logs_queue.put(Log.from_string(LINES[0]))
+
+            assert logs_queue.logs_queue.qsize() == 10
+            data = metrics.snapshot()
+            assert data["logs_dropped"] == 90
+            assert (data["sample_every"] > 1) == (policy == OverloadPolicy.SAMPLE)
+
+    def test_stages_self_time(self):
+        clock = SimulatedClock()
+        metrics = PipelineMetrics(clock)
+        collector, stats = ConsumersFeeder(metrics), ConsumersFeeder(metrics)
+
+        def update(log):
+            clock.sleep(0.5)
+            stats.feed_consumers(log)
+
+        def display(log):
+            clock.sleep(1)
+
+        collector.add_consumer(update)
+        stats.add_consumer(display)
+        collector.feed_consumers(None)
+
+        assert metrics.stages[update] == 0.5, "Time of fed stages should not be counted twice"
+        assert metrics.stages[display] == 1
+
+    def test_line_sampler(self):
+        sampler = LineSampler(rate=0.25)
+        lines = [f"{line} {i}\n" for i, line in enumerate(LINES * 1000)]
+        kept = [line for line in lines if sampler.keep(line)]
+
+        assert kept == [line for line in lines if sampler.keep(line)], "Sampling must be deterministic"
+        assert abs(len(kept) * sampler.weight - len(lines)) < len(lines) * 0.05
+
+    def test_watched_file_batches(self):
+        logs_queue = queue.Queue()
+        watched_file = WatchedFile(self.tmp_file, source=3)
+        assert watched_file.has_changed()
+        assert watched_file.read(logs_queue, max_lines=1) == 1
+        watched_file.schedule(10, 1, max_lines=1)
+        assert watched_file.next_check == 10, "File with more lines should be read again right after others"
+        assert logs_queue.get().source == 3
+
+        watched_file.read(logs_queue)
+        watched_file.schedule(10, 0)
+        watched_file.schedule(10, 0)
+        assert watched_file.interval > WatchedFile.MIN_INTERVAL, "Unchanged file should be checked less often"
+
+    def test_garbage_batches(self):
+        with open(self.tmp_file, "w", encoding="utf-8") as fd:
+            fd.writelines(["garbage\n"] * (LogCollector.READ_BATCH + 10) + LINES)
+        logs_queue = queue.Queue()
+        metrics = PipelineMetrics()
+        watched_file = WatchedFile(self.tmp_file)
+        lines = []
+        for _ in range(3):
+            assert watched_file.has_changed()
+            lines.append(watched_file.read(logs_queue, metrics.watcher_counters, max_lines=LogCollector.READ_BATCH))
+
+        # garbage lines are read once, the incomplete last line is left to be read again
+        assert lines == [LogCollector.READ_BATCH, 10 + 3, 0]
+        assert [logs_queue.get().user for _ in range(logs_queue.qsize())] == ["james", "jill"]
+        assert metrics.snapshot()["lines_failed"] == LogCollector.READ_BATCH + 10 + 1
+        assert watched_file.position == os.path.getsize(self.tmp_file) - len(LINES[-1])
+
+    def test_discover_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "a.log"), "w", encoding="utf-8") as fd:
+                fd.write(LINES[0])
+            collector = LogCollector(log_files={os.path.join(tmp_dir, "*.log")})
+            assert collector.sources == [os.path.join(tmp_dir, "a.log")]
+
+            collector.watcher_process.start()
+            try:
+                with open(os.path.join(tmp_dir, "b.log"), "w", encoding="utf-8") as fd:
+                    fd.write(LINES[2])
+                sources = set()
+                timeout = time.monotonic() + 10
+                for log in collector:
+                    if not isinstance(log, EmptyLog):
+                        sources.add(collector.sources[log.source])
+                    if len(sources) == 2 or time.monotonic() > timeout:
+                        break
+            finally:
+                collector.watcher_process.terminate()
+                collector.watcher_process.join()
+            assert sources == {os.path.join(tmp_dir, "a.log"), os.path.join(tmp_dir, "b.log")}
+
+    def test_shared_memory_transport(self):
+        collector = LogCollector(log_files={self.tmp_file}, queue_size=1, transport=LogCollector.SHARED_MEMORY)
+        collector.watcher_process.start()
+        try:
+            logs = []
+            for log in collector:
+                if not isinstance(log, EmptyLog):
+                    logs.append(log)
+                if len(logs) == 2:
+                    break
+        finally:
+            collector.watcher_process.terminate()
+            collector.watcher_process.join()
+            collector.close()
+
+        assert [log.user for log in logs] == ["james", "jill"]
+        assert [log.offset for log in logs] == [len(LINES[0]), len("".join(LINES[:3]))]
+        assert logs[0].date == Log.from_string(LINES[0]).date
+
+    def test_shared_ring_epochs(self):
+        ring = shared_ring.SharedRingQueue(capacity=4)
+        try:
+            with mock.patch.object(shared_ring, "MAX_VALUES", 8):
+                paths = []
+                for i in range(40):
+                    log = Log.from_string(LINES[0])
+                    log.path = f"/report/{i}"
+                    ring.put(log)
+                    paths.append(ring.get(timeout=5).path)
+                    # an epoch ends after the record exceeding its values count, with up to 6 new values
+                    assert len(ring.ids) < 8 + 6 and len(ring.values) <= 2 * (8 + 6) + 1
+        finally:
+            ring.close()
+
+        assert paths == [f"/report/{i}" for i in range(40)]
+        assert ring.epoch > 1
+
+    def test_shared_ring_wait(self):
+        ring = shared_ring.SharedRingQueue(capacity=1)
+        try:
+            self.assertRaises(queue.Empty, ring.get, timeout=.05)
+            ring.put(Log.from_string(LINES[0]))
+            self.assertRaises(queue.Full, ring.put_nowait, Log.from_string(LINES[2]))
+            self.assertRaises(queue.Full, ring.put, Log.from_string(LINES[2]), timeout=.05)
+            assert ring.get(block=False).user == "james"
+
+            # a blocked reader is woken up by the writer
+            timer = threading.Timer(.1, ring.put, (Log.from_string(LINES[2]),))
+            timer.start()
+            assert ring.get(timeout=5).user == "jill"
+            timer.join()
+        finally:
+            ring.close()
+        # closing twice (eg: again on exit) does nothing
+        ring.close()
+
+    @skipUnless(os.path.isdir(shared_ring.SHM_DIR), "shared memory segments are not listed")
+    def test_shared_ring_stale_segment(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        # left by a dead owner
+        stale = os.path.join(shared_ring.SHM_DIR, f"{shared_ring.SEGMENT_PREFIX}{process.pid}_0")
+        open(stale, "wb").close()
+        ring = shared_ring.SharedRingQueue(capacity=1)
+        try:
+            assert not os.path.exists(stale)
+            assert os.path.exists(os.path.join(shared_ring.SHM_DIR, ring.memory.name.lstrip("/")))
+        finally:
+            ring.close()
+        assert not os.path.exists(os.path.join(shared_ring.SHM_DIR, ring.memory.name.lstrip("/")))
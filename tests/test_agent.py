@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import zlib
+import socket
+
+from unittest import TestCase, mock
+
+from datalog_http_monitoring.log_collector import EmptyLog
+from datalog_http_monitoring import agent
+from datalog_http_monitoring.agent import LogAgent, LogAggregator, parse_address
+
+from tests import START, make_log
+
+
+class TestAgent(TestCase):
+    def setUp(self):
+        self.aggregator = LogAggregator(("127.0.0.1", 0))
+        self.aggregator.serve()
+
+    def tearDown(self):
+        self.aggregator.close()
+
+    def receive(self, count):
+        logs = []
+        for log in self.aggregator:
+            if isinstance(log, EmptyLog):
+                self.fail(f"Only {len(logs)} logs received instead of {count}")
+            logs.append(log)
+            if len(logs) == count:
+                return logs
+
+    def test_stream(self):
+        agent = LogAgent(self.aggregator.address, ["access.log"], name="web1", batch_size=10)
+        logs = [make_log(second) for second in range(25)]
+        for log in logs:
+            agent.update(log)
+        agent.close()
+
+        received = self.receive(len(logs))
+        assert self.aggregator.sources == ["web1:access.log"]
+        assert [(log.ip, log.user, log.date, log.path, log.size, log.source, log.offset) for log in received] == \
+               [(log.ip, log.user, log.date, log.path, log.size, log.source, log.offset) for log in logs]
+        assert not agent.buffered
+
+    def test_values_reset(self):
+        agent = LogAgent(self.aggregator.address, ["access.log"], name="web1", batch_size=5)
+        agent.MAX_VALUES = 4
+        logs = [make_log(second) for second in range(25)]
+        for log in logs:
+            agent.update(log)
+            assert len(agent.ids) < agent.MAX_VALUES + 5 * 6
+        agent.close()
+
+        assert [(log.ip, log.user, log.path) for log in self.receive(len(logs))] == \
+               [(log.ip, log.user, log.path) for log in logs]
+
+    def test_reconnect(self):
+        address = self.aggregator.address
+        self.aggregator.close()
+        agent = LogAgent(address, ["access.log"], name="web1", batch_size=5, max_buffered=8)
+        for second in range(10):
+            agent.update(make_log(second))
+        assert agent.thread.is_alive(), "Logs should be sent from a background thread"
+        assert agent.buffered == 8
+        assert agent.dropped == 2
+
+        self.aggregator = LogAggregator(address)
+        self.aggregator.serve()
+        agent.close()
+        assert [log.offset for log in self.receive(8)] == list(range(2, 10))
+
+    def test_resent_batches(self):
+        agent = LogAgent(self.aggregator.address, ["access.log"], name="web1", batch_size=5)
+        for second in range(10):
+            agent.pending.append(make_log(second))
+        assert agent.flush()
+        assert [sequence for sequence, _ in agent.in_flight] == [1, 2], "Acknowledgments are not read yet"
+        assert [log.offset for log in self.receive(10)] == list(range(10))
+
+        # the connection is lost before acknowledgments are read, batches are sent again
+        agent._disconnect(0)
+        agent.next_connect = 0
+        agent.update(make_log(10))
+        agent.close()
+        assert [log.offset for log in self.receive(1)] == [10], "Fed batches should not be fed again"
+        assert agent.sequence == 3 and not agent.in_flight
+
+    def send_frames(self, *frames) -> bytes:
+        """
+        :return: the aggregator answers, until it closes the connection
+        """
+        with socket.create_connection(self.aggregator.address) as connection:
+            connection.sendall(b"".join(frames))
+            connection.shutdown(socket.SHUT_WR)
+            connection.settimeout(5)
+            return connection.makefile("rb").read()
+
+    def test_oversized_batch(self):
+        records = zlib.compress(bytes(agent.RECORD.size * 2))
+        # more data than announced records
+        assert self.send_frames(agent.frame(agent.BATCH, agent.BATCH_HEADER.pack(1, 1) + records)) == b""
+        # less data than announced records
+        assert self.send_frames(agent.frame(agent.BATCH, agent.BATCH_HEADER.pack(1, 3) + records)) == b""
+        assert self.aggregator.logs_queue.empty()
+
+    def test_values_limit(self):
+        values = [agent.frame(agent.VALUE, agent.VALUE_HEADER.pack(value_id, agent.STRING) + b"/")
+                  for value_id in range(1, 6)]
+        # a record of path 4
+        record = agent.RECORD.pack(START.timestamp(), 0, 200, 1, 1, agent.NO_SOURCE, 0, 0, 0, 0, 4, 0, 0)
+        batch = agent.frame(agent.BATCH, agent.BATCH_HEADER.pack(1, 1) + zlib.compress(record))
+        with mock.patch.object(agent, "MAX_SESSION_VALUES", 4):
+            assert self.send_frames(*values, batch) == b""
+            assert self.send_frames(*values[:3], agent.frame(agent.RESET, b""), *values[:4], batch) == \
+                agent.frame(agent.ACK, agent.SEQUENCE.pack(1)), "Values should be counted from the last reset"
+        assert [log.path for log in self.receive(1)] == ["/"]
+
+    def test_parse_address(self):
+        assert parse_address("localhost:5140") == ("localhost", 5140)
+        assert parse_address("5140") == ("127.0.0.1", 5140)
+        assert parse_address("5140", "0.0.0.0") == ("0.0.0.0", 5140)
+        assert parse_address("[::1]:5140") == ("::1", 5140)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+from datalog_http_monitoring.anomaly import AnomalyMonitor
+
+from tests import START, make_log
+
+
+class TestAnomalyMonitor(TestCase):
+    def test_section_spike(self):
+        monitor = AnomalyMonitor(interval=10)
+        changed = []
+        for second in range(600):
+            # /api is steady, /report is quiet and spikes from 200s to 300s
+            changed.extend(monitor.check(make_log(second, path="/api/user")))
+            changed.extend(monitor.check(make_log(second + 0.5, path="/api/user")))
+            if second % 5 == 0:
+                changed.extend(monitor.check(make_log(second, path="/report")))
+            if 200 <= second < 300:
+                for _ in range(5):
+                    changed.extend(monitor.check(make_log(second, path="/report")))
+
+        assert [alert.kind for alert in changed] == ["Traffic spike on /report"] * 2
+        assert changed[0].finished and not monitor.in_alert
+        assert 200 <= changed[0].start.timestamp() - START.timestamp() <= 210
+        assert 300 <= changed[0].end.timestamp() - START.timestamp() <= 310
+
+    def test_new_section_warmup(self):
+        monitor = AnomalyMonitor(interval=10)
+        changed = []
+        for second in range(300):
+            changed.extend(monitor.check(make_log(second, path="/api/user")))
+            # a section first requested at 200s learns its baseline before alerting
+            if second >= 200:
+                for _ in range(5 if second < 230 else 1):
+                    changed.extend(monitor.check(make_log(second, path="/new")))
+
+        assert changed == [] and monitor.sections["new"].baseline.samples == 9
+
+    def test_error_ratio(self):
+        monitor = AnomalyMonitor(interval=10)
+        changed = []
+        for second in range(300):
+            for i in range(4):
+                status_code = 500 if second >= 200 and i % 2 or second % 20 == 0 and i == 0 else 200
+                changed.extend(monitor.check(make_log(second, path=f"/section{i}", status_code=status_code)))
+
+        assert len(changed) == 1 and changed[0].kind.startswith("High 5XX ratio")
+        assert monitor.in_alert
+
+    def test_sections_in_alert_kept(self):
+        monitor = AnomalyMonitor(interval=10, max_sections=2)
+        changed = []
+        for second in range(400):
+            # both tracked sections spike from 200s to 300s, while another section is requested
+            for section in ("api", "report"):
+                for _ in range(6 if 200 <= second < 300 else 1):
+                    changed.extend(monitor.check(make_log(second, path=f"/{section}")))
+            if 250 <= second < 260:
+                changed.extend(monitor.check(make_log(second, path="/other")))
+
+        assert sorted(alert.kind for alert in changed) == \
+               ["Traffic spike on /api"] * 2 + ["Traffic spike on /report"] * 2
+        assert all(alert.finished for alert in changed) and not monitor.in_alert
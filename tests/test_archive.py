@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+import tempfile
+import threading
+
+from ipaddress import ip_address
+from unittest import TestCase, mock
+
+from datalog_http_monitoring.log_collector import EmptyLog
+from datalog_http_monitoring.archive import LogArchive, ArchiveSegment
+from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
+
+from tests import START, make_log
+
+
+def make_sampled_log(second):
+    # every 5th log stands for 2 logs
+    return make_log(second, status_code=200 + second % 2, weight=2.0 if second % 5 == 0 else 1)
+
+
+def fields(log):
+    return log.ip, log.user, log.date, log.method, log.path, log.status_code, log.size, log.weight, log.source, \
+           log.offset
+
+
+class TestLogArchive(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = LogArchive(self.directory, sources=["access.log"], segment_size=40)
+
+    def test_read_back(self):
+        # a late log is sorted within its segment
+        seconds = list(range(100))
+        seconds[10], seconds[11] = seconds[11], seconds[10]
+        logs = [make_sampled_log(second) for second in seconds]
+        for log in logs:
+            self.archive.add(log)
+        self.archive.close()
+
+        assert [entry["count"] for entry in LogArchive.segments(self.directory)] == [40, 40, 20]
+        assert [fields(log) for log in LogArchive.read(self.directory)] == \
+               [fields(make_sampled_log(second)) for second in range(100)]
+
+        start, end = (START + datetime.timedelta(seconds=second) for second in (30, 50))
+        entries = LogArchive.segments(self.directory, start.timestamp(), end.timestamp())
+        assert len(entries) == 2
+        assert [log.offset for log in LogArchive.read(self.directory, start.timestamp(), end.timestamp())] == \
+               list(range(30, 50))
+
+        with ArchiveSegment(entries[0]["segment"]) as segment:
+            assert len(segment) == 40
+            assert segment.sources == ["access.log"]
+            top = segment.top("status_code", start.timestamp(), end.timestamp())
+            assert top == {200: 6, 201: 6}
+            assert segment.top("ip")[ip_address("10.0.0.0")] == 12
+
+    def test_writer_thread(self):
+        threads = []
+        with mock.patch.object(LogArchive, "_write_segment", autospec=True,
+                               side_effect=lambda *args: threads.append(threading.current_thread().name)):
+            for second in range(100):
+                self.archive.add(make_sampled_log(second))
+            assert self.archive.segment == 3, "Full segments should be handed to the writer"
+            self.archive.close()
+        assert threads == ["LogArchive"] * 3
+
+    def test_invalid_segment(self):
+        path = os.path.join(self.directory, "segment-000001.dlg")
+        with open(path, "wb") as fd:
+            fd.write(b"NOPE" + bytes(64))
+        with mock.patch.object(ArchiveSegment, "close", autospec=True, side_effect=ArchiveSegment.close) as close:
+            self.assertRaises(AssertionError, ArchiveSegment, path)
+        assert close.call_count == 1, "The memory map should be closed"
+
+    def test_rollups(self):
+        stats = HTTPLogsStats(period=10)
+        stats.sources = ["access.log"]
+        stats.add_consumer(self.archive.add_rollup)
+        for second in range(35):
+            stats.update(make_sampled_log(second))
+        stats.update(EmptyLog(START + datetime.timedelta(seconds=45)))
+
+        rollups = list(LogArchive.rollups(self.directory))
+        assert [(period_start.second, period_end.second) for period_start, period_end, _ in rollups] == \
+               [(0, 10), (10, 20), (20, 30), (30, 45)]
+        assert [round(period_stats.hits) for _, _, period_stats in rollups] == [14, 12, 12, 4]
+        assert len(list(LogArchive.rollups(self.directory, end=(START.timestamp() + 15)))) == 2
+
+    def test_idle_ticks(self):
+        # replayed logs are old, idle ticks are dated with the wall clock
+        for second in range(10):
+            self.archive.add(make_sampled_log(second))
+            self.archive.add(EmptyLog())
+        self.archive.close()
+        assert [entry["count"] for entry in LogArchive.segments(self.directory)] == [10]
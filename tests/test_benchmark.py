@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import tempfile
+import contextlib
+
+from unittest import TestCase
+
+from benchmarks import benchmark
+
+
+class TestBenchmark(TestCase):
+    def test_corpus_is_reproducible(self):
+        corpus = benchmark.generate_corpus(seed=1, lines=100, rate=10)
+        assert corpus == benchmark.generate_corpus(seed=1, lines=100, rate=10)
+        assert corpus != benchmark.generate_corpus(seed=2, lines=100, rate=10)
+
+    def test_results_and_compare(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "results.json")
+            with contextlib.redirect_stderr(io.StringIO()):
+                benchmark.main(["--lines", "200", "--repeat", "1", "--only", "log_from_string", "http_stats_update",
+                                "--output", output])
+            with open(output, encoding="utf-8") as fd:
+                results = json.load(fd)
+
+            assert (results["seed"], results["lines"]) == (42, 200)
+            assert set(results["benchmarks"]) == {"log_from_string", "http_stats_update"}
+            for result in results["benchmarks"].values():
+                assert set(result) == {"count", "best_seconds", "timings", "per_second", "peak_memory", "unit"}
+                assert result["count"] == 200 and len(result["timings"]) == 1
+
+            del results["benchmarks"]["http_stats_update"]
+            with open(output, "w", encoding="utf-8") as fd:
+                json.dump(results, fd)
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+                benchmark.main(["--lines", "200", "--repeat", "1", "--only", "log_from_string", "http_stats_update",
+                                "--compare", output])
+
+        comparison = stdout.getvalue().split("\n}\n", 1)[1].splitlines()
+        assert len(comparison) == 2
+        assert comparison[0].startswith("log_from_string ") and "x  peak " in comparison[0]
+        assert comparison[1].startswith("http_stats_update ") and comparison[1].endswith("(new)")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+from datalog_http_monitoring.clock import SimulatedClock
+from datalog_http_monitoring.log_collector import EmptyLog, WatchedFile
+from datalog_http_monitoring.event_time import EventTimeMerger
+
+from tests import START, make_log
+
+
+class TestEventTimeMerger(TestCase):
+    def setUp(self):
+        self.merger = EventTimeMerger(max_delay=30, known_sources=["a.log", "b.log"])
+        self.merger.WATERMARK_INTERVAL = 0
+        self.logs = []
+        self.merger.add_consumer(self.logs.append)
+
+    def test_merge(self):
+        # second file falls 5 seconds behind
+        for second in range(20):
+            self.merger.update(make_log(second, 0))
+            self.merger.update(make_log(max(second - 5, 0), 1))
+
+        dates = [log.date for log in self.logs]
+        assert dates == sorted(dates), "Logs should be released in date order"
+        assert len(self.logs) < 40 and len(self.merger.buffer) == 40 - len(self.logs)
+        assert self.merger.late == 0
+
+    def test_interleaved_batches(self):
+        # files are read in turns of batches of 100 lines, 5 logs per second
+        for batch in range(5):
+            for source in (0, 1):
+                for index in range(batch * 100, (batch + 1) * 100):
+                    self.merger.update(make_log(index // 5, source))
+
+        dates = [log.date for log in self.logs]
+        assert dates == sorted(dates), "Logs should be released in date order"
+        assert self.merger.late == 0
+        assert len(self.logs) + len(self.merger.buffer) == 1000
+
+    def test_single_source(self):
+        self.merger.known_sources = ["a.log"]
+        self.merger.update(make_log(0, 0))
+        assert len(self.logs) == 1, "Logs of a single source are passed through"
+
+    def test_idle_source(self):
+        clock = SimulatedClock(START)
+        self.merger = EventTimeMerger(max_delay=30, idle_timeout=5, known_sources=["a.log", "b.log", "c.log"],
+                                      clock=clock)
+        self.merger.add_consumer(self.logs.append)
+        self.merger.update(make_log(0, 0))
+        self.merger.update(make_log(10, 1))
+        self.merger.update(EmptyLog())
+        assert len(self.merger.buffer) == 2, "Source 2 has not sent logs yet, it may be read next"
+        clock.sleep(EventTimeMerger.FIRST_LOG_TIMEOUT)
+        self.merger.update(EmptyLog())
+        assert [log.source for log in self.logs if not isinstance(log, EmptyLog)] == [0], \
+            "A file which never sent logs should not hold logs back for long"
+        clock.sleep(5)
+        self.merger.update(EmptyLog())
+        assert [log.source for log in self.logs if not isinstance(log, EmptyLog)] == [0, 1], \
+            "Idle sources should not hold logs back"
+        assert isinstance(self.logs[-1], EmptyLog)
+
+    def test_slow_polled_source(self):
+        clock = SimulatedClock(START)
+        self.merger = EventTimeMerger(max_delay=30, known_sources=["a.log", "b.log"], clock=clock)
+        assert self.merger.idle_timeout > WatchedFile.MAX_INTERVAL
+        self.merger.add_consumer(self.logs.append)
+        # both files are read at startup, then the second one is polled slowly
+        self.merger.update(make_log(0, 1))
+        for second in range(60):
+            clock.sleep(1)
+            self.merger.update(make_log(second, 0))
+            # a file written now and then is checked at the slowest polling interval
+            if second % WatchedFile.MAX_INTERVAL == WatchedFile.MAX_INTERVAL - 1:
+                for date in range(second - int(WatchedFile.MAX_INTERVAL) + 1, second + 1):
+                    self.merger.update(make_log(date, 1))
+            self.merger.update(EmptyLog())
+
+        dates = [log.date for log in self.logs if not isinstance(log, EmptyLog)]
+        assert dates == sorted(dates) and len(dates) + len(self.merger.buffer) == 121
+        assert self.merger.late == 0, "A slowly polled source should not be idle between two reads"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import itertools
+
+from unittest import TestCase
+
+from datalog_http_monitoring.clock import SimulatedClock
+from datalog_http_monitoring.log_collector import Log
+from datalog_http_monitoring.generate_logs import LogGenerator, write_logs_bulk
+
+from tests import START
+
+
+def make_generator(seed=42):
+    return LogGenerator(users=10, files=10, ips=10, threshold_requests=10, threshold_period=10,
+                        threshold_duration_max=10, threshold_trigger_each=10, seed=seed,
+                        clock=SimulatedClock(START))
+
+
+class TestLogGenerator(TestCase):
+    def test_same_seed_same_blocks(self):
+        blocks = list(make_generator().generate_blocks(rate=50, generation_seconds=10, live=False))
+        assert len(set(blocks)) == 10, "Each second should have its own logs"
+        assert blocks == list(make_generator().generate_blocks(rate=50, generation_seconds=10, live=False))
+        assert blocks != list(make_generator(seed=0).generate_blocks(rate=50, generation_seconds=10, live=False))
+
+    def test_same_seed_same_logs(self):
+        generator, other_generator = make_generator(), make_generator()
+        logs = [generator.generate_log(START) for _ in range(10)]
+        assert len(set(logs)) > 1, "Logs should be drawn from the generator state, not a fresh one"
+        assert logs == [other_generator.generate_log(START) for _ in range(10)]
+        assert logs != [make_generator(seed=0).generate_log(START) for _ in range(10)]
+
+    def test_blocks_rate(self):
+        blocks = list(make_generator().generate_blocks(rate=20, generation_seconds=10, live=False))
+        assert len(blocks) == 10, "One block per generated second"
+        for second, block in enumerate(blocks):
+            dates = {Log.from_string(line).date for line in block.splitlines()}
+            assert len(block.splitlines()) == 20
+            assert len(dates) == 1 and (dates.pop() - START).total_seconds() == second - 10
+
+        blocks = list(make_generator().generate_blocks(rate=2.5, generation_seconds=4, live=False))
+        assert [block.count("\n") for block in blocks] == [2, 3, 2, 3], "Fractional rates are kept over time"
+
+    def test_live_blocks_rate(self):
+        generator = make_generator()
+        clock = generator.clock
+        seconds = []
+        for block in itertools.islice(generator.generate_blocks(rate=20, generation_seconds=2, live=True), 6):
+            dates = {Log.from_string(line).date for line in block.splitlines()}
+            assert len(block.splitlines()) == 20 and len(dates) == 1
+            seconds.append(((dates.pop() - START).total_seconds(), (clock.utcnow() - START).total_seconds()))
+        # past seconds are generated right away, then each second is generated when it comes
+        assert seconds == [(-2, 0), (-1, 0), (0, 0), (1, 1), (2, 2), (3, 3)]
+
+    def test_write_logs_bulk(self):
+        output = io.StringIO()
+        write_logs_bulk(make_generator(), output, rate=30, period=10, live=False)
+        lines = output.getvalue().splitlines()
+        assert len(lines) == 300
+        assert all(Log.from_string(line) for line in lines)
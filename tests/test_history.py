@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import stat
+import socket
+import tempfile
+
+from unittest import TestCase, mock
+
+from datalog_http_monitoring import history
+from datalog_http_monitoring.log_collector import Log
+from datalog_http_monitoring.history import RecentHistory, PATH, FIELDS
+
+
+LINES = [
+    '127.0.0.1 - james [09/May/2018:16:00:00 +0000] "GET /api/user HTTP/1.0" 503 12\n',
+    '127.0.0.1 - jill [09/May/2018:16:00:30 +0000] "GET /api/report HTTP/1.0" 200 34\n',
+    '127.0.0.1 - frank [09/May/2018:16:01:00 +0000] "POST /api/user HTTP/1.0" 500 56\n',
+    '127.0.0.1 - mary [09/May/2018:16:02:00 +0000] "GET /report HTTP/1.0" 500 78\n',
+]
+
+
+class TestRecentHistory(TestCase):
+    def setUp(self):
+        self.history = RecentHistory(retention=100)
+        for line in LINES:
+            self.history.add(Log.from_string(line))
+
+    def test_query(self):
+        assert len(self.history.query()) == 3, "Logs older than retention should be removed"
+        assert [record[PATH] for record in self.history.query(section="api", status="5XX")] == ["/api/user"]
+        assert self.history.query(status="503") == []
+        assert len(self.history.query(last=60, status="5XX")) == 1
+        assert sorted(self.history.top("section", status="5XX")) == [("api", 1), ("report", 1)]
+
+    def test_limit(self):
+        assert [record[PATH] for record in self.history.query(limit=2)] == ["/report", "/api/user"]
+        assert self.history.count(status="5XX") == 2
+        with mock.patch("datalog_http_monitoring.history._Bucket.record", autospec=True,
+                        side_effect=history._Bucket.record) as record:
+            response = self.history.answer({"status": "5XX", "limit": 1})
+        assert response["count"] == 2 and [log["path"] for log in response["records"]] == ["/report"]
+        assert record.call_count == 1, "Only returned records should be decoded"
+
+    def test_top(self):
+        log = Log.from_string(LINES[3])
+        log.weight = 2.5
+        log.source = 0
+        self.history.add(log)
+        assert sorted(self.history.top("path")) == [("/api/report", 1), ("/api/user", 1), ("/report", 3.5)]
+        assert self.history.top("status", limit=1) == [(500, 4.5)]
+        assert sorted(self.history.top("source"), key=str) == [(0, 2.5), (None, 3)]
+        assert self.history.top("user", section="report") == [("mary", 3.5)]
+
+    def test_records(self):
+        log = Log.from_string('127.0.0.1 - - [09/May/2018:18:02:30 +0200] "GET /api/user HTTP/1.0" 503 12\n')
+        log.source = 1
+        self.history.add(log)
+        record = self.history.query(last=1)[0]
+        assert dict(zip(FIELDS, record)) == {
+            "date": log.date, "section": "api", "status": 503, "size": 12, "weight": 1, "method": "GET",
+            "path": "/api/user", "ip": log.ip, "user": None, "source": 1}
+        assert record[0].utcoffset() == log.date.utcoffset()
+        assert self.history.query(section="report")[0][-1] is None, "Logs without source should be kept as None"
+
+    def test_max_records(self):
+        history = RecentHistory(retention=1000, max_records=2)
+        for line in LINES:
+            history.add(Log.from_string(line))
+        assert [record[PATH] for record in history.query()] == ["/report", "/api/user"]
+
+        # the newest second alone reaches the limit
+        history.add(Log.from_string(LINES[3]))
+        history.add(Log.from_string(LINES[3]))
+        assert history.records == len(history.query()) == 2
+
+    def test_serve(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), "history.sock")
+        server = self.history.serve(socket_path)
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(socket_path)
+                client.sendall(b'{"section": "api", "group_by": "path"}\n')
+                response = json.loads(client.makefile("rb").readline())
+        finally:
+            server.shutdown()
+            os.remove(socket_path)
+        assert sorted(response["top"]) == [["/api/report", 1], ["/api/user", 1]]
+
+    def test_serve_path(self):
+        directory = tempfile.mkdtemp()
+        socket_path = os.path.join(directory, "history.sock")
+        server = self.history.serve(socket_path)
+        server.shutdown()
+        server.server_close()
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600, "Only the user should access the socket"
+
+        # a socket left by a previous run is replaced, not a regular file
+        server = self.history.serve(socket_path)
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+        with open(socket_path, "w") as fd:
+            fd.write("not a socket")
+        self.assertRaises(FileExistsError, self.history.serve, socket_path)
+        assert os.path.isfile(socket_path)
+        os.remove(socket_path)
+        os.rmdir(directory)
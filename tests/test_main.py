@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import subprocess
+
+from unittest import TestCase
+
+
+# modules which are slow to import and must only be imported by the code paths using them
+HEAVY_MODULES = ["faker", "isodate", "humanize", "coloredlogs", "pstats", "cProfile"]
+
+
+class TestMain(TestCase):
+    def test_lazy_imports(self):
+        code = (
+            "import sys\n"
+            "from datalog_http_monitoring.__main__ import parse_args\n"
+            "from datalog_http_monitoring.cli_swag import CliSwag\n"
+            "from datalog_http_monitoring.log_collector import LogCollector\n"
+            "from datalog_http_monitoring.http_logs_stats import HTTPLogsStats\n"
+            "parse_args([])\n"
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+        )
+        output = subprocess.check_output([sys.executable, "-c", code], universal_newlines=True)
+        assert not output.strip(), f"Heavy modules imported at startup: {output.strip()}"
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+import tempfile
+
+from unittest import TestCase
+
+from datalog_http_monitoring import parsers
+from datalog_http_monitoring.log_collector import Log
+
+
+COMMON = '127.0.0.1 - james [09/May/2018:16:00:39 +0200] "GET /report HTTP/1.0" 200 123\n'
+COMBINED = '127.0.0.1 - - [09/May/2018:16:00:39 +0200] "GET /report HTTP/1.1" 200 123 ' \
+           '"https://example.com/" "Mozilla/5.0 (X11; Linux x86_64)"\n'
+JSON = '{"remote_addr": "127.0.0.1", "remote_user": "james", "time_iso8601": "2018-05-09T16:00:39+02:00", ' \
+       '"request": "GET /report HTTP/1.0", "status": "200", "body_bytes_sent": "123"}\n'
+
+
+class TestParsers(TestCase):
+    def assert_log(self, log):
+        expected = Log.from_string(COMMON)
+        assert log, "Line should have been parsed"
+        for field in ("ip", "date", "method", "path", "status_code", "size"):
+            assert getattr(log, field) == getattr(expected, field), f"Wrong {field}"
+
+    def test_parsers(self):
+        self.assert_log(parsers.get_parser("common")(COMMON))
+        self.assert_log(parsers.get_parser("json")(JSON))
+
+        log = parsers.get_parser("combined")(COMBINED)
+        self.assert_log(log)
+        assert log.user is None
+        assert log.user_agent == "Mozilla/5.0 (X11; Linux x86_64)"
+
+    def test_format_string(self):
+        parse = parsers.get_parser('$remote_addr $request_time [$time_local] "$request" $status $body_bytes_sent')
+        self.assert_log(parse('127.0.0.1 0.003 [09/May/2018:16:00:39 +0200] "GET /report HTTP/1.0" 200 123'))
+        assert parse(JSON) is None
+
+    def test_detect_parser(self):
+        for line, name in ((COMMON, "common"), (COMBINED, "combined"), (JSON, "json")):
+            assert parsers.detect_parser([line] * 3)[0] == name
+        assert parsers.detect_parser(["garbage\n"]) == (None, None)
+        # trailing fields after the common ones, eg: a response time
+        assert parsers.detect_parser([COMMON.rstrip("\n") + " 0.003\n"] * 3)[0] == "common"
+
+    def test_detect_file_fallback(self):
+        log_file = tempfile.mkstemp()[1]
+        with open(log_file, "w", encoding="utf-8") as fd:
+            fd.write("127.0.0.1 - james [09/May/2018:16:00:39 +0000] GET /report 200 123\n")
+        _, parse = parsers.detect_file_parser(log_file)
+        assert parse is Log.from_string
+        os.remove(log_file)
+
+    def test_parse_clf_date(self):
+        assert parsers.parse_clf_date("09/May/2018:16:00:39 -0130") == datetime.datetime(
+            2018, 5, 9, 16, 0, 39, tzinfo=datetime.timezone(-datetime.timedelta(hours=1, minutes=30)))
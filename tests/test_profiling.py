@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import pstats
+import signal
+import tempfile
+import threading
+import subprocess
+from unittest import TestCase, mock
+
+from datalog_http_monitoring import profiling
+from datalog_http_monitoring.agent import LogAgent, LogAggregator
+
+from tests import make_log
+
+
+def busy_work():
+    return sum(index * index for index in range(10000))
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_dir = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def stats_functions(self, name: str) -> set:
+        path = os.path.join(self.output_dir, f"{name}.{os.getpid()}")
+        assert os.path.exists(f"{path}.txt")
+        with open(f"{path}.txt", encoding="utf-8") as fd:
+            assert "=== Top 20 functions by cumulative time ===" in fd.read()
+        return {function for _, _, function in pstats.Stats(f"{path}.prof").stats}
+
+    def test_dump(self):
+        profiler = profiling.Profiler(self.output_dir, "main process", interval=0)
+        profiler.start()
+        busy_work()
+        profiler.tick()
+        assert "busy_work" in self.stats_functions("main_process")
+        profiler.stop()
+
+    def test_thread(self):
+        def work():
+            profiling.start_thread()
+            try:
+                busy_work()
+            finally:
+                profiling.stop()
+
+        with mock.patch.dict(os.environ, {profiling.ENV_DIR: self.output_dir}):
+            thread = threading.Thread(target=work, name="Worker")
+            thread.start()
+            thread.join()
+        assert "busy_work" in self.stats_functions("MainProcess-Worker")
+        # not profiled from the main thread
+        assert not os.path.exists(os.path.join(self.output_dir, f"MainProcess.{os.getpid()}.prof"))
+
+    def test_agent_sender_thread(self):
+        aggregator = LogAggregator(("127.0.0.1", 0))
+        aggregator.serve()
+        try:
+            with mock.patch.dict(os.environ, {profiling.ENV_DIR: self.output_dir}):
+                agent = LogAgent(aggregator.address, ["access.log"], batch_size=10)
+                for second in range(25):
+                    agent.update(make_log(second))
+                # sent from the sender thread rather than by `close`
+                while agent.pending:
+                    time.sleep(.01)
+                agent.close()
+        finally:
+            aggregator.close()
+        assert "flush" in self.stats_functions("MainProcess-LogAgent")
+
+    def test_sigterm(self):
+        script = ("import time\n"
+                  "from datalog_http_monitoring import profiling\n"
+                  "profiling.setup(sys.argv[1])\n"
+                  "try:\n"
+                  "    print('started', flush=True)\n"
+                  "    time.sleep(30)\n"
+                  "finally:\n"
+                  "    profiling.stop()\n")
+        process = subprocess.Popen([sys.executable, "-c", "import sys\n" + script, self.output_dir],
+                                   stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(__file__)))
+        try:
+            assert process.stdout.readline() == b"started\n"
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=10) == 128 + signal.SIGTERM
+        finally:
+            process.kill()
+            process.stdout.close()
+        path = os.path.join(self.output_dir, f"MainProcess.{process.pid}")
+        assert os.path.exists(f"{path}.txt")
+        # stats written once the handler raised SystemExit
+        assert "_exit" in {function for _, _, function in pstats.Stats(f"{path}.prof").stats}
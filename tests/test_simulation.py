@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from unittest import TestCase
+
+from datalog_http_monitoring.clock import SimulatedClock
+from datalog_http_monitoring.cli_swag import CliSwag
+from datalog_http_monitoring.simulation import Simulation, START_DATE
+from datalog_http_monitoring.http_logs_stats import HTTPLogsStats
+
+
+class TestSimulation(TestCase):
+    def test_alerts_timing(self):
+        simulation = Simulation(hours=6, seed=1)
+        assert simulation.run()
+        assert simulation.stats.alerts, "Spam periods should have triggered alerts"
+        assert simulation.check() == []
+        assert simulation.clock.utcnow() >= START_DATE + datetime.timedelta(hours=6)
+
+    def test_wrong_alerts_detected(self):
+        simulation = Simulation(hours=1, seed=1)
+        simulation.run()
+        # an alert recovered too late
+        simulation.stats.alerts[0].end += datetime.timedelta(seconds=1)
+        assert simulation.check()
+
+    def test_simulated_refresh(self):
+        clock = SimulatedClock(START_DATE)
+        cli = CliSwag(refresh_time=1, use_curses=False, clock=clock)
+        cli.next_refresh = clock.time() + 1
+        cli.update(HTTPLogsStats(clock=clock))
+        assert cli.next_refresh == clock.time() + 1, "Screen should not have been refreshed yet"
+        clock.sleep(1)
+        cli.format_stats = lambda http_stats: ""
+        cli._display = lambda content: None
+        cli.update(HTTPLogsStats(clock=clock))
+        assert cli.next_refresh == clock.time() + 1